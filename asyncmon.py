@@ -0,0 +1,122 @@
+from micropython import const
+from array import array
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# asyncio API of the PowerMonitor
+#
+#   async def lamps():
+#       while True:
+#           lamps = await pm.lamps_changed()
+#           ...
+#
+#   async def events():
+#       async for timestamp, index, old, new in pm.changes():
+#           ...
+#
+#   async def frames():
+#       while True:
+#           frame, buf = await pm.frame()
+#           ...
+#
+# The poller sets a ThreadSafeFlag after each batch of words that changed
+# something and counts the changes of each kind in signalseq (see SIG_* in
+# powermon_viper.py). A single task waits for the flag, checks which counters
+# changed and wakes the coroutines that wait for these kinds of changes with an
+# Event, so any number of coroutines can wait and none of them runs in the
+# poller thread. Changes are coalesced: all changes in a batch of the poller
+# and all batches until the task runs wake a waiting coroutine once. Use
+# changes() to see every change.
+
+# Same as SIG_* of powermon_viper.py
+SIG_LAMPS = const(0)
+SIG_SOLENOIDS = const(1)
+SIG_GI = const(2)
+SIG_FRAME = const(3)
+SIG_READY = const(4)
+SIG_NUM = const(5)
+SIG_ANY = const(5)       # all but SIG_FRAME, not counted by the poller
+EVENT_WORDS = const(2)
+CHANGE_BATCH = const(16)
+
+
+class ChangeNotifier():
+
+    def __init__(self, signalseq):
+        self.signalseq = signalseq
+        self.seen = array('I', signalseq)
+        self.flag = asyncio.ThreadSafeFlag()
+        self.events = [asyncio.Event() for i in range(SIG_NUM + 1)]
+        self.task = None
+        self.wakeups = 0
+
+    def start(self):
+        # Starts the task that waits for the poller, needs a running event loop
+        if self.task is None:
+            self.task = asyncio.create_task(self.dispatch())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def dispatch(self):
+        seq = self.signalseq
+        seen = self.seen
+        events = self.events
+        while True:
+            await self.flag.wait()
+            self.wakeups += 1
+            changed = False
+            for k in range(SIG_NUM):
+                s = seq[k]
+                if s != seen[k]:
+                    seen[k] = s
+                    # Wakes all coroutines that are waiting now
+                    events[k].set()
+                    events[k].clear()
+                    if k != SIG_FRAME:
+                        changed = True
+            if changed:
+                events[SIG_ANY].set()
+                events[SIG_ANY].clear()
+
+    async def wait(self, kind):
+        self.start()
+        await self.events[kind].wait()
+
+    def get_stats(self):
+        return {
+            "signals": sum(self.signalseq),
+            "wakeups": self.wakeups,
+            }
+
+
+class ChangeStream():
+    # Async iterator over the event journal of the PowerMonitor, yields
+    # (timestamp, index, old, new) for every change, see
+    # PowerMonitor.read_events()
+
+    def __init__(self, pm, notifier, batch=CHANGE_BATCH):
+        self.pm = pm
+        self.notifier = notifier
+        self.buf = array('I', [0]*(batch*EVENT_WORDS))
+        self.n = 0
+        self.pos = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while self.pos >= self.n:
+            self.pos = 0
+            self.n = self.pm.read_events(self.buf)
+            if not self.n:
+                # The poller journals a change before it signals it
+                await self.notifier.wait(SIG_ANY)
+        i = self.pos * EVENT_WORDS
+        self.pos += 1
+        w = self.buf[i+1]
+        return self.buf[i], w >> 16, (w >> 8) & 0xff, w & 0xff
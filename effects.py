@@ -1,5 +1,7 @@
 from machine import Pin, PWM, Timer
 import utime
+import math
+from array import array
 
 PWM_OFF = const(0)              # Output nothing
 PWM_SINGLESHOT = const(1)       # Play the effect once and turn off
@@ -8,6 +10,11 @@ PWM_CYCLIC = const(3)           # Cycle the effect
 PWM_BACKANDFORTH = const(4)     # Cycle forward/backward through the effect
 PWM_RAMPDOWN = const(5)         # Play the effect backward once
 
+# Kinds of effects
+EFFECT_SAMPLES = const(0)   # bytearray, 8-bit samples
+EFFECT_TABLE = const(1)     # array('H'), 16-bit duty cycles
+EFFECT_KEYFRAMES = const(2) # Keyframes.data
+
 def pwm_update(p):
     p.update_data()
     
@@ -20,16 +27,18 @@ class PWMEffect():
         
         self.effectlen=0
         self.effect=bytearray(0)
+        self.effectkind=EFFECT_SAMPLES
         self.effectcounter=0
         self.effectdir=0
         self.update_ms=update_ms
         self.datadir=0
         self.timer=None
         
-    def play_effect(self, data, datalen, mode=PWM_OFF):
+    def play_effect(self, data, datalen=None, mode=PWM_OFF):
+        # data: bytearray (8-bit samples), array('H') (16-bit duty cycles) or
+        # Keyframes, datalen defaults to the length of the effect
         self.effectcounter = 0
-        self.effect=data
-        self.effectlen=datalen
+        self.effectkind, self.effect, self.effectlen = effect_data(data, datalen)
         self.effectmode=mode
         self.start_effecttimer()
         
@@ -45,7 +54,7 @@ class PWMEffect():
             
         if rampdown:
             if self.effectcounter >= self.effectlen:
-                self.effectcounter >= self.effectlen-1
+                self.effectcounter = self.effectlen-1
             self.effectmode=PWM_RAMPDOWN
             self.start_effecttimer()
         elif shutdown:
@@ -64,12 +73,17 @@ class PWMEffect():
             ec = int(self.effectcounter)
             el = int(self.effectlen)
             effectmode = int(self.effectmode)
-            effect = ptr8(self.effect)
+            kind = int(self.effectkind)
             done = int(0)
             
             if ec <= el-1: 
-                # Scale to 16 bit
-                self.pwm.duty_u16(effect[ec]*256)
+                if kind == EFFECT_SAMPLES:
+                    # Scale to 16 bit
+                    self.pwm.duty_u16(int(ptr8(self.effect)[ec]) << 8)
+                elif kind == EFFECT_TABLE:
+                    self.pwm.duty_u16(int(ptr16(self.effect)[ec]))
+                else:
+                    self.pwm.duty_u16(int(eval_keyframes(self.effect, ec, curve_tables)))
             
             if effectmode == PWM_SINGLESHOT:
                 if ec > el-1:
@@ -123,6 +137,406 @@ class PWMEffect():
                 print("done")
                 self.timer.deinit()
 
+# Keyframe effects
+#
+# Instead of a table with a sample per tick, an effect can be defined by
+# keyframes (tick, duty 0-65535) and a curve from each keyframe to the next.
+# The duty cycle is interpolated in fixed point on every tick, so long fades
+# don't need RAM and use the full 16-bit resolution. The curves are stored as
+# tables with CURVE_POINTS entries (0-65535) in curve_tables and interpolated
+# linearly.
+CURVE_LINEAR = const(0)
+CURVE_EXP = const(1)            # 2^(8x), slow start, fast end
+CURVE_GAMMA = const(2)          # x^2.2, linear for the eye
+CURVE_SINE = const(3)           # ease in/out
+CURVE_NUM = const(4)
+CURVE_POINTS = const(257)
+CURVE_SHIFT = const(7)          # 15-bit phase, 256 segments
+
+KF_TICK = const(0)
+KF_DUTY = const(1)
+KF_CURVE = const(2)
+KF_FIELDS = const(3)
+
+def _make_curves():
+    tables = array('H', [0]*(CURVE_NUM*CURVE_POINTS))
+    for i in range(CURVE_POINTS):
+        x = i / (CURVE_POINTS-1)
+        values = (x,
+                  (math.pow(2, 8*x) - 1) / 255,
+                  math.pow(x, 2.2),
+                  (1 - math.cos(math.pi * x)) / 2)
+        for c in range(CURVE_NUM):
+            tables[c*CURVE_POINTS+i] = int(values[c] * 65535 + 0.5)
+    return tables
+
+curve_tables = _make_curves()
+
+@micropython.viper
+def eval_keyframes(frames: ptr16, pos: int, curves: ptr16) -> int:
+    # Duty cycle (0-65535) of a keyframe effect (see Keyframes) at pos
+    last = 1 + (int(frames[0])-1)*KF_FIELDS
+    i = 1
+    while i < last and int(frames[i+KF_FIELDS+KF_TICK]) <= pos:
+        i += KF_FIELDS
+    if i >= last:
+        return int(frames[last+KF_DUTY])
+    
+    t0 = int(frames[i+KF_TICK])
+    d0 = int(frames[i+KF_DUTY])
+    if pos <= t0:
+        return d0
+    t1 = int(frames[i+KF_FIELDS+KF_TICK])
+    d1 = int(frames[i+KF_FIELDS+KF_DUTY])
+    
+    # 15-bit phase, so the products fit into 32 bits
+    x = ((pos - t0) << 15) // (t1 - t0)
+    c = int(frames[i+KF_CURVE])*CURVE_POINTS + (x >> CURVE_SHIFT)
+    s0 = int(curves[c])
+    shape = s0 + (((int(curves[c+1]) - s0) * (x & 0x7f)) >> CURVE_SHIFT)
+    return d0 + (((d1 - d0) * (shape >> 1)) >> 15)
+
+
+class Keyframes():
+    # An effect defined by keyframes. frames is a list of (tick, duty) or
+    # (tick, duty, curve) with increasing ticks, duty is 0-65535 and curve the
+    # curve to the next keyframe (default: curve).
+    
+    def __init__(self, frames, curve=CURVE_LINEAR):
+        if not frames:
+            raise ValueError("no keyframes")
+        data = array('H', [0]*(1+len(frames)*KF_FIELDS))
+        data[0] = len(frames)
+        last = -1
+        for i in range(len(frames)):
+            f = frames[i]
+            if f[0] <= last or f[0] > 65535:
+                raise ValueError("keyframe ticks must increase")
+            last = f[0]
+            j = 1 + i*KF_FIELDS
+            data[j+KF_TICK] = f[0]
+            data[j+KF_DUTY] = f[1]
+            data[j+KF_CURVE] = f[2] if len(f) > 2 else curve
+        self.data = data
+        self.length = last+1
+        
+    def value(self, pos):
+        return eval_keyframes(self.data, pos, curve_tables)
+        
+    def render(self):
+        # The effect as a table with one 16-bit duty cycle per tick
+        table = array('H', [0]*self.length)
+        for i in range(self.length):
+            table[i] = eval_keyframes(self.data, i, curve_tables)
+        return table
+
+def fade(start, end, ticks, curve=CURVE_LINEAR):
+    # An effect that fades from duty start to end in ticks
+    return Keyframes(((0, start), (ticks-1, end)), curve)
+
+def from_samples(data, datalen=None):
+    # Converts an 8-bit sample table to a 16-bit table, scaled like the
+    # samples are played (255 -> 65280)
+    if datalen is None:
+        datalen = len(data)
+    table = array('H', [0]*datalen)
+    for i in range(datalen):
+        table[i] = data[i] << 8
+    return table
+
+def effect_data(data, datalen=None):
+    # (EFFECT_*, data, datalen) of an effect for the players
+    if isinstance(data, Keyframes):
+        if datalen is None:
+            datalen = data.length
+        return EFFECT_KEYFRAMES, data.data, datalen
+    if datalen is None:
+        datalen = len(data)
+    if isinstance(data, array):
+        return EFFECT_TABLE, data, datalen
+    return EFFECT_SAMPLES, data, datalen
+
+
+# Channel table of the EffectScheduler, CH_FIELDS words per channel
+CH_MODE = const(0)
+CH_COUNTER = const(1)
+CH_LEN = const(2)
+CH_DIR = const(3)          # PWM_BACKANDFORTH: 0 forward, 1 backward
+CH_DIVIDER = const(4)      # advance every CH_DIVIDER ticks
+CH_DIVCOUNT = const(5)
+CH_DUTY = const(6)         # duty cycle written to the output
+CH_PENDING = const(7)      # CH_DUTY needs to be written
+CH_KIND = const(8)         # EFFECT_*
+CH_FIELDS = const(9)
+
+# Effect cache: keyframe effects that are played at least CACHE_PLAYS times
+# and have at most CACHE_MAX_TICKS ticks are rendered to a table. The play
+# counts of up to CACHE_COUNTS effects are kept, when a new effect doesn't fit,
+# all counts are halved and the effects without plays are forgotten.
+CACHE_ENTRIES = const(4)
+CACHE_PLAYS = const(3)
+CACHE_MAX_TICKS = const(512)
+CACHE_COUNTS = const(32)
+
+@micropython.viper
+def update_channels(table: ptr32, effects, pwms, n: int) -> int:
+    # Advances all channels that are due, then writes the duty cycles that
+    # changed in a second pass. Returns the number of outputs written.
+    pending = int(0)
+    curves = ptr16(curve_tables)
+    for ch in range(n):
+        base = ch*CH_FIELDS
+        mode = table[base+CH_MODE]
+        if mode == PWM_OFF:
+            continue
+        divcount = table[base+CH_DIVCOUNT] - 1
+        if divcount > 0:
+            table[base+CH_DIVCOUNT] = divcount
+            continue
+        table[base+CH_DIVCOUNT] = table[base+CH_DIVIDER]
+        
+        ec = table[base+CH_COUNTER]
+        el = table[base+CH_LEN]
+        kind = table[base+CH_KIND]
+        duty = int(-1)
+        done = int(0)
+        
+        if ec <= el-1:
+            if kind == EFFECT_SAMPLES:
+                # Scale to 16 bit
+                duty = int(ptr8(effects[ch])[ec]) << 8
+            elif kind == EFFECT_TABLE:
+                duty = int(ptr16(effects[ch])[ec])
+            else:
+                duty = int(eval_keyframes(effects[ch], ec, curves))
+        
+        if mode == PWM_SINGLESHOT:
+            if ec > el-1:
+                duty = 0
+                done = 1
+            else:
+                ec += 1
+                
+        elif mode == PWM_RAMP:
+            if ec > el-1:
+                # just stick with the last sample
+                done = 1
+            else:
+                ec += 1
+                
+        elif mode == PWM_RAMPDOWN:
+            if ec == 0:
+                done = 1
+            else:
+                ec -= 1
+                
+        elif mode == PWM_CYCLIC:
+            if ec >= el-1:
+                ec = 0
+            else:
+                ec += 1
+                
+        elif mode == PWM_BACKANDFORTH:
+            if table[base+CH_DIR]:
+                if ec <= 0:
+                    table[base+CH_DIR] = 0
+                    ec = 1
+                else:
+                    ec -= 1
+            else:
+                if ec >= el-1:
+                    table[base+CH_DIR] = 1
+                    ec -= 1
+                else:
+                    ec += 1
+                    
+        table[base+CH_COUNTER] = ec
+        if done:
+            table[base+CH_MODE] = PWM_OFF
+        if duty >= 0 and duty != table[base+CH_DUTY]:
+            table[base+CH_DUTY] = duty
+            table[base+CH_PENDING] = 1
+            pending += 1
+    
+    if pending:
+        for ch in range(n):
+            base = ch*CH_FIELDS
+            if table[base+CH_PENDING]:
+                table[base+CH_PENDING] = 0
+                pwms[ch].duty_u16(table[base+CH_DUTY])
+    return pending
+
+
+class EffectCache():
+    # Pre-rendered tables of the keyframe effects that are played most
+    
+    def __init__(self, entries=CACHE_ENTRIES, plays=CACHE_PLAYS,
+                 max_ticks=CACHE_MAX_TICKS, max_counts=CACHE_COUNTS):
+        if max_counts <= entries:
+            raise ValueError("max_counts must be larger than entries")
+        self.entries = entries
+        self.plays = plays
+        self.max_ticks = max_ticks
+        self.max_counts = max_counts
+        self.counts = {}
+        self.tables = {}
+        self.hits = 0
+        
+    def lookup(self, effect):
+        # Returns the rendered table of a Keyframes effect or None
+        table = self.tables.get(effect)
+        if effect not in self.counts and len(self.counts) >= self.max_counts:
+            self.age()
+        count = self.counts.get(effect, 0) + 1
+        self.counts[effect] = count
+        if table is not None:
+            self.hits += 1
+            return table
+        if count < self.plays or effect.length > self.max_ticks:
+            return None
+        
+        if len(self.tables) >= self.entries:
+            # Replace the effect that was played least
+            coldest = None
+            for e in self.tables:
+                if coldest is None or self.counts[e] < self.counts[coldest]:
+                    coldest = e
+            if self.counts[coldest] >= count:
+                return None
+            del self.tables[coldest]
+        table = effect.render()
+        self.tables[effect] = table
+        return table
+        
+    def age(self):
+        # Halves the play counts, so recent plays count more, and forgets the
+        # effects that have no plays left and no table. If all of them still
+        # have plays, the one played least without a table is forgotten.
+        counts = self.counts
+        for e in list(counts):
+            c = counts[e] >> 1
+            if c or e in self.tables:
+                counts[e] = c
+            else:
+                del counts[e]
+        if len(counts) >= self.max_counts:
+            coldest = None
+            for e in counts:
+                if e not in self.tables and \
+                   (coldest is None or counts[e] < counts[coldest]):
+                    coldest = e
+            del counts[coldest]
+        
+    def clear(self):
+        self.counts = {}
+        self.tables = {}
+
+
+class EffectScheduler():
+    # Plays effects on many PWM outputs from a single periodic timer. The
+    # channels are preallocated, each tick advances all channels in one pass
+    # and writes only the duty cycles that changed. A channel with divider n
+    # advances every n ticks.
+    #
+    # Effects can be bytearrays (8-bit samples), array('H') tables (16-bit
+    # duty cycles) or Keyframes. Keyframe effects that are played often are
+    # rendered to tables by the cache.
+    
+    def __init__(self, channels=8, tick_ms=10):
+        self.maxchannels = channels
+        self.tick_ms = tick_ms
+        self.table = array('i', [0]*(channels*CH_FIELDS))
+        self.effects = [bytearray(1)]*channels
+        self.pwms = [None]*channels
+        self.channels = 0
+        self.timer = None
+        self.callback = self._tick
+        self.cache = EffectCache()
+        
+    def add_channel(self, pin, pwm_freq=1000, divider=1):
+        # Returns the channel number
+        if self.channels >= self.maxchannels:
+            raise ValueError("no free channel")
+        ch = self.channels
+        pwm = PWM(pin)
+        pwm.freq(pwm_freq)
+        pwm.duty_u16(0)
+        self.pwms[ch] = pwm
+        self.set_divider(ch, divider)
+        self.channels += 1
+        return ch
+        
+    def set_divider(self, ch, divider):
+        if divider < 1:
+            raise ValueError("invalid divider")
+        base = ch*CH_FIELDS
+        self.table[base+CH_DIVIDER] = divider
+        self.table[base+CH_DIVCOUNT] = 1
+        
+    def play_effect(self, ch, data, datalen=None, mode=PWM_SINGLESHOT):
+        # datalen defaults to the length of the effect
+        if isinstance(data, Keyframes):
+            rendered = self.cache.lookup(data)
+            if rendered is not None:
+                data = rendered
+        kind, data, datalen = effect_data(data, datalen)
+        
+        base = ch*CH_FIELDS
+        table = self.table
+        # The channel is off while it is set up, so a tick in between
+        # doesn't see half of it
+        table[base+CH_MODE] = PWM_OFF
+        self.effects[ch] = data
+        table[base+CH_KIND] = kind
+        table[base+CH_LEN] = datalen
+        table[base+CH_DIR] = 0
+        table[base+CH_DIVCOUNT] = 1
+        if mode == PWM_RAMPDOWN:
+            table[base+CH_COUNTER] = datalen-1
+        else:
+            table[base+CH_COUNTER] = 0
+        table[base+CH_MODE] = mode
+        
+    def stop_effect(self, ch, shutdown=True, rampdown=False):
+        base = ch*CH_FIELDS
+        table = self.table
+        if rampdown:
+            if table[base+CH_COUNTER] >= table[base+CH_LEN]:
+                table[base+CH_COUNTER] = table[base+CH_LEN]-1
+            table[base+CH_MODE] = PWM_RAMPDOWN
+            return
+        table[base+CH_MODE] = PWM_OFF
+        if shutdown:
+            table[base+CH_DUTY] = 0
+            table[base+CH_PENDING] = 0
+            self.pwms[ch].duty_u16(0)
+            
+    def is_playing(self, ch):
+        return self.table[ch*CH_FIELDS+CH_MODE] != PWM_OFF
+        
+    def tick(self):
+        # Runs one tick, returns the number of outputs written
+        return update_channels(self.table, self.effects, self.pwms,
+                               self.channels)
+        
+    def _tick(self, timer):
+        update_channels(self.table, self.effects, self.pwms, self.channels)
+        
+    def start(self):
+        if self.timer is None:
+            self.timer = Timer(period=self.tick_ms,
+                               mode=Timer.PERIODIC,
+                               callback=self.callback)
+            
+    def stop(self, shutdown=True):
+        if self.timer is not None:
+            self.timer.deinit()
+            self.timer = None
+        if shutdown:
+            for ch in range(self.channels):
+                self.stop_effect(ch)
+
+
 if __name__ == '__main__':
     # Use onboard LED
     led=Pin(25, Pin.OUT)
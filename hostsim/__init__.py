@@ -0,0 +1,60 @@
+# Host-side tools for the WPC power monitor
+#
+# The code in powermon_viper.py and effects.py is written for MicroPython on the
+# Raspberry Pi Pico. The modules in this package allow running the same code on a
+# PC (CPython or the unix port of MicroPython) to replay logic analyzer captures,
+# simulate bus traffic and benchmark the poller.
+#
+# Use it like this:
+#
+#   import hostsim
+#   hostsim.install()
+#   import powermon_viper
+#
+# install() makes the MicroPython-only modules (micropython, rp2, machine, utime)
+# importable. Modules that already exist (e.g. on unix MicroPython) are not
+# replaced.
+
+import sys
+
+if "/" in __file__:
+    PACKAGE_DIR = __file__.rsplit("/", 1)[0]
+else:
+    PACKAGE_DIR = "."
+SHIM_DIR = PACKAGE_DIR + "/mp"
+if PACKAGE_DIR == ".":
+    ROOT_DIR = ".."
+elif "/" in PACKAGE_DIR:
+    ROOT_DIR = PACKAGE_DIR.rsplit("/", 1)[0]
+else:
+    ROOT_DIR = "."
+
+installed = False
+
+
+def install():
+    global installed
+
+    if installed:
+        return
+
+    if SHIM_DIR not in sys.path:
+        # Append, so native modules of unix MicroPython still take precedence
+        sys.path.append(SHIM_DIR)
+
+    if sys.implementation.name != "micropython":
+        # const(), micropython.viper and the viper pointer types are handled by
+        # the MicroPython compiler, on CPython they have to be builtins
+        import builtins
+        import micropython
+        for name in ("const", "ptr8", "ptr16", "ptr32"):
+            if not hasattr(builtins, name):
+                setattr(builtins, name, getattr(micropython, name))
+        if not hasattr(builtins, "micropython"):
+            builtins.micropython = micropython
+
+    # Make the repository root importable (powermon_viper, effects)
+    if ROOT_DIR not in sys.path:
+        sys.path.append(ROOT_DIR)
+
+    installed = True
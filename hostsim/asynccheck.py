@@ -0,0 +1,142 @@
+# Check of the asyncio API of the PowerMonitor
+#
+# Replays a capture through updateloop() in a second thread while coroutines
+# wait with lamps_changed(), solenoids_changed(), gi_changed(), frame(),
+# ready() and changes() in the main thread, like the poller and asyncio on the two cores
+# of the Pico. Checks that changes() delivered every change of the replay in
+# order and that every waiter saw the final state, and prints how many wakeups
+# the signals of the poller were coalesced into:
+#
+#   python3 -m hostsim.asynccheck logicanalyzer/wpcpower.LPF
+#   python3 -m hostsim.asynccheck --waiters 10 logicanalyzer/*.LPF
+
+import sys
+
+import hostsim
+hostsim.install()
+
+import _thread
+import uasyncio as asyncio
+
+from hostsim import lpf, replay
+
+STATE_OFFSETS = {"lamp": 0, "solenoid": 8, "gi": 12}
+
+
+def timeline_changes(timeline):
+    # (index, old, new) of the replay timeline, in the order of the journal
+    return [(STATE_OFFSETS[kind] + index, old, new)
+            for t, kind, index, old, new in timeline]
+
+
+async def check_async(path, waiters=3):
+    pv = replay.load_decoder()
+    pm = pv.PowerMonitor()
+    capture = lpf.read_lpf(path)
+    result = {}
+    done = [False]
+
+    def poller():
+        result["replay"] = replay.replay(capture, decoder=pv)
+        done[0] = True
+
+    counts = {"lamps": [0]*waiters, "solenoids": 0, "gi": 0, "frames": 0}
+    seen = {}
+    events = []
+
+    async def lamp_waiter(i):
+        while True:
+            seen["lamps", i] = await pm.lamps_changed()
+            counts["lamps"][i] += 1
+
+    async def solenoid_waiter():
+        while True:
+            seen["solenoids"] = await pm.solenoids_changed()
+            counts["solenoids"] += 1
+
+    async def gi_waiter():
+        while True:
+            seen["gi"] = await pm.gi_changed()
+            counts["gi"] += 1
+
+    async def frame_waiter():
+        while True:
+            await pm.frame()
+            counts["frames"] += 1
+
+    async def ready_waiter():
+        await pm.ready()
+        seen["ready"] = True
+
+    async def change_reader():
+        async for timestamp, index, old, new in pm.changes():
+            events.append((index, old, new))
+
+    tasks = [asyncio.create_task(lamp_waiter(i)) for i in range(waiters)]
+    tasks.append(asyncio.create_task(solenoid_waiter()))
+    tasks.append(asyncio.create_task(gi_waiter()))
+    tasks.append(asyncio.create_task(frame_waiter()))
+    tasks.append(asyncio.create_task(change_reader()))
+    tasks.append(asyncio.create_task(ready_waiter()))
+    # Let the tasks start waiting before the poller runs
+    await asyncio.sleep_ms(10)
+
+    _thread.start_new_thread(poller, ())
+    while not done[0]:
+        await asyncio.sleep_ms(1)
+    await asyncio.sleep_ms(50)
+    for task in tasks:
+        task.cancel()
+    pm.async_notifier().stop()
+
+    res = result["replay"]
+    stats = pm.get_stats()
+    expected = timeline_changes(res.timeline)
+    errors = []
+    if stats["event_drops"] == 0 and events != expected:
+        errors.append("changes() differs from the replay")
+    for i in range(waiters):
+        if counts["lamps"][i] and seen["lamps", i] != pm.get_lamps():
+            errors.append("lamp waiter {} missed the last change".format(i))
+    if counts["solenoids"] and seen["solenoids"] != pm.get_solenoids():
+        errors.append("solenoid waiter missed the last change")
+    if counts["gi"] and seen["gi"] != pm.get_gi():
+        errors.append("GI waiter missed the last change")
+    if stats["ready"] and not seen.get("ready"):
+        errors.append("ready() didn't return")
+    return errors, {
+        "changes": len(expected),
+        "events": len(events),
+        "event_drops": stats["event_drops"],
+        "async_signals": stats["async_signals"],
+        "async_wakeups": stats["async_wakeups"],
+        "lamp_wakeups": counts["lamps"],
+        "solenoid_wakeups": counts["solenoids"],
+        "gi_wakeups": counts["gi"],
+        "frames": counts["frames"],
+        "time_to_ready_ms": stats["time_to_ready_ms"],
+        }
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="asyncio API check")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--waiters", type=int, default=3,
+                        help="coroutines waiting for lamp changes")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for path in args.files:
+        errors, stats = asyncio.run(check_async(path, args.waiters))
+        print("{}: {}".format(path, stats))
+        for error in errors:
+            print("  " + error)
+        failed = failed or errors
+    print("FAILED" if failed else "OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
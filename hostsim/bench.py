@@ -0,0 +1,237 @@
+# Throughput benchmark for the poller
+#
+# Runs updateloop() of one or more builds (module names) against simulated
+# traffic and reports for each build:
+#
+# - flood:     words/s the poller processes if the FIFO is always full
+# - sweep:     drop rate and worst-case FIFO depth for different traffic rates
+#              and burst shapes
+# - sustained: the highest rate (words/s) without dropped words
+#
+#   python3 -m hostsim.bench [--repeats N] [build ...]
+#   micropython -m hostsim.bench [build ...]
+#
+# A build is a module name, optionally followed by module globals to set, e.g.
+# "powermon_viper:ingest_burst=1,decode_batch=1". On CPython, const() values
+# can be changed the same way, e.g. "powermon_viper:INSTRUMENT=0".
+#
+# With --per-word, only the cost per word (ns, and cycles with --mhz, the clock
+# of the host) of a full FIFO is measured, by default for the variants
+# generated by hostsim/build.py:
+#
+#   python3 -m hostsim.bench --per-word
+#   python3 -m hostsim.bench --per-word --mhz 3000 powermon_release powermon_viper
+#
+# Every measurement is repeated (--repeats, default REPEATS) and reported as the
+# median with the range (min-max) of the runs. Differences between builds that
+# are within the range are noise of the host, not a difference of the builds.
+# The numbers depend on the host, compare builds on the same machine only.
+# Use --scale to slow down the simulated bus relative to the host. With
+# --paired, the traffic is passed through read_data_paired first, rates are
+# still bus words/s.
+
+import sys
+
+import hostsim
+hostsim.install()
+
+from hostsim import sim
+
+RATES = (20000, 50000, 100000, 200000, 400000)
+SHAPES = (sim.SHAPE_UNIFORM, sim.SHAPE_BURST, sim.SHAPE_POISSON)
+
+# Simulated bus time per sweep run
+RUN_US = 200000
+FLOOD_WORDS = 50000
+REPEATS = 5
+VARIANTS = ["powermon_release", "powermon_instrumented", "powermon_verbose"]
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        return values[n//2]
+    return (values[n//2-1] + values[n//2]) / 2
+
+
+def summary(values):
+    # (median, min, max)
+    return median(values), min(values), max(values)
+
+
+def words_for_rate(rate, run_us=RUN_US):
+    return max(1000, int(rate * run_us / 1000000))
+
+
+def traffic_for(build, rate, shape, paired=False):
+    traffic = sim.make_traffic(rate, words_for_rate(rate), shape)
+    if paired:
+        name, config = sim.parse_build(build)
+        program = sim.load_build(name, config).read_data_paired
+        traffic = sim.pair_traffic(traffic, program)
+    return traffic
+
+
+def sustained_rate(build, shape, scale=1.0, low=1000, high=2000000, steps=10,
+                   paired=False):
+    # Binary search for the highest rate without dropped words
+    name, config = sim.parse_build(build)
+    best = 0
+    for i in range(steps):
+        rate = (low + high) // 2
+        traffic = traffic_for(build, rate, shape, paired)
+        res = sim.run_poller(name, traffic, scale, config)
+        if res["dropped"]:
+            high = rate
+        else:
+            best = rate
+            low = rate
+    return best
+
+
+def bench_build(build, scale=1.0, rates=RATES, shapes=SHAPES, paired=False,
+                repeats=REPEATS):
+    # Flood rate, sweep and sustained rates as summary() of repeats runs
+    name, config = sim.parse_build(build)
+    results = {"build": build, "sweep": [], "paired": paired,
+               "repeats": repeats}
+
+    results["flood"] = summary([sim.run_flood(name, FLOOD_WORDS, scale, config)
+                                for i in range(repeats)])
+
+    for shape in shapes:
+        for rate in rates:
+            traffic = traffic_for(build, rate, shape, paired)
+            runs = []
+            for i in range(repeats):
+                res = sim.run_poller(name, traffic, scale, config)
+                del res["module"]
+                runs.append(res)
+            results["sweep"].append({
+                "shape": shape,
+                "rate": rate,
+                "words": len(traffic),
+                "drop_rate": summary([r["drop_rate"] for r in runs]),
+                "max_depth": max([r["max_depth"] for r in runs]),
+                "overflows": sum([1 for r in runs if r["overflow"]]),
+                "ring_overruns": summary([r["ring_overruns"] for r in runs]),
+                })
+
+    results["sustained"] = {}
+    for shape in shapes:
+        results["sustained"][shape] = summary(
+            [sustained_rate(build, shape, scale, paired=paired)
+             for i in range(repeats)])
+
+    return results
+
+
+def per_word_cost(build, scale=1.0, words=FLOOD_WORDS, repeats=REPEATS):
+    # ns per word with a full FIFO as summary() of repeats runs. Output of
+    # verbose builds is discarded on CPython.
+    name, config = sim.parse_build(build)
+    quiet = None
+    try:
+        import contextlib
+        import os
+        quiet = open(os.devnull, "w")
+    except ImportError:
+        pass
+    costs = []
+    for i in range(repeats):
+        if quiet:
+            with contextlib.redirect_stdout(quiet):
+                rate = sim.run_flood(name, words, scale, config)
+        else:
+            rate = sim.run_flood(name, words, scale, config)
+        costs.append(1e9 / rate if rate else 0)
+    if quiet:
+        quiet.close()
+    return summary(costs)
+
+
+def print_per_word(builds, scale=1.0, mhz=0, repeats=REPEATS):
+    costs = [(build, per_word_cost(build, scale, repeats=repeats))
+             for build in builds]
+    base, base_min, base_max = costs[0][1]
+    print("median of {} runs, range min-max".format(repeats))
+    print("{:<40} {:>10} {:>13} {:>9}{}".format(
+        "build", "ns/word", "range", "relative",
+        " {:>12}".format("cycles/word") if mhz else ""))
+    for build, (ns, low, high) in costs:
+        line = "{:<40} {:>10.0f} {:>13} {:>9.2f}".format(
+            build, ns, "{:.0f}-{:.0f}".format(low, high),
+            ns / base if base else 0)
+        if mhz:
+            line += " {:>12.0f}".format(ns * mhz / 1000)
+        if build != costs[0][0] and low <= base_max and high >= base_min:
+            # The ranges overlap, the difference can be noise
+            line += "  (within range of {})".format(costs[0][0])
+        print(line)
+
+
+def print_results(results):
+    # Medians with the range (min-max) of the runs, depth is the maximum of
+    # all runs, overflow the number of runs with an overflow
+    print("Build: {}{}, median of {} runs".format(
+        results["build"], " (paired)" if results["paired"] else "",
+        results["repeats"]))
+    print("  flood throughput: {:.0f} words/s ({:.0f}-{:.0f})".format(
+        *results["flood"]))
+    print("  {:>8} {:>8} {:>8} {:>9} {:>15} {:>6} {:>8} {:>8}".format(
+        "shape", "rate", "words", "drop rate", "range", "depth", "overflow",
+        "overruns"))
+    for res in results["sweep"]:
+        drops = res["drop_rate"]
+        print("  {:>8} {:>8} {:>8} {:>9.4f} {:>15} {:>6} {:>8} {:>8}".format(
+            res["shape"], res["rate"], res["words"], drops[0],
+            "{:.4f}-{:.4f}".format(drops[1], drops[2]), res["max_depth"],
+            "{}/{}".format(res["overflows"], results["repeats"]),
+            res["ring_overruns"][0]))
+    for shape in results["sustained"]:
+        print("  sustained {}: {:.0f} words/s ({}-{})".format(
+            shape, *results["sustained"][shape]))
+
+
+def main(argv):
+    builds = []
+    scale = 1.0
+    paired = False
+    per_word = False
+    mhz = 0
+    repeats = REPEATS
+    i = 0
+    while i < len(argv):
+        if argv[i] == "--scale":
+            i += 1
+            scale = float(argv[i])
+        elif argv[i] == "--paired":
+            paired = True
+        elif argv[i] == "--per-word":
+            per_word = True
+        elif argv[i] == "--repeats":
+            i += 1
+            repeats = int(argv[i])
+        elif argv[i] == "--mhz":
+            i += 1
+            mhz = float(argv[i])
+        else:
+            builds.append(argv[i])
+        i += 1
+
+    if per_word:
+        print_per_word(builds or VARIANTS, scale, mhz, repeats)
+        return
+
+    if not builds:
+        builds = ["powermon_viper:ingest_burst=1,decode_batch=1",
+                  "powermon_viper"]
+
+    for build in builds:
+        print_results(bench_build(build, scale, paired=paired,
+                                  repeats=repeats))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
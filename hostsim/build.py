@@ -0,0 +1,187 @@
+# Build step for the poller variants
+#
+# powermon_viper.py is the only source of the poller. Its debug and
+# instrumentation code is in blocks like "if DEBUG:", "if INSTRUMENT:" or
+# "if DEBUG >= DEBUG_VERBOSE:". This generates a module for each variant in
+# BUILDS with DEBUG and INSTRUMENT set and these blocks resolved: blocks whose
+# condition is false are removed, the others (or the else branch) are kept
+# without the if. The variants don't spend any time or memory on the code they
+# don't use, on CPython as well as on MicroPython:
+#
+#   python3 -m hostsim.build            # writes powermon_release.py etc.
+#   python3 -m hostsim.build --check    # fails if a variant is outdated or
+#                                       # doesn't compile for the Pico
+#
+# Select a variant with powermon.PowerMonitor(build="release") and copy the
+# module of the variant to the Pico. Compare the cost per word with
+#
+#   python3 -m hostsim.bench --per-word powermon_release powermon_instrumented powermon_verbose
+
+import re
+import sys
+
+import hostsim
+
+SOURCE = "powermon_viper.py"
+
+# variant: module, constants
+BUILDS = {
+    "release": ("powermon_release", {"DEBUG": 0, "INSTRUMENT": 0}),
+    "instrumented": ("powermon_instrumented", {"DEBUG": 1, "INSTRUMENT": 1}),
+    "verbose": ("powermon_verbose", {"DEBUG": 2, "INSTRUMENT": 1}),
+    }
+
+# Names that can appear in the conditions of the blocks that are resolved
+LEVELS = {"DEBUG_NONE": 0, "DEBUG_SOME": 1, "DEBUG_VERBOSE": 2}
+
+HEADER = ("# Generated by hostsim/build.py from {} ({} build), don't edit\n"
+          "# {}\n\n")
+
+IF_RE = re.compile(r"^(\s*)if ([A-Z_ >=<!0-9]+):\s*(#.*)?$")
+ELSE_RE = re.compile(r"^(\s*)else:\s*(#.*)?$")
+CONST_RE = re.compile(r"^([A-Z_]+)\s*=\s*const\((\d+)\)")
+TOKEN_RE = re.compile(r"[A-Z_]+")
+
+
+def indent_of(line):
+    return len(line) - len(line.lstrip())
+
+
+def significant(line):
+    s = line.strip()
+    return s and not s.startswith("#")
+
+
+def evaluate(condition, constants):
+    # Returns the value of a condition on the constants or None if it uses
+    # other names
+    names = dict(LEVELS)
+    names.update(constants)
+    for name in TOKEN_RE.findall(condition):
+        if name not in names:
+            return None
+    return bool(eval(condition, {"__builtins__": {}}, names))
+
+
+def block_end(lines, start, indent):
+    # First line after the block that starts at start (the line after the
+    # if/else), trailing blank lines and comments stay outside
+    end = start
+    i = start
+    while i < len(lines):
+        if significant(lines[i]):
+            if indent_of(lines[i]) <= indent:
+                break
+            end = i + 1
+        i += 1
+    return end
+
+
+def dedent(lines, by):
+    out = []
+    for line in lines:
+        if line.strip():
+            out.append(line[by:] if indent_of(line) >= by else line.lstrip())
+        else:
+            out.append(line)
+    return out
+
+
+def resolve(lines, constants):
+    # Resolves the blocks of the constants, returns the new lines
+    out = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        m = IF_RE.match(line)
+        value = None if not m else evaluate(m.group(2), constants)
+        if value is None:
+            m = CONST_RE.match(line)
+            if m and m.group(1) in constants:
+                line = "{}=const({})\n".format(m.group(1), constants[m.group(1)])
+            out.append(line)
+            i += 1
+            continue
+
+        indent = indent_of(line)
+        body_start = i + 1
+        body_end = block_end(lines, body_start, indent)
+        body = lines[body_start:body_end]
+        else_body = []
+        end = body_end
+        if end < len(lines) and ELSE_RE.match(lines[end]) and \
+                indent_of(lines[end]) == indent:
+            else_end = block_end(lines, end + 1, indent)
+            else_body = lines[end+1:else_end]
+            end = else_end
+
+        kept = body if value else else_body
+        if kept:
+            by = indent_of(next(l for l in kept if significant(l))) - indent
+            out.extend(resolve(dedent(kept, by), constants))
+        else:
+            # Keep the enclosing block valid if this was its only statement
+            prev = next((l for l in reversed(out) if significant(l)), "")
+            following = next((l for l in lines[end:] if significant(l)), "")
+            if (prev.rstrip().endswith(":") and indent_of(prev) < indent and
+                    indent_of(following) < indent):
+                out.append(" " * indent + "pass\n")
+        i = end
+    return out
+
+
+def generate(root=None):
+    # Returns {path: source} of all variants
+    if root is None:
+        root = hostsim.ROOT_DIR
+    with open(root + "/" + SOURCE) as f:
+        lines = f.readlines()
+    variants = {}
+    for build in BUILDS:
+        module, constants = BUILDS[build]
+        settings = ", ".join("{}={}".format(k, constants[k])
+                             for k in sorted(constants))
+        source = HEADER.format(SOURCE, build, settings)
+        source += "".join(resolve(lines, constants))
+        variants[root + "/" + module + ".py"] = source
+    return variants
+
+
+def main(argv):
+    check = "--check" in argv
+    failed = 0
+    for path, source in generate().items():
+        compile(source, path, "exec")
+        if check:
+            try:
+                with open(path) as f:
+                    current = f.read()
+            except OSError:
+                current = None
+            if current != source:
+                print("{}: outdated".format(path))
+                failed += 1
+            continue
+        with open(path, "w") as f:
+            f.write(source)
+        print("{}: {} lines".format(path, source.count("\n")))
+    if check:
+        # Compile the variants and the other modules for the RP2040 (see
+        # hostsim.mpycheck)
+        from hostsim import mpycheck
+        paths = list(generate()) + [hostsim.ROOT_DIR + "/" + m
+                                    for m in mpycheck.MODULES]
+        errors = mpycheck.check(paths)
+        if errors is None:
+            print("mpy-cross not found, compile check skipped")
+        else:
+            for path in errors:
+                print("{}: doesn't compile for {}".format(path, mpycheck.ARCH))
+                for line in errors[path].splitlines():
+                    print("  " + line)
+                failed += 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
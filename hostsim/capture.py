@@ -0,0 +1,305 @@
+# Compact binary capture files (.wpcc)
+#
+# LPF files store every run of GPIO levels as a text line with 35 columns. For
+# replaying, only the words the PIO programs see are needed: the bus words
+# read_data pushes and the zero crossings. A .wpcc file stores these as fixed
+# size records, so it can be memory mapped and read from any point in time:
+#
+#   header       HEADER_FORMAT, little endian
+#                  magic "WPCC", version, flags (0), unit_ns (time unit),
+#                  block_records, records, index_offset, end_time (units)
+#   records      records * (delta uint16, word uint16), little endian
+#                  delta: time since the previous record in units
+#                  word:  bits 0-14: bus word (inverted GPIO 0-14, as read_data
+#                         pushes it), ZC_FLAG: zero crossing (word 0x8000)
+#                  TIME_EXT: adds delta << 16 units to the time, for gaps
+#                         longer than 65535 units
+#   index        one entry per block_records records (INDEX_FORMAT):
+#                  time before the first record of the block (units), first
+#                  record of the block
+#
+#   python3 -m hostsim.capture convert logicanalyzer/wpcpower.LPF wpcpower.wpcc
+#   python3 -m hostsim.capture info wpcpower.wpcc
+#   python3 -m hostsim.replay --start 100 --length 50 wpcpower.wpcc
+#
+# CaptureWriter appends records in chunks, so captures that don't fit into
+# memory (e.g. recorded from a running machine) can be written. CaptureFile
+# maps the file and only reads the blocks that are accessed.
+
+import bisect
+import struct
+import sys
+
+import numpy as np
+
+EXTENSION = ".wpcc"
+MAGIC = b"WPCC"
+VERSION = 1
+HEADER_FORMAT = "<4sHHIIQQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+INDEX_FORMAT = "<QQ"
+INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+
+RECORD_DTYPE = np.dtype([("delta", "<u2"), ("word", "<u2")])
+INDEX_DTYPE = np.dtype([("time", "<u8"), ("record", "<u8")])
+
+WORD_MASK = 0x7fff
+ZC_FLAG = 0x8000
+TIME_EXT = 0xffff
+DELTA_MAX = 0xffff
+
+# 1us like ticks_us on the Pico. Bus words are ~2us apart, so a 16-bit delta
+# covers 65ms and TIME_EXT records are only needed for gaps in the traffic
+# (with 10ns, every gap longer than 655us needed one). Replays give the same
+# changes as the LPF, with the times rounded to 1us. Use --unit-ns 10 if the
+# sample delay of the PIO programs needs to be resolved.
+UNIT_NS = 1000
+BLOCK_RECORDS = 4096
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CaptureWriter():
+
+    def __init__(self, path, unit_ns=UNIT_NS, block_records=BLOCK_RECORDS):
+        self.f = open(path, "wb")
+        self.unit_ns = unit_ns
+        self.block_records = block_records
+        self.records = 0
+        self.time = 0
+        self.index = []
+        self.f.write(b"\0" * HEADER_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, times, words):
+        # times: absolute times in units (increasing), words: bus words or
+        # ZC_FLAG for zero crossings
+        times = np.asarray(times, dtype=np.int64)
+        words = np.asarray(words, dtype=np.uint16)
+        if not len(times):
+            return
+        deltas = np.diff(times, prepend=self.time)
+        if deltas.min() < 0:
+            raise CaptureError("times are not increasing")
+
+        # Gaps that don't fit into 16 bits get TIME_EXT records in front
+        long_gaps = np.flatnonzero(deltas > DELTA_MAX)
+        if len(long_gaps):
+            rec_deltas = []
+            rec_words = []
+            start = 0
+            for i in long_gaps:
+                rec_deltas.append(deltas[start:i])
+                rec_words.append(words[start:i])
+                high = int(deltas[i]) >> 16
+                while high:
+                    step = min(high, DELTA_MAX)
+                    rec_deltas.append(np.array([step]))
+                    rec_words.append(np.array([TIME_EXT]))
+                    high -= step
+                rec_deltas.append(np.array([deltas[i] & DELTA_MAX]))
+                rec_words.append(words[i:i+1])
+                start = i + 1
+            rec_deltas.append(deltas[start:])
+            rec_words.append(words[start:])
+            deltas = np.concatenate(rec_deltas)
+            words = np.concatenate(rec_words).astype(np.uint16)
+
+        records = np.empty(len(deltas), dtype=RECORD_DTYPE)
+        records["delta"] = deltas
+        records["word"] = words
+
+        # Index entries for the blocks that start in this chunk
+        first = -self.records % self.block_records
+        if first < len(records):
+            elapsed = np.where(words == TIME_EXT,
+                               deltas.astype(np.int64) << 16, deltas)
+            before = self.time + np.concatenate(([0], np.cumsum(elapsed)[:-1]))
+            for i in range(first, len(records), self.block_records):
+                self.index.append((int(before[i]), self.records + i))
+
+        self.f.write(records.tobytes())
+        self.records += len(records)
+        self.time = int(times[-1])
+
+    def close(self):
+        if self.f is None:
+            return
+        index_offset = HEADER_SIZE + self.records * RECORD_DTYPE.itemsize
+        for entry in self.index:
+            self.f.write(struct.pack(INDEX_FORMAT, *entry))
+        self.f.seek(0)
+        self.f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, 0,
+                                 self.unit_ns, self.block_records,
+                                 self.records, index_offset, self.time))
+        self.f.close()
+        self.f = None
+
+
+class CaptureFile():
+    # Memory mapped .wpcc file. Times are in microseconds.
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE:
+                raise CaptureError("file too short: " + str(path))
+            (magic, version, flags, self.unit_ns, self.block_records,
+             self.records, index_offset, self.end_time) = struct.unpack(
+                HEADER_FORMAT, header)
+            if magic != MAGIC:
+                raise CaptureError("not a capture file: " + str(path))
+            if version != VERSION:
+                raise CaptureError("unsupported version {}".format(version))
+            blocks = -(-self.records // self.block_records)
+            f.seek(index_offset)
+            index = np.frombuffer(f.read(blocks * INDEX_SIZE), dtype=INDEX_DTYPE)
+            if len(index) != blocks:
+                raise CaptureError("index truncated: " + str(path))
+
+        self.name = str(path).rsplit("/", 1)[-1]
+        self.index_times = index["time"].astype(np.int64)
+        self.index_records = index["record"].astype(np.int64)
+        self.us_per_unit = self.unit_ns / 1000.0
+        if self.records:
+            self.data = np.memmap(path, dtype=RECORD_DTYPE, mode="r",
+                                  offset=HEADER_SIZE, shape=(self.records,))
+        else:
+            self.data = np.zeros(0, dtype=RECORD_DTYPE)
+
+    @property
+    def duration_us(self):
+        return self.end_time * self.us_per_unit
+
+    def __len__(self):
+        return self.records
+
+    def __repr__(self):
+        return "<CaptureFile {} {} records, {} blocks, {:.0f}us>".format(
+            self.name, self.records, len(self.index_times), self.duration_us)
+
+    def _block(self, b):
+        # Returns (times, words) of block b without TIME_EXT records, times
+        # in units
+        start = self.index_records[b]
+        end = min(start + self.block_records, self.records)
+        records = self.data[start:end]
+        deltas = records["delta"].astype(np.int64)
+        words = records["word"]
+        ext = words == TIME_EXT
+        times = self.index_times[b] + np.cumsum(np.where(ext, deltas << 16,
+                                                         deltas))
+        keep = ~ext
+        return times[keep], words[keep]
+
+    def iter_blocks(self, start_us=0, end_us=None):
+        # Yields (times, words) for the records in [start_us, end_us), block
+        # by block. times are in microseconds.
+        start = int(start_us / self.us_per_unit)
+        end = None if end_us is None else int(end_us / self.us_per_unit)
+        b = max(0, bisect.bisect_right(self.index_times, start) - 1)
+        for b in range(b, len(self.index_times)):
+            if end is not None and self.index_times[b] >= end:
+                break
+            times, words = self._block(b)
+            lo = np.searchsorted(times, start, side="left")
+            hi = len(times)
+            if end is not None:
+                hi = np.searchsorted(times, end, side="left")
+            if hi > lo:
+                yield times[lo:hi] * self.us_per_unit, words[lo:hi]
+
+    def read(self, start_us=0, end_us=None):
+        # Returns (times, words) for the records in [start_us, end_us)
+        chunks = list(self.iter_blocks(start_us, end_us))
+        if not chunks:
+            return np.zeros(0), np.zeros(0, dtype=np.uint16)
+        return (np.concatenate([c[0] for c in chunks]),
+                np.concatenate([c[1] for c in chunks]))
+
+    def events(self, start_us=0, end_us=None):
+        # Returns (word_times, words, zc_times) like replay.decode_words()
+        times, words = self.read(start_us, end_us)
+        zc = (words & ZC_FLAG) != 0
+        return (times[~zc], (words[~zc] & WORD_MASK).astype(np.uint32),
+                times[zc])
+
+
+def write_events(path, word_times, words, zc_times, unit_ns=UNIT_NS,
+                 block_records=BLOCK_RECORDS):
+    # Writes bus words and zero crossings (times in microseconds)
+    times = np.concatenate((word_times, zc_times))
+    values = np.concatenate((np.asarray(words, dtype=np.uint32) & WORD_MASK,
+                             np.full(len(zc_times), ZC_FLAG, dtype=np.uint32)))
+    order = np.argsort(times, kind="stable")
+    units = np.round(times[order] * 1000.0 / unit_ns).astype(np.int64)
+    with CaptureWriter(path, unit_ns, block_records) as w:
+        w.append(units, values[order])
+
+
+def convert_lpf(lpf_path, path, channel_map=None, sample_delay_us=None,
+                unit_ns=UNIT_NS):
+    # Converts an LPF capture to a .wpcc file, returns the number of records
+    import hostsim
+    hostsim.install()
+    from hostsim import lpf, replay
+
+    if channel_map is None:
+        channel_map = lpf.LPF_CHANNELS
+    if sample_delay_us is None:
+        sample_delay_us = replay.SAMPLE_DELAY_US
+    capture = lpf.read_lpf(lpf_path, channel_map)
+    word_times, words, zc_times = replay.decode_words(capture, sample_delay_us)
+    write_events(path, word_times, words, zc_times, unit_ns)
+    return len(word_times) + len(zc_times)
+
+
+def main(argv):
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(description="WPC capture files")
+    sub = parser.add_subparsers(dest="command", required=True)
+    conv = sub.add_parser("convert", help="convert an LPF capture")
+    conv.add_argument("lpf")
+    conv.add_argument("output")
+    conv.add_argument("--direct", action="store_true",
+                      help="channels D0-D15 are connected to GPIO 0-15")
+    conv.add_argument("--unit-ns", type=int, default=UNIT_NS,
+                      help="time unit (default: %(default)s)")
+    info = sub.add_parser("info", help="show the contents of capture files")
+    info.add_argument("files", nargs="+")
+    args = parser.parse_args(argv)
+
+    if args.command == "convert":
+        channel_map = None
+        if args.direct:
+            from hostsim import lpf
+            channel_map = lpf.DIRECT_CHANNELS
+        records = convert_lpf(args.lpf, args.output, channel_map,
+                              unit_ns=args.unit_ns)
+        print("{}: {} records, {} -> {} bytes".format(
+            args.output, records, os.path.getsize(args.lpf),
+            os.path.getsize(args.output)))
+        return 0
+
+    for path in args.files:
+        cap = CaptureFile(path)
+        word_times, words, zc_times = cap.events()
+        print("{}: {:.0f}us, {} records in {} blocks, {} bus words, "
+              "{} zero crossings, {}ns per unit".format(
+                  cap.name, cap.duration_us, cap.records,
+                  len(cap.index_times), len(words), len(zc_times),
+                  cap.unit_ns))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,110 @@
+# Tick cost of the effect outputs
+#
+# Compares the cost of updating N outputs with one PWMEffect (and Timer) per
+# output and with a single EffectScheduler, using the PWM/Timer stand-ins of
+# hostsim on the host. Besides the time, it counts the timer callbacks and the
+# duty cycle writes per tick, which don't depend on the host.
+#
+#   python3 -m hostsim.effectbench [channels ...]
+#   micropython -m hostsim.effectbench [channels ...]
+#
+# The numbers depend on the host, compare them on the same machine only. On
+# CPython, viper functions run as plain Python with emulated pointers, which
+# makes table based code look slower than it is on the Pico. What a tick costs
+# on the Pico is mostly calls: with PWMEffect every output has its own timer
+# interrupt, a callback, the viper update_data(), update_effectcounter() and a
+# duty cycle write, the scheduler has one callback and one viper call for all
+# outputs and only writes the duty cycles that changed (see doc/effects.md).
+
+import sys
+
+import hostsim
+hostsim.install()
+
+import machine
+import utime
+
+import effects
+
+CHANNELS = (1, 4, 8, 16, 32)
+TICKS = 2000
+EFFECT_LEN = 64
+
+
+def make_effect(n=EFFECT_LEN):
+    # Pulse like a flasher: a ramp up, a hold and a ramp down
+    ramp = n // 4
+    data = bytearray([255] * n)
+    for i in range(ramp):
+        data[i] = i * 255 // ramp
+        data[n-1-i] = data[i]
+    return data
+
+
+def run_ticks(pwms, ticks):
+    # Returns (us per tick, callbacks per tick, writes per tick)
+    writes = sum(pwm.writes for pwm in pwms)
+    callbacks = 0
+    start = utime.ticks_us()
+    for t in range(ticks):
+        callbacks += len(machine.Timer.timers)
+        machine.Timer.fire_all()
+    elapsed = utime.ticks_diff(utime.ticks_us(), start)
+    writes = sum(pwm.writes for pwm in pwms) - writes
+    return elapsed / ticks, callbacks / ticks, writes / ticks
+
+
+def bench_pwmeffect(n, ticks=TICKS):
+    # Returns (us per tick, timers created, callbacks per tick, writes per
+    # tick)
+    machine.Timer.timers = []
+    created = machine.Timer.created
+    data = make_effect()
+    outputs = []
+    for i in range(n):
+        p = effects.PWMEffect(machine.Pin(i), update_ms=10)
+        p.play_effect(data, len(data), effects.PWM_CYCLIC)
+        outputs.append(p)
+
+    us, callbacks, writes = run_ticks([p.pwm for p in outputs], ticks)
+
+    for p in outputs:
+        p.stop_effect()
+    return us, machine.Timer.created - created, callbacks, writes
+
+
+def bench_scheduler(n, ticks=TICKS, divider=1):
+    # Returns (us per tick, timers created, callbacks per tick, writes per
+    # tick)
+    machine.Timer.timers = []
+    created = machine.Timer.created
+    data = make_effect()
+    sched = effects.EffectScheduler(n, 10)
+    for i in range(n):
+        ch = sched.add_channel(machine.Pin(i), divider=divider)
+        sched.play_effect(ch, data, len(data), effects.PWM_CYCLIC)
+    sched.start()
+
+    us, callbacks, writes = run_ticks(sched.pwms[:n], ticks)
+
+    sched.stop()
+    return us, machine.Timer.created - created, callbacks, writes
+
+
+def main(argv):
+    channels = [int(a) for a in argv] or CHANNELS
+    print("{:>8} {:>14} {:>14} {:>14} {:>16} {:>19} {:>16}".format(
+        "outputs", "PWMEffect us", "scheduler us", "divider 4 us",
+        "timers (eff/sch)", "callbacks (eff/sch)", "writes (eff/sch)"))
+    for n in channels:
+        single, timers, callbacks, writes = bench_pwmeffect(n)
+        sched, sched_timers, sched_callbacks, sched_writes = bench_scheduler(n)
+        divided = bench_scheduler(n, divider=4)[0]
+        print("{:>8} {:>14.1f} {:>14.1f} {:>14.1f} {:>12}/{:>3} {:>13.0f}/{:>5.0f}"
+              " {:>10.1f}/{:>5.1f}".format(
+                  n, single, sched, divided, timers, sched_timers, callbacks,
+                  sched_callbacks, writes, sched_writes))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
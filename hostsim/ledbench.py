@@ -0,0 +1,120 @@
+# Rendering throughput of the WS2812 output
+#
+# Renders lamp matrix frames into LED framebuffers with ws2812.WS2812 and a
+# framebuffer backend instead of the PIO/DMA output, and reports the time per
+# rendered frame for different strip lengths:
+#
+#   python3 -m hostsim.ledbench [leds ...]
+#   micropython -m hostsim.ledbench [leds ...]
+#
+# The numbers depend on the host, compare them on the same machine only. On
+# CPython, viper functions run as plain Python with emulated pointers.
+
+import sys
+
+import hostsim
+hostsim.install()
+
+import utime
+
+import ws2812
+
+LEDS = (64, 144, 300, 600)
+FRAMES = 200
+
+
+class FramebufferOutput():
+    # Keeps the last frame as RGB bytes, e.g. to check or display it
+
+    def __init__(self, n):
+        self.n = n
+        self.pixels = bytearray(3*n)
+        self.frames = 0
+
+    def busy(self):
+        return False
+
+    def write(self, fb, n):
+        p = self.pixels
+        for i in range(n):
+            w = fb[i]
+            p[3*i] = (w >> 16) & 0xff
+            p[3*i+1] = (w >> 24) & 0xff
+            p[3*i+2] = (w >> 8) & 0xff
+        self.frames += 1
+
+    def save_ppm(self, path, width=None):
+        if width is None:
+            width = self.n
+        height = (self.n + width - 1) // width
+        with open(path, "wb") as f:
+            f.write("P6 {} {} 255\n".format(width, height).encode())
+            f.write(self.pixels)
+            f.write(bytes(3 * (width*height - self.n)))
+
+
+class FakeMonitor():
+    # Provides a new lamp matrix frame on every call
+
+    def __init__(self):
+        self.frame = 0
+        self.state = bytearray(17)
+
+    def get_lamp_frame(self, buf=None):
+        if buf is None:
+            buf = bytearray(8)
+        self.frame += 1
+        for col in range(8):
+            buf[col] = (self.frame * 37 + col * 11) & 0xff
+        return self.frame, buf
+
+    def get_lamp_intensity(self, buf=None):
+        if buf is None:
+            buf = bytearray(64)
+        for i in range(64):
+            buf[i] = (self.frame * 7 + i * 4) & 0xff
+        return buf
+
+    def snapshot(self, buf=None):
+        if buf is None:
+            buf = bytearray(17)
+        for i in range(5):
+            self.state[12+i] = (self.frame >> 4) % 9
+        buf[0:17] = self.state
+        return self.frame, buf
+
+
+def make_map(n):
+    leds = ws2812.LEDMap()
+    colors = ((255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255))
+    for i in range(n):
+        if i % 16 == 15:
+            leds.add_gi(i % 5, (255, 180, 80))
+        else:
+            leds.add_lamp(i % 64, colors[i % len(colors)])
+    return leds
+
+
+def bench(n, mode=ws2812.LAMPS_ONOFF, frames=FRAMES):
+    # Returns us per rendered frame
+    out = FramebufferOutput(n)
+    strip = ws2812.WS2812(FakeMonitor(), make_map(n), output=out, lamps=mode)
+    start = utime.ticks_us()
+    for i in range(frames):
+        strip.update()
+    elapsed = utime.ticks_diff(utime.ticks_us(), start)
+    return elapsed / frames, out.frames
+
+
+def main(argv):
+    counts = [int(a) for a in argv] or LEDS
+    print("{:>6} {:>12} {:>12}".format("leds", "on/off us", "intensity us"))
+    for n in counts:
+        onoff, frames = bench(n)
+        intensity, frames = bench(n, ws2812.LAMPS_INTENSITY)
+        print("{:>6} {:>12.1f} {:>12.1f}".format(n, onoff, intensity))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,154 @@
+# Reader for the logic analyzer captures (.LPF) in logicanalyzer/
+#
+# The sample data of an LPF file is stored as text between "{" and "}". Each line
+# holds the state of the channels D0-D31, CLK1, CLK2 and the number of samples
+# the state lasted (run length encoding). Channels that were not acquired are
+# marked with "U". The sample period is stored after the sample data.
+#
+# The file is streamed in chunks and each chunk is parsed with NumPy, so even
+# long captures can be loaded quickly.
+
+import numpy as np
+
+# Logic analyzer channel connected to the Pico GPIOs 0-15 in the captures of this
+# repository. D0-D7 are the data lines. The other channels were identified from
+# the captures: D13 only carries one-hot data (lamp column), D12 the lamp rows,
+# D14 is the zero cross signal (10ms period), D15 carries 5-bit values (triacs).
+# D8-D11 are the solenoid strobes, their order can't be derived from the captures.
+LPF_CHANNELS = (0, 1, 2, 3, 4, 5, 6, 7,
+                15,   # GPIO8  triacs
+                8,    # GPIO9  sol1
+                10,   # GPIO10 sol3
+                11,   # GPIO11 sol4
+                9,    # GPIO12 sol2
+                13,   # GPIO13 lamp columns
+                12,   # GPIO14 lamp rows
+                14)   # GPIO15 zero cross
+
+# Channels that are directly connected in GPIO order
+DIRECT_CHANNELS = tuple(range(16))
+
+CHUNK_ROWS = 65536
+
+SEPARATOR = b"\x11"
+
+
+class LPFError(Exception):
+    pass
+
+
+class Capture():
+    # A capture converted to GPIO states
+    #
+    # states:    uint32 array, bit n is the level of GPIO n. Each entry is a run
+    #            of samples with the same channel states
+    # times:     float64 array, start of each run in microseconds
+    # period_us: sample period in microseconds
+
+    def __init__(self, states, times, duration_us, period_us, name=""):
+        self.states = states
+        self.times = times
+        self.duration_us = duration_us
+        self.period_us = period_us
+        self.name = name
+
+    def __len__(self):
+        return len(self.states)
+
+    def __repr__(self):
+        return "<Capture {} {} runs, {:.0f}us>".format(self.name,
+                                                         len(self),
+                                                         self.duration_us)
+
+
+def _parse_chunk(lines, columns):
+    text = b",".join(lines).replace(b"U", b"1").decode("ascii")
+    values = np.fromstring(text, dtype=np.int64, sep=",")
+    if len(values) != len(lines) * columns:
+        raise LPFError("malformed sample data")
+    values = values.reshape(-1, columns)
+
+    bits = values[:, :32].astype(np.uint32) << np.arange(32, dtype=np.uint32)
+    channels = np.bitwise_or.reduce(bits, axis=1)
+    return channels, values[:, -1]
+
+
+def iter_lpf(f, chunk_rows=CHUNK_ROWS, settings=None):
+    # Yields (channels, counts) arrays for chunks of the sample data. channels
+    # holds the state of D0-D31 as bits. If a dict is given as settings, the
+    # key/value lines of the file are stored there.
+    columns = 0
+    in_data = False
+    lines = []
+
+    for line in f:
+        line = line.strip()
+
+        if not in_data:
+            if line == b"{":
+                in_data = True
+                columns = -1
+            elif line == b"}":
+                in_data = False
+            elif settings is not None and SEPARATOR in line:
+                key, value = line.split(SEPARATOR, 1)
+                settings[key.decode("latin-1")] = value.decode("latin-1")
+            continue
+
+        if line == b"}":
+            in_data = False
+            if lines:
+                yield _parse_chunk(lines, columns)
+                lines = []
+            continue
+
+        if columns < 0:
+            # Header line with the channel names
+            columns = line.count(b",") + 1
+            continue
+
+        if line:
+            lines.append(line)
+            if len(lines) >= chunk_rows:
+                yield _parse_chunk(lines, columns)
+                lines = []
+
+    if in_data:
+        raise LPFError("sample data not terminated")
+
+
+def to_gpio(channels, channel_map=LPF_CHANNELS):
+    # Re-order logic analyzer channels to GPIO bits
+    gpio = np.zeros(len(channels), dtype=np.uint32)
+    for pin, channel in enumerate(channel_map):
+        gpio |= ((channels >> np.uint32(channel)) & np.uint32(1)) << np.uint32(pin)
+    return gpio
+
+
+def read_lpf(path, channel_map=LPF_CHANNELS, chunk_rows=CHUNK_ROWS):
+    settings = {}
+    states = []
+    counts = []
+
+    with open(path, "rb") as f:
+        for channels, c in iter_lpf(f, chunk_rows, settings):
+            states.append(to_gpio(channels, channel_map))
+            counts.append(c)
+
+    if not states:
+        raise LPFError("no sample data in " + str(path))
+
+    period = settings.get("AcquiredSamplePeriod")
+    if period is None:
+        raise LPFError("sample period missing in " + str(path))
+    period_us = float(period) * 1e6
+
+    states = np.concatenate(states)
+    counts = np.concatenate(counts)
+    samples = np.cumsum(counts)
+    times = np.empty(len(samples), dtype=np.float64)
+    times[0] = 0
+    times[1:] = samples[:-1] * period_us
+
+    return Capture(states, times, float(samples[-1] * period_us), period_us,
+                   str(path).rsplit("/", 1)[-1])
@@ -0,0 +1,215 @@
+# Stand-in for the MicroPython "machine" module on CPython
+#
+# PWM and Timer don't drive any hardware. PWM records the duty cycle, Timer
+# callbacks run when fire() is called.
+
+_freq = 125000000
+
+
+def freq(value=None):
+    global _freq
+    if value is None:
+        return _freq
+    _freq = value
+
+
+def reset():
+    raise SystemExit("machine.reset()")
+
+
+class Pin():
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    ALT = 3
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None, **kw):
+        self.id = id
+        self.mode = mode
+        self.pull = pull
+        self._value = 0
+        if value is not None:
+            self._value = value
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = 1 if v else 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def toggle(self):
+        self._value ^= 1
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+    def __repr__(self):
+        return "Pin({})".format(self.id)
+
+
+class PWM():
+    # Records the duty cycle instead of driving a pin. writes counts the
+    # duty_u16()/duty_ns() calls, e.g. to check that outputs are only written
+    # on changes.
+
+    def __init__(self, dest, freq=None, duty_u16=None, **kw):
+        self.pin = dest
+        self._freq = 0
+        self._duty = 0
+        self.writes = 0
+        self.active = True
+        if freq is not None:
+            self.freq(freq)
+        if duty_u16 is not None:
+            self.duty_u16(duty_u16)
+
+    def init(self, freq=None, duty_u16=None, **kw):
+        if freq is not None:
+            self.freq(freq)
+        if duty_u16 is not None:
+            self.duty_u16(duty_u16)
+        self.active = True
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._duty
+        if value < 0 or value > 65535:
+            raise ValueError("duty out of range")
+        self._duty = value
+        self.writes += 1
+
+    def duty_ns(self, value=None):
+        period_ns = 1000000000 // self._freq if self._freq else 0
+        if value is None:
+            return self._duty * period_ns // 65535
+        self.duty_u16(min(65535, value * 65535 // period_ns) if period_ns else 0)
+
+    def deinit(self):
+        self.active = False
+        self._duty = 0
+
+    def __repr__(self):
+        return "PWM({}, freq={}, duty_u16={})".format(self.pin, self._freq,
+                                                     self._duty)
+
+
+class Timer():
+    # Doesn't run on its own. Call fire() (or Timer.fire_all()) to run the
+    # callback as the hardware timer would. Active timers are kept in
+    # Timer.timers, created counts all Timer objects.
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    timers = []
+    created = 0
+
+    def __init__(self, id=-1, **kw):
+        self.id = id
+        self.callback = None
+        self.mode = Timer.PERIODIC
+        self.period = 0
+        Timer.created += 1
+        if kw:
+            self.init(**kw)
+
+    def init(self, mode=PERIODIC, freq=-1, period=-1, callback=None):
+        self.mode = mode
+        if freq > 0:
+            self.period = 1000 / freq
+        else:
+            self.period = period
+        self.callback = callback
+        if self not in Timer.timers:
+            Timer.timers.append(self)
+
+    def deinit(self):
+        if self in Timer.timers:
+            Timer.timers.remove(self)
+
+    def fire(self):
+        if self.callback is not None:
+            self.callback(self)
+        if self.mode == Timer.ONE_SHOT:
+            self.deinit()
+
+    @classmethod
+    def fire_all(cls):
+        for t in list(cls.timers):
+            t.fire()
+
+
+class UART():
+    # Collects the written bytes in output. If a file descriptor is attached
+    # with attach() (e.g. a pty), they are written there instead.
+
+    def __init__(self, id, baudrate=115200, **kw):
+        self.id = id
+        self.baudrate = baudrate
+        self.output = bytearray()
+        self.fd = None
+
+    def init(self, baudrate=115200, **kw):
+        self.baudrate = baudrate
+
+    def attach(self, fd):
+        self.fd = fd
+
+    def write(self, buf):
+        if self.fd is not None:
+            import os
+            data = bytes(buf)
+            while data:
+                data = data[os.write(self.fd, data):]
+        else:
+            self.output.extend(buf)
+        return len(buf)
+
+    def any(self):
+        return 0
+
+    def read(self, n=-1):
+        return None
+
+    def deinit(self):
+        self.fd = None
+
+
+class SPI():
+    # Records the written bytes instead of clocking them out. last is the data
+    # of the last write(), writes counts the writes and written the bytes.
+    MSB = 0
+    LSB = 1
+
+    def __init__(self, id, baudrate=1000000, firstbit=MSB, **kw):
+        self.id = id
+        self.baudrate = baudrate
+        self.firstbit = firstbit
+        self.last = bytes()
+        self.writes = 0
+        self.written = 0
+
+    def init(self, baudrate=1000000, firstbit=MSB, **kw):
+        self.baudrate = baudrate
+        self.firstbit = firstbit
+
+    def write(self, buf):
+        self.last = bytes(buf)
+        self.writes += 1
+        self.written += len(buf)
+
+    def deinit(self):
+        pass
@@ -0,0 +1,77 @@
+# Stand-in for the MicroPython "micropython" module on CPython
+#
+# The code emitters (viper, native) are replaced by the plain Python function.
+# Viper pointers are emulated by wrapping the underlying buffer. Like on the
+# Pico, stores are truncated to the width of the pointer.
+
+
+def const(x):
+    return x
+
+
+def viper(f):
+    return f
+
+
+def native(f):
+    return f
+
+
+def asm_thumb(f):
+    return f
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def opt_level(level=None):
+    return 0
+
+
+class ptr8():
+
+    __slots__ = ("buf",)
+
+    def __init__(self, buf):
+        if isinstance(buf, ptr8):
+            buf = buf.buf
+        self.buf = buf
+
+    def __getitem__(self, i):
+        return self.buf[i]
+
+    def __setitem__(self, i, v):
+        self.buf[i] = v & 0xff
+
+
+class ptr16():
+
+    __slots__ = ("buf",)
+
+    def __init__(self, buf):
+        if isinstance(buf, ptr16):
+            buf = buf.buf
+        self.buf = memoryview(buf).cast("B").cast("H")
+
+    def __getitem__(self, i):
+        return self.buf[i]
+
+    def __setitem__(self, i, v):
+        self.buf[i] = v & 0xffff
+
+
+class ptr32():
+
+    __slots__ = ("buf",)
+
+    def __init__(self, buf):
+        if isinstance(buf, ptr32):
+            buf = buf.buf
+        self.buf = memoryview(buf).cast("B").cast("I")
+
+    def __getitem__(self, i):
+        return self.buf[i]
+
+    def __setitem__(self, i, v):
+        self.buf[i] = v & 0xffffffff
@@ -0,0 +1,257 @@
+# Stand-in for the MicroPython "rp2" module on CPython
+#
+# asm_pio() runs the program body like MicroPython does and records the
+# instructions, so PIO programs can be inspected on the host. They are not
+# executed. StateMachine objects don't run any code either. Instead, a FIFO
+# source can be attached that provides the words the state machine would push
+# (see hostsim.sim and hostsim.replay).
+
+
+class PIO():
+    JOIN_NONE = 0
+    JOIN_TX = 1
+    JOIN_RX = 2
+    IN_LOW = 0
+    IN_HIGH = 1
+    OUT_LOW = 2
+    OUT_HIGH = 3
+    SHIFT_LEFT = 0
+    SHIFT_RIGHT = 1
+    IRQ_SM0 = 0x100
+    IRQ_SM1 = 0x200
+    IRQ_SM2 = 0x400
+    IRQ_SM3 = 0x800
+
+    def __init__(self, id):
+        self.id = id
+
+
+class PIOASMError(Exception):
+    pass
+
+
+class _Instruction():
+
+    def __init__(self, program, op, args):
+        self.op = op
+        self.args = args
+        self.delay = 0
+        self.sideset = None
+        program.append(self)
+
+    def __getitem__(self, delay):
+        if delay < 0 or delay > 31:
+            raise PIOASMError("delay out of range")
+        self.delay = delay
+        return self
+
+    def side(self, value):
+        self.sideset = value
+        return self
+
+    def __repr__(self):
+        return "{}{}[{}]".format(self.op, self.args, self.delay)
+
+
+class _Operand():
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+class _Invert(_Operand):
+
+    def __init__(self, operand):
+        self.name = "~" + repr(operand)
+        self.operand = operand
+
+
+class _Reverse(_Operand):
+
+    def __init__(self, operand):
+        self.name = "::" + repr(operand)
+        self.operand = operand
+
+
+class Program():
+    # A recorded PIO program
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = settings
+        self.instructions = []
+        self.labels = {}
+        self.wrap_target = 0
+        self.wrap = -1
+
+    def append(self, instr):
+        self.instructions.append(instr)
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def __repr__(self):
+        return "<PIO program {} ({} instructions)>".format(self.name, len(self))
+
+
+_OPERANDS = ("pins", "x", "y", "null", "pindirs", "pc", "isr", "osr", "status",
+             "exec", "pin", "gpio", "x_dec", "y_dec", "not_x", "not_y",
+             "x_not_y", "not_osre", "block", "noblock", "iffull", "ifempty",
+             "rel", "clear")
+
+_INSTRUCTIONS = ("nop", "jmp", "wait", "in_", "out", "push", "pull", "mov",
+                 "set")
+
+
+def asm_pio(**kw):
+
+    def assemble(f):
+        program = Program(f.__name__, kw)
+
+        def make_instr(op):
+            return lambda *args: _Instruction(program, op, args)
+
+        def label(name):
+            program.labels[name] = len(program)
+
+        def wrap_target():
+            program.wrap_target = len(program)
+
+        def wrap():
+            program.wrap = len(program) - 1
+
+        def word(instr, label=None):
+            return _Instruction(program, "word", (instr, label))
+
+        class _Irq(_Operand):
+            # irq is an instruction and a wait source at the same time
+            def __call__(self, *args):
+                return _Instruction(program, "irq", args)
+
+        env = {}
+        for name in _OPERANDS:
+            env[name] = _Operand(name)
+        for name in _INSTRUCTIONS:
+            env[name] = make_instr(name)
+        env["irq"] = _Irq("irq")
+        env["label"] = label
+        env["wrap_target"] = wrap_target
+        env["wrap"] = wrap
+        env["word"] = word
+        env["invert"] = _Invert
+        env["reverse"] = _Reverse
+
+        # Like MicroPython, temporarily inject the assembler names into the
+        # globals of the module that defines the program
+        g = f.__globals__
+        saved = {}
+        for name in env:
+            if name in g:
+                saved[name] = g[name]
+            g[name] = env[name]
+        try:
+            f()
+        finally:
+            for name in env:
+                if name in saved:
+                    g[name] = saved[name]
+                else:
+                    del g[name]
+
+        if program.wrap < 0:
+            program.wrap = len(program) - 1
+        if len(program) > 32:
+            raise PIOASMError("program too long")
+        return program
+
+    return assemble
+
+
+class StateMachine():
+    # A state machine that doesn't execute its program. Words are provided by
+    # an attached FIFO source. A source needs rx_fifo() and get() methods.
+
+    def __init__(self, id, program=None, freq=-1, **kw):
+        self.id = id
+        self.source = None
+        self.running = False
+        self.tx = []
+        self.init(program, freq, **kw)
+
+    def init(self, program=None, freq=-1, **kw):
+        self.program = program
+        self.freq = freq
+        self.settings = kw
+
+    def attach(self, source):
+        self.source = source
+
+    def active(self, value=None):
+        if value is None:
+            return self.running
+        self.running = bool(value)
+
+    def rx_fifo(self):
+        if self.source is None:
+            return 0
+        return self.source.rx_fifo()
+
+    def get(self, buf=None, shift=0):
+        if self.source is None:
+            raise RuntimeError("no FIFO source attached to state machine")
+        return self.source.get() >> shift
+
+    def tx_fifo(self):
+        return 0
+
+    def put(self, value, shift=0):
+        self.tx.append(value << shift)
+
+    def exec(self, instr):
+        pass
+
+    def irq(self, handler=None, trigger=0, hard=False):
+        pass
+
+    def restart(self):
+        pass
+
+
+class DMA():
+    # Copies the data at trigger time instead of running in the background. If
+    # the destination is a StateMachine, the words are appended to its tx list.
+
+    def __init__(self):
+        self.closed = False
+        self.transfers = 0
+
+    def pack_ctrl(self, **kw):
+        return kw
+
+    def unpack_ctrl(self, ctrl):
+        return ctrl
+
+    def config(self, read=None, write=None, count=-1, ctrl=None, trigger=False):
+        self.read = read
+        self.write = write
+        self.count = count
+        self.ctrl = ctrl
+        if trigger:
+            self.active(1)
+
+    def active(self, value=None):
+        if value is None:
+            return False
+        if value:
+            if isinstance(self.write, StateMachine):
+                for i in range(self.count):
+                    self.write.put(self.read[i])
+            elif self.write is not None:
+                self.write[0:self.count] = self.read[0:self.count]
+            self.transfers += 1
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,55 @@
+# Stand-in for the MicroPython "uasyncio" module on CPython
+#
+# Everything comes from asyncio. ThreadSafeFlag and sleep_ms() only exist in
+# MicroPython and are added here. ThreadSafeFlag.set() can be called from
+# another thread, like from the poller thread on the second core of the Pico.
+
+import threading
+
+from asyncio import *
+
+
+def sleep_ms(ms):
+    return sleep(ms / 1000)
+
+
+class ThreadSafeFlag():
+    # Like the MicroPython class: one task waits, set() may be called from any
+    # thread, several set() before the task runs wake it once
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flag = False
+        self._loop = None
+        self._waiter = None
+
+    def set(self):
+        with self._lock:
+            self._flag = True
+            waiter = self._waiter
+            loop = self._loop
+        if waiter is not None:
+            loop.call_soon_threadsafe(self._wake, waiter)
+
+    def _wake(self, waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def clear(self):
+        with self._lock:
+            self._flag = False
+
+    async def wait(self):
+        with self._lock:
+            if self._flag:
+                self._flag = False
+                return
+            self._loop = get_running_loop()
+            waiter = self._loop.create_future()
+            self._waiter = waiter
+        try:
+            await waiter
+        finally:
+            with self._lock:
+                self._waiter = None
+                self._flag = False
@@ -0,0 +1,61 @@
+# Stand-in for the MicroPython "utime" module on CPython
+#
+# The time source can be replaced with set_time_source(). This allows simulations
+# and replays to run on a virtual clock instead of the wall clock.
+
+import time
+
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+_time_source = None
+
+
+def set_time_source(func):
+    # func() returns the current time in microseconds, None restores the wall clock
+    global _time_source
+    _time_source = func
+
+
+def _now_us():
+    if _time_source is not None:
+        return int(_time_source())
+    return time.perf_counter_ns() // 1000
+
+
+def ticks_us():
+    return _now_us() & TICKS_MAX
+
+
+def ticks_ms():
+    return (_now_us() // 1000) & TICKS_MAX
+
+
+def ticks_cpu():
+    return ticks_us()
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+
+def time_ns():
+    return time.time_ns()
+
+
+def sleep(seconds):
+    if _time_source is None:
+        time.sleep(seconds)
+
+
+def sleep_ms(ms):
+    sleep(ms / 1000)
+
+
+def sleep_us(us):
+    sleep(us / 1000000)
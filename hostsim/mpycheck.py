@@ -0,0 +1,84 @@
+# Compile check of the modules that run on the Pico
+#
+# CPython runs the viper code as plain Python, so viper type errors (like an
+# object where viper expects an int) or functions that are too big for Thumb-1
+# only show up when the module is compiled for the Pico. This compiles the
+# modules with mpy-cross for armv6m (the RP2040) and fails if one of them
+# doesn't compile. mpy-cross is taken from the mpy_cross package
+# (pip install mpy-cross) or from the PATH:
+#
+#   python3 -m hostsim.mpycheck                  # all modules in MODULES
+#   python3 -m hostsim.mpycheck effects.py       # some of them
+#
+# Older mpy-cross versions (e.g. 1.22) still refuse branches beyond the Thumb-1
+# range, newer ones don't, check with the version of the firmware.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import hostsim
+
+ARCH = "armv6m"
+
+# Modules that are copied to the Pico (the generated variants of the poller
+# are checked by hostsim.build --check)
+MODULES = ("powermon_viper.py", "powermon.py", "asyncmon.py", "effects.py",
+           "pipeline.py", "rules.py", "shiftout.py", "stream.py", "ws2812.py")
+
+
+def find_mpy_cross():
+    # Command line of mpy-cross or None if there is none
+    try:
+        import mpy_cross
+        return [sys.executable, "-m", "mpy_cross"]
+    except ImportError:
+        pass
+    path = shutil.which("mpy-cross")
+    if path:
+        return [path]
+    return None
+
+
+def compile_module(command, path, arch=ARCH):
+    # Returns None if path compiles, the error message otherwise
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "out.mpy")
+        res = subprocess.run(command + ["-march=" + arch, "-o", out, path],
+                             capture_output=True, text=True)
+    if res.returncode:
+        return (res.stderr or res.stdout).strip()
+    return None
+
+
+def check(paths, arch=ARCH):
+    # {path: error} of the modules that don't compile, None without mpy-cross
+    command = find_mpy_cross()
+    if command is None:
+        return None
+    errors = {}
+    for path in paths:
+        error = compile_module(command, path, arch)
+        if error:
+            errors[path] = error
+    return errors
+
+
+def main(argv):
+    paths = argv or [os.path.join(hostsim.ROOT_DIR, m) for m in MODULES]
+    errors = check(paths)
+    if errors is None:
+        print("mpy-cross not found, install it with pip install mpy-cross")
+        return 2
+    for path in paths:
+        print("{}: {}".format(path, "FAILED" if path in errors else "ok"))
+        if path in errors:
+            for line in errors[path].splitlines():
+                print("  " + line)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
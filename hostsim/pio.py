@@ -0,0 +1,275 @@
+# Interpreter for PIO programs recorded by the rp2 stand-in
+#
+# Executes the instructions of a PIO program the way a state machine does. The
+# executed cycles (including delays) are counted in cycles, but there's no
+# timing otherwise: pin levels only change when set_pins() is called between
+# steps. This allows checking that a PIO program
+# pushes the expected words for given pin states. Only the instructions the
+# programs in this repository use are supported:
+# wait (irq, pin, gpio), mov, jmp, in, out, push, pull, set, irq and nop.
+#
+#   sm = PIOInterpreter(powermon_viper.read_data)
+#   sm.run()                 # runs until the program waits
+#   sm.set_pins(levels)      # GPIO levels, bit n = GPIO n
+#   sm.raise_irq(0)
+#   words = sm.run()         # words pushed to the RX FIFO
+
+MASK32 = 0xffffffff
+MAX_STEPS = 1000
+
+
+class PIOError(Exception):
+    pass
+
+
+def _reverse32(v):
+    r = 0
+    for i in range(32):
+        r = (r << 1) | ((v >> i) & 1)
+    return r
+
+
+class PIOInterpreter():
+
+    def __init__(self, program, in_base=0, jmp_pin=None):
+        self.program = program
+        self.in_base = in_base
+        self.jmp_pin = jmp_pin
+
+        settings = program.settings
+        self.in_shift_right = settings.get("in_shiftdir", 0) == 1
+        self.out_shift_right = settings.get("out_shiftdir", 0) == 1
+        self.autopush = settings.get("autopush", False)
+        self.push_thresh = settings.get("push_thresh", 32)
+
+        self.pc = program.wrap_target
+        self.x = 0
+        self.y = 0
+        self.isr = 0
+        self.isr_count = 0
+        self.osr = 0
+        self.osr_count = 32
+        self.gpio = 0xffffffff
+        self.irqs = 0
+        self.rx = []
+        self.cycles = 0
+
+    def set_pins(self, levels):
+        self.gpio = levels & MASK32
+
+    def raise_irq(self, n):
+        self.irqs |= 1 << n
+
+    def pins(self):
+        s = self.in_base
+        return ((self.gpio >> s) | (self.gpio << (32 - s))) & MASK32
+
+    def _read(self, src):
+        name = src.name
+        invert = False
+        reverse = False
+        if name.startswith("~"):
+            invert = True
+            src = src.operand
+            name = src.name
+        elif name.startswith("::"):
+            reverse = True
+            src = src.operand
+            name = src.name
+
+        if name == "pins":
+            v = self.pins()
+        elif name == "x":
+            v = self.x
+        elif name == "y":
+            v = self.y
+        elif name == "null":
+            v = 0
+        elif name == "isr":
+            v = self.isr
+        elif name == "osr":
+            v = self.osr
+        else:
+            raise PIOError("unsupported source " + name)
+
+        if invert:
+            v = ~v & MASK32
+        if reverse:
+            v = _reverse32(v)
+        return v
+
+    def _write(self, dst, v):
+        name = dst.name
+        if name == "x":
+            self.x = v
+        elif name == "y":
+            self.y = v
+        elif name == "isr":
+            self.isr = v
+            self.isr_count = 0
+        elif name == "osr":
+            self.osr = v
+            self.osr_count = 0
+        elif name == "null" or name == "pins" or name == "pindirs":
+            pass
+        elif name == "pc":
+            self.pc = v
+            return True
+        else:
+            raise PIOError("unsupported destination " + name)
+        return False
+
+    def _push(self):
+        self.rx.append(self.isr)
+        self.isr = 0
+        self.isr_count = 0
+
+    def _shift_in(self, v, n):
+        mask = (1 << n) - 1 if n < 32 else MASK32
+        v &= mask
+        if self.in_shift_right:
+            self.isr = ((self.isr >> n) | (v << (32 - n))) & MASK32
+        else:
+            self.isr = ((self.isr << n) | v) & MASK32
+        self.isr_count = min(32, self.isr_count + n)
+        if self.autopush and self.isr_count >= self.push_thresh:
+            self._push()
+
+    def _shift_out(self, n):
+        mask = (1 << n) - 1 if n < 32 else MASK32
+        if self.out_shift_right:
+            v = self.osr & mask
+            self.osr = (self.osr >> n) if n < 32 else 0
+        else:
+            v = (self.osr >> (32 - n)) & mask
+            self.osr = (self.osr << n) & MASK32
+        self.osr_count = min(32, self.osr_count + n)
+        return v
+
+    def _condition(self, cond):
+        if cond is None:
+            return True
+        name = cond.name
+        if name == "not_x":
+            return self.x == 0
+        if name == "not_y":
+            return self.y == 0
+        if name == "x_dec":
+            res = self.x != 0
+            self.x = (self.x - 1) & MASK32
+            return res
+        if name == "y_dec":
+            res = self.y != 0
+            self.y = (self.y - 1) & MASK32
+            return res
+        if name == "x_not_y":
+            return self.x != self.y
+        if name == "pin":
+            return (self.gpio >> self.jmp_pin) & 1 == 1
+        if name == "not_osre":
+            return self.osr_count < 32
+        raise PIOError("unsupported condition " + name)
+
+    def _advance(self):
+        if self.pc == self.program.wrap:
+            self.pc = self.program.wrap_target
+        else:
+            self.pc += 1
+
+    def step(self):
+        # Executes one instruction, returns False if the state machine stalls
+        instr = self.program.instructions[self.pc]
+        self.cycles += 1
+        if not self._execute(instr):
+            return False
+        self.cycles += instr.delay
+        return True
+
+    def _execute(self, instr):
+        op = instr.op
+        args = instr.args
+
+        if op == "wait":
+            polarity, src, index = args[0], args[1], args[2]
+            if src.name == "irq":
+                if not self.irqs & (1 << index):
+                    return False
+                if polarity:
+                    self.irqs &= ~(1 << index)
+            elif src.name == "gpio":
+                if (self.gpio >> index) & 1 != polarity:
+                    return False
+            elif src.name == "pin":
+                if (self.pins() >> index) & 1 != polarity:
+                    return False
+            else:
+                raise PIOError("unsupported wait source " + src.name)
+
+        elif op == "mov":
+            if self._write(args[0], self._read(args[1])):
+                return True
+
+        elif op == "jmp":
+            if len(args) == 1:
+                cond, target = None, args[0]
+            else:
+                cond, target = args[0], args[1]
+            if self._condition(cond):
+                self.pc = self.program.labels[target]
+                return True
+
+        elif op == "in_":
+            self._shift_in(self._read(args[0]), args[1])
+
+        elif op == "out":
+            v = self._shift_out(args[1])
+            if self._write(args[0], v):
+                return True
+            if args[0].name == "isr":
+                self.isr_count = args[1]
+
+        elif op == "push":
+            self._push()
+
+        elif op == "pull":
+            raise PIOError("pull is not supported, the TX FIFO is not emulated")
+
+        elif op == "set":
+            self._write(args[0], args[1] & 0x1f)
+
+        elif op == "irq":
+            self.irqs |= 1 << (args[-1] & 7)
+
+        elif op != "nop":
+            raise PIOError("unsupported instruction " + op)
+
+        self._advance()
+        return True
+
+    def run(self):
+        # Runs until the state machine waits, returns the pushed words
+        for i in range(MAX_STEPS):
+            if not self.step():
+                rx = self.rx
+                self.rx = []
+                return rx
+        raise PIOError("program doesn't stall")
+
+
+def run_bus_words(program, words, jmp_pin=None, databits=15):
+    # Runs a data program (like read_data) over bus words as read_data pushes
+    # them (inverted GPIO 0-14). For every word, the pins are set and IRQ 0 is
+    # raised like wait_clock does. Returns (indices, pushed): pushed holds the
+    # words the program pushed, indices the input word that caused each push.
+    sm = PIOInterpreter(program, jmp_pin=jmp_pin)
+    sm.run()
+    mask = (1 << databits) - 1
+    indices = []
+    pushed = []
+    for i in range(len(words)):
+        sm.set_pins(~int(words[i]) & mask)
+        sm.raise_irq(0)
+        for w in sm.run():
+            indices.append(i)
+            pushed.append(w)
+    return indices, pushed
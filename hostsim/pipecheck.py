@@ -0,0 +1,148 @@
+# Thread test of the pipeline queue
+#
+# Runs a producer thread that pushes numbered records into a
+# pipeline.SPSCQueue while the main thread pops them, like the poller and the
+# pipeline on the two cores of the Pico, and checks that every record arrives
+# once and in order, except for the ones that were dropped because the queue
+# was full. Then a producer thread writes random state changes into the queue
+# of a Pipeline and the state of the pipeline is compared with the final state
+# of the producer:
+#
+#   python3 -m hostsim.pipecheck
+#   micropython -m hostsim.pipecheck
+#
+# Each check runs twice: with a producer that pushes as fast as it can (the
+# queue fills up and records are dropped) and with a producer that sleeps for
+# 1ms after every PACE records.
+
+import random
+import sys
+
+import hostsim
+hostsim.install()
+
+import _thread
+import utime
+
+import pipeline
+
+RECORDS = 200000
+CHANGES = 50000
+PACE = 32
+
+
+class FakeMonitor():
+
+    def __init__(self):
+        self.state = bytearray(pipeline.STATE_SIZE)
+
+    def snapshot(self, buf=None):
+        if buf is None:
+            buf = bytearray(pipeline.STATE_SIZE)
+        buf[:] = self.state
+        return 0, buf
+
+
+def check_queue(pace=0, records=RECORDS, size=pipeline.QUEUE_SIZE, seed=1):
+    # Returns (errors, stats)
+    queue = pipeline.SPSCQueue(size)
+    done = [False]
+
+    def producer():
+        for i in range(records):
+            queue.push(i, i ^ 0x5a5a5a5a)
+            if pace and i % pace == pace - 1:
+                utime.sleep_ms(1)
+        done[0] = True
+
+    _thread.start_new_thread(producer, ())
+    rnd = random.Random(seed)
+    out = pipeline.array('I', [0]*(32*pipeline.Q_WORDS))
+    received = 0
+    expected = 0
+    errors = 0
+    start = utime.ticks_ms()
+    while True:
+        finished = done[0]
+        n = queue.pop(out)
+        for i in range(n):
+            seq = out[i*pipeline.Q_WORDS]
+            if seq < expected or out[i*pipeline.Q_WORDS+1] != seq ^ 0x5a5a5a5a:
+                errors += 1
+            expected = seq + 1
+        received += n
+        if finished and not n:
+            break
+        if rnd.randrange(1000) == 0:
+            utime.sleep_ms(1)
+    elapsed = utime.ticks_diff(utime.ticks_ms(), start)
+    stats = queue.get_stats()
+    if received + stats["drops"] != records:
+        errors += 1
+    stats["received"] = received
+    stats["records_per_s"] = records * 1000 // max(1, elapsed)
+    return errors, stats
+
+
+def check_pipeline(pace=0, changes=CHANGES, size=pipeline.QUEUE_SIZE, seed=2):
+    # Returns (errors, stats)
+    pm = FakeMonitor()
+    pipe = pipeline.Pipeline(queue_size=size)
+    calls = [0, 0]
+
+    def lamps():
+        calls[0] += 1
+
+    def stage(state, now):
+        calls[1] += 1
+
+    pipe.set_lamp_notify(lamps)
+    pipe.add_stage(stage)
+    pipe.attach(pm)
+    done = [False]
+
+    def producer():
+        rnd = random.Random(seed)
+        for i in range(changes):
+            index = rnd.randrange(pipeline.STATE_SIZE)
+            old = pm.state[index]
+            new = rnd.randrange(256)
+            # Like the poller: the published state is updated first
+            pm.state[index] = new
+            pipe.queue.push(utime.ticks_us(), (index << 16) | (old << 8) | new)
+            if pace and i % pace == pace - 1:
+                utime.sleep_ms(1)
+        done[0] = True
+
+    _thread.start_new_thread(producer, ())
+    rnd = random.Random(seed + 1)
+    while True:
+        finished = done[0]
+        if not pipe.poll() and finished:
+            break
+        if rnd.randrange(200) == 0:
+            utime.sleep_ms(1)
+    pipe.poll()
+    errors = 0 if pipe.state == pm.state else 1
+    stats = pipe.get_stats()
+    stats["lamp_notify"] = calls[0]
+    stats["stage_calls"] = calls[1]
+    return errors, stats
+
+
+def main(argv):
+    failed = False
+    for name, check in (("queue", check_queue), ("pipeline", check_pipeline)):
+        for pace in (0, PACE):
+            errors, stats = check(pace)
+            failed = failed or errors
+            print("{} ({}): {} errors".format(
+                name, "paced" if pace else "flood", errors))
+            for key, value in stats.items():
+                print("  {}: {}".format(key, value))
+    print("FAILED" if failed else "OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
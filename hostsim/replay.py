@@ -0,0 +1,429 @@
+# Replay engine for logic analyzer captures
+#
+# Rebuilds the words the PIO programs in powermon_viper.py would push from the
+# GPIO levels in a capture and feeds them through updateloop(). This allows
+# checking decoder changes against real bus traffic without a pinball machine.
+#
+#   python3 -m hostsim.replay logicanalyzer/wpcpower.LPF
+#
+# The PIO programs are emulated with vectorized edge detection:
+#
+# wait_clock/read_data: when the control lines (GPIO 8-14) change from "all high"
+#   to "at least one low", the data machine samples GPIO 0-14 SAMPLE_DELAY_US
+#   later and pushes the inverted 15-bit value.
+# wait_zerocrossing: pushes a word on every rising edge of GPIO 15.
+#
+# stamp_zc_triacs: pushes the value of a counter (16 counts per us, counting
+#   down) on every rising edge of GPIO 15 and on every falling edge of the triac
+#   strobe (GPIO 8) together with the data bus, sampled STAMP_DELAY_US later.
+#
+# Data programs that do more than sampling (read_data_paired) are executed with
+# the PIO interpreter in hostsim.pio on the sampled words. With --verify-paired,
+# a capture is replayed with read_data and read_data_paired and the results are
+# compared.
+
+import sys
+
+import hostsim
+hostsim.install()
+
+import numpy as np
+
+from hostsim import lpf
+from hostsim import pio
+
+# wait_clock waits 32 cycles after the falling edge, raising the IRQ and sampling
+# the pins in read_data takes some more cycles (125MHz)
+SAMPLE_DELAY_US = 36 * 0.008
+
+CTL_MASK = 0x7f
+CTL_SHIFT = 8
+ZC_BIT = 15
+DATA_MASK = 0x7fff
+LCOL_PIN = 13
+
+# stamp_zc_triacs: counts per us, counter bits and sample delay of the data
+STAMP_COUNTS_US = 16
+STAMP_MASK = 0x3fffff
+STAMP_DATA_SHIFT = 22
+STAMP_DELAY_US = 16 / 80.0
+TRIAC_BIT = 8
+
+EV_DATA = 0
+EV_ZC = 1
+
+
+def clock_edges(states):
+    # Indices of the runs where at least one control line goes low after all
+    # control lines have been high
+    allhigh = ((states >> CTL_SHIFT) & CTL_MASK) == CTL_MASK
+    return np.flatnonzero(allhigh[:-1] & ~allhigh[1:]) + 1
+
+
+def zc_edges(states):
+    zc = ((states >> ZC_BIT) & 1).astype(bool)
+    return np.flatnonzero(~zc[:-1] & zc[1:]) + 1
+
+
+def decode_words(capture, sample_delay_us=SAMPLE_DELAY_US):
+    # Returns (word_times, words, zc_times) as the PIO programs would see them
+    states = capture.states
+    times = capture.times
+
+    edges = clock_edges(states)
+    word_times = times[edges] + sample_delay_us
+    sample = np.searchsorted(times, word_times, side="right") - 1
+    words = (~states[sample]) & DATA_MASK
+
+    zc_times = times[zc_edges(states)]
+    return word_times, words.astype(np.uint32), zc_times
+
+
+def _stamp_counter(t):
+    ticks = np.round(t * STAMP_COUNTS_US).astype(np.int64)
+    return (-ticks & STAMP_MASK).astype(np.uint32)
+
+
+def stamp_words(capture):
+    # Returns (times, words) as stamp_zc_triacs would push them
+    states = capture.states
+    times = capture.times
+
+    zc = zc_edges(states)
+    strobe = ((states >> TRIAC_BIT) & 1).astype(bool)
+    triacs = np.flatnonzero(strobe[:-1] & ~strobe[1:]) + 1
+
+    zc_times = times[zc]
+    triac_times = times[triacs]
+    sample = np.searchsorted(times, triac_times + STAMP_DELAY_US,
+                             side="right") - 1
+    sampled = (~states[sample]).astype(np.uint32) & 0x1ff
+
+    stamp_times = np.concatenate((zc_times, triac_times))
+    words = np.concatenate((_stamp_counter(zc_times),
+                            _stamp_counter(triac_times) |
+                            (sampled << np.uint32(STAMP_DATA_SHIFT))))
+    order = np.argsort(stamp_times, kind="stable")
+    return stamp_times[order], words[order]
+
+
+def stamp_words_from_bus(word_times, words, zc_times):
+    # Like stamp_words() for captures that only contain the bus words: the
+    # triac words are the strobes, their low 9 bits the sampled data
+    triac = (words & (1 << TRIAC_BIT)) != 0
+    triac_times = word_times[triac]
+    sampled = words[triac].astype(np.uint32) & 0x1ff
+
+    stamp_times = np.concatenate((zc_times, triac_times))
+    stamps = np.concatenate((_stamp_counter(zc_times),
+                             _stamp_counter(triac_times) |
+                             (sampled << np.uint32(STAMP_DATA_SHIFT))))
+    order = np.argsort(stamp_times, kind="stable")
+    return stamp_times[order], stamps[order]
+
+
+def pair_words(word_times, words, program=None):
+    # Runs read_data_paired over the words read_data would push, returns
+    # (word_times, words) of the words it pushes
+    if program is None:
+        program = load_decoder().read_data_paired
+    indices, pushed = pio.run_bus_words(program, words, jmp_pin=LCOL_PIN)
+    indices = np.array(indices, dtype=np.int64)
+    return word_times[indices], np.array(pushed, dtype=np.uint32)
+
+
+def merge_events(word_times, words, zc_times, zc_words=None):
+    # Merge both FIFOs into one stream ordered by time
+    if zc_words is None:
+        zc_words = np.zeros(len(zc_times), dtype=np.uint32)
+    times = np.concatenate((word_times, zc_times))
+    kinds = np.concatenate((np.full(len(word_times), EV_DATA, dtype=np.uint8),
+                            np.full(len(zc_times), EV_ZC, dtype=np.uint8)))
+    values = np.concatenate((words, zc_words))
+    order = np.argsort(times, kind="stable")
+    return times[order], kinds[order], values[order]
+
+
+class _ReplayBus():
+    # Serves the merged event stream to updateloop() through two FIFO sources
+    # and records state changes after each event
+
+    def __init__(self, pv, times, kinds, values):
+        self.pv = pv
+        self.times = times.tolist()
+        self.kinds = kinds.tolist()
+        self.values = values.tolist()
+        self.pos = 0
+        self.now = 0
+        self.last_time = 0
+        self.timeline = []
+
+        self.tracked = (("lamp", pv.lamps),
+                        ("solenoid", pv.solenoids),
+                        ("gi", pv.gi_brightness))
+        self.previous = [bytes(buf) for (_, buf) in self.tracked]
+
+    def pending(self, kind):
+        self.record_changes()
+        if self.pos >= len(self.kinds):
+            # All data consumed, end the poller
+            self.pv.running = False
+            return 0
+        if self.kinds[self.pos] != kind:
+            return 0
+        self.now = self.times[self.pos]
+        return 1
+
+    def get(self):
+        value = self.values[self.pos]
+        self.last_time = self.times[self.pos]
+        self.pos += 1
+        return value
+
+    def record_changes(self):
+        for i in range(len(self.tracked)):
+            name, buf = self.tracked[i]
+            prev = self.previous[i]
+            if buf != prev:
+                for j in range(len(buf)):
+                    if buf[j] != prev[j]:
+                        self.timeline.append((self.last_time, name, j,
+                                              prev[j], buf[j]))
+                self.previous[i] = bytes(buf)
+
+
+class _ReplayFIFO():
+
+    def __init__(self, bus, kind):
+        self.bus = bus
+        self.kind = kind
+
+    def rx_fifo(self):
+        return self.bus.pending(self.kind)
+
+    def get(self):
+        return self.bus.get()
+
+
+class ReplayResult():
+    # lamps, solenoids, gi_brightness: final state after the replay
+    # timeline: list of (time_us, kind, index, old, new) for each change,
+    #           kind is "lamp", "solenoid" or "gi"
+    # word_times, words: the bus words that were fed to the decoder
+    # zc_times: the zero crossings that were fed to the decoder
+    # stats: counters of the decoder
+
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+    def get_lamps(self):
+        return int.from_bytes(self.lamps, "big")
+
+    def get_solenoids(self):
+        return int.from_bytes(self.solenoids, "big")
+
+    def get_gi(self):
+        return int.from_bytes(self.gi_brightness, "big")
+
+
+def load_decoder():
+    # Load a fresh copy of powermon_viper, so no state of a previous run is kept
+    import importlib
+    import powermon_viper
+    return importlib.reload(powermon_viper)
+
+
+def run_decoder(pv, times, kinds, values, start_us=0):
+    # Runs updateloop() of the given module over an event stream. Readiness
+    # is measured from start_us.
+    import rp2
+    import utime
+
+    bus = _ReplayBus(pv, times, kinds, values)
+
+    pv.datamachine = rp2.StateMachine(1, pv.read_data)
+    pv.datamachine.attach(_ReplayFIFO(bus, EV_DATA))
+    pv.zcmachine = rp2.StateMachine(2, pv.wait_zerocrossing)
+    pv.zcmachine.attach(_ReplayFIFO(bus, EV_ZC))
+
+    utime.set_time_source(lambda: bus.now)
+    pv.readyinfo[pv.RD_START] = int(start_us)
+    pv.readyinfo[pv.RD_READY] = 0
+    pv.readyinfo[pv.RD_TIME_US] = 0
+    pv.readyinfo[pv.RD_SEEN] = 0
+    pv.running = True
+    pv.finished = False
+    try:
+        pv.updateloop()
+    finally:
+        utime.set_time_source(None)
+        pv.running = False
+    bus.record_changes()
+    return bus
+
+
+def replay(capture, sample_delay_us=SAMPLE_DELAY_US, decoder=None,
+           paired=False, stamped=False):
+    # Replays a Capture (see hostsim.lpf) through updateloop(). With paired,
+    # the data words are the ones read_data_paired pushes. With stamped, the
+    # zero cross FIFO gets the words of stamp_zc_triacs.
+    word_times, words, zc_times = decode_words(capture, sample_delay_us)
+    stamps = None
+    if stamped:
+        stamps = stamp_words(capture)
+    return replay_words(word_times, words, zc_times, decoder, paired, stamps)
+
+
+def replay_words(word_times, words, zc_times, decoder=None, paired=False,
+                 stamps=None, start_us=0):
+    # Replays bus words and zero crossings (e.g. from a .wpcc file, see
+    # hostsim.capture). stamps: (times, words) of stamp_zc_triacs, True to
+    # derive them from the bus words. ready_us is the time from start_us
+    # until the decoder was ready, None for the first record.
+    zc_words = None
+    zero_crossings = len(zc_times)
+    if stamps is True:
+        stamps = stamp_words_from_bus(word_times, words, zc_times)
+    if stamps is not None:
+        zc_times, zc_words = stamps
+
+    if decoder is None:
+        decoder = load_decoder()
+    if paired:
+        word_times, words = pair_words(word_times, words,
+                                       decoder.read_data_paired)
+    decoder.gi_stamped = stamps is not None
+    times, kinds, values = merge_events(word_times, words, zc_times, zc_words)
+    if start_us is None:
+        start_us = times[0] if len(times) else 0
+    bus = run_decoder(decoder, times, kinds, values, start_us)
+
+    return ReplayResult(lamps=bytes(decoder.lamps),
+                        solenoids=bytes(decoder.solenoids),
+                        gi_brightness=bytes(decoder.gi_brightness),
+                        timeline=bus.timeline,
+                        word_times=word_times,
+                        words=words,
+                        zc_times=zc_times,
+                        stats={
+                            "words": len(words),
+                            "zero_crossings": zero_crossings,
+                            "update_counter": decoder.update_counter,
+                            "address_errors": decoder.address_errors,
+                            "overflow": decoder.overflow,
+                            "ready_us": (decoder.readyinfo[decoder.RD_TIME_US]
+                                         if decoder.readyinfo[decoder.RD_READY]
+                                         else None),
+                            })
+
+
+def replay_file(path, channel_map=lpf.LPF_CHANNELS,
+                sample_delay_us=SAMPLE_DELAY_US):
+    return replay(lpf.read_lpf(path, channel_map), sample_delay_us)
+
+
+def verify_paired(capture, sample_delay_us=SAMPLE_DELAY_US):
+    # Replays a capture with read_data and read_data_paired. Returns
+    # (ok, legacy, paired), ok is True if the final state and all state
+    # changes are the same.
+    legacy = replay(capture, sample_delay_us)
+    paired = replay(capture, sample_delay_us, paired=True)
+    ok = (legacy.lamps == paired.lamps and
+          legacy.solenoids == paired.solenoids and
+          legacy.gi_brightness == paired.gi_brightness and
+          legacy.timeline == paired.timeline)
+    return ok, legacy, paired
+
+
+def _lamp_words(words):
+    addresses = (words >> 8) & CTL_MASK
+    return int(np.count_nonzero((addresses == 32) | (addresses == 64) |
+                                (words > DATA_MASK)))
+
+
+def print_result(res, timeline=False):
+    print(res.stats)
+    if timeline:
+        for (t, kind, index, old, new) in res.timeline:
+            print("{:12.1f}us {:8} {} {:0>8b} -> {:0>8b}".format(t, kind, index,
+                                                                old, new))
+    print("Lamps:     {0:0>64b}".format(res.get_lamps()))
+    print("Solenoids: {0:0>32b}".format(res.get_solenoids()))
+    print("GI:        {0:0>10X}".format(res.get_gi()))
+
+
+def main(argv):
+    import argparse
+    import time
+    from hostsim.capture import CaptureFile, EXTENSION
+
+    parser = argparse.ArgumentParser(description="Replay WPC bus captures")
+    parser.add_argument("files", nargs="+",
+                        help="LPF or .wpcc capture files")
+    parser.add_argument("-t", "--timeline", action="store_true",
+                        help="print all state changes")
+    parser.add_argument("--direct", action="store_true",
+                        help="channels D0-D15 are connected to GPIO 0-15")
+    parser.add_argument("--delay", type=float, default=SAMPLE_DELAY_US,
+                        help="data sample delay after the clock edge (us)")
+    parser.add_argument("--paired", action="store_true",
+                        help="use read_data_paired for the data words")
+    parser.add_argument("--stamped", action="store_true",
+                        help="use stamp_zc_triacs for zero crossings/triacs")
+    parser.add_argument("--start", type=float, default=0,
+                        help="start of the replay in ms (.wpcc)")
+    parser.add_argument("--length", type=float, default=None,
+                        help="length of the replay in ms (.wpcc)")
+    parser.add_argument("--verify-paired", action="store_true",
+                        help="check that read_data_paired decodes the same")
+    args = parser.parse_args(argv)
+
+    channel_map = lpf.LPF_CHANNELS
+    if args.direct:
+        channel_map = lpf.DIRECT_CHANNELS
+
+    failed = False
+    for path in args.files:
+        if args.verify_paired:
+            capture = lpf.read_lpf(path, channel_map)
+            ok, legacy, paired = verify_paired(capture, args.delay)
+            print("{}: {}, {} state changes, lamp words {} -> {}".format(
+                capture.name, "same result" if ok else "MISMATCH",
+                len(legacy.timeline), _lamp_words(legacy.words),
+                _lamp_words(paired.words)))
+            failed = failed or not ok
+            continue
+
+        if path.endswith(EXTENSION):
+            start = time.perf_counter()
+            cap = CaptureFile(path)
+            start_us = args.start * 1000
+            end_us = None
+            if args.length is not None:
+                end_us = start_us + args.length * 1000
+            word_times, words, zc_times = cap.events(start_us, end_us)
+            # A slice is ready relative to its first record, not to the start
+            # of the capture
+            res = replay_words(word_times, words, zc_times,
+                               paired=args.paired, stamps=args.stamped or None,
+                               start_us=None if args.start else 0)
+            elapsed = time.perf_counter() - start
+            print("{}: {:.0f}us of {:.0f}us replayed in {:.3f}s".format(
+                cap.name, (word_times[-1] - word_times[0]) if len(words) else 0,
+                cap.duration_us, elapsed))
+            print_result(res, args.timeline)
+            continue
+
+        start = time.perf_counter()
+        capture = lpf.read_lpf(path, channel_map)
+        res = replay(capture, args.delay, paired=args.paired,
+                     stamped=args.stamped)
+        elapsed = time.perf_counter() - start
+        print("{}: {:.0f}us captured, decoded in {:.3f}s".format(
+            capture.name, capture.duration_us, elapsed))
+        print_result(res, args.timeline)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
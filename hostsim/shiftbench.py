@@ -0,0 +1,164 @@
+# Shift register output check and benchmark
+#
+# Drives shiftout.ShiftOutput with random mappings and random states into the
+# SPI stand-in, checks every output against a shift register chain model and
+# reports the time per update (with and without a change of a mapped input):
+#
+#   python3 -m hostsim.shiftbench [outputs ...]
+#   micropython -m hostsim.shiftbench [outputs ...]
+#
+# The numbers depend on the host, compare them on the same machine only. On
+# CPython, viper functions run as plain Python with emulated pointers.
+
+import random
+import sys
+
+import hostsim
+hostsim.install()
+
+import machine
+import utime
+
+import shiftout
+
+OUTPUTS = (8, 32, 64, 128)
+UPDATES = 500
+
+
+class FakeMonitor():
+
+    def __init__(self):
+        self.state = bytearray(shiftout.STATE_SIZE)
+        self.seq = 0
+
+    def set(self, state):
+        self.state[:] = state
+        self.seq += 1
+
+    def snapshot(self, buf=None):
+        if buf is None:
+            buf = bytearray(shiftout.STATE_SIZE)
+        buf[:] = self.state
+        return self.seq, buf
+
+
+def chain_outputs(data, outputs):
+    # Output levels of a chain of 74HC595 after shifting data in MSB first:
+    # the last byte ends up in the first register
+    levels = []
+    for output in range(outputs):
+        byte = data[len(data) - 1 - output // 8]
+        levels.append((byte >> (output & 7)) & 1)
+    return levels
+
+
+def expected_outputs(sources, state, thresholds, invert):
+    levels = []
+    for output, source in enumerate(sources):
+        if source is None:
+            v = 0
+        elif source >> 3 == shiftout.IN_GI:
+            gi = source & 7
+            v = 1 if state[shiftout.STATE_GI + gi] >= thresholds[gi] else 0
+        else:
+            v = (state[source >> 3] >> (source & 7)) & 1
+        levels.append(v ^ 1 if invert else v)
+    return levels
+
+
+def make_output(outputs, rnd, invert=False):
+    pm = FakeMonitor()
+    spi = machine.SPI(0)
+    latch = machine.Pin(22, machine.Pin.OUT)
+    out = shiftout.ShiftOutput(pm, spi, outputs=outputs, latch=latch,
+                               invert=invert)
+    for output in range(outputs):
+        kind = rnd.randrange(10)
+        if kind < 5:
+            out.map_lamp(rnd.randrange(64), output)
+        elif kind < 8:
+            out.map_solenoid(rnd.randrange(32), output)
+        elif kind < 9:
+            out.map_gi(rnd.randrange(shiftout.GI_NUM), output,
+                       rnd.randrange(1, 9))
+    return pm, spi, out
+
+
+def random_state(rnd, state):
+    state = bytearray(state)
+    for i in range(rnd.randrange(1, 4)):
+        b = rnd.randrange(shiftout.STATE_SIZE)
+        if b >= shiftout.STATE_GI:
+            state[b] = rnd.randrange(9)
+        else:
+            state[b] ^= 1 << rnd.randrange(8)
+    return state
+
+
+def check(outputs, updates=UPDATES, seed=1):
+    # Returns the number of updates where the outputs were wrong or an
+    # unchanged mapping was written
+    rnd = random.Random(seed)
+    errors = 0
+    for invert in (False, True):
+        pm, spi, out = make_output(outputs, rnd, invert)
+        out.compile()
+        state = bytearray(shiftout.STATE_SIZE)
+        for i in range(updates):
+            state = random_state(rnd, state)
+            pm.set(state)
+            before = spi.last
+            written = out.update()
+            want = expected_outputs(out.sources, state, out.thresholds, invert)
+            if chain_outputs(spi.last, outputs) != want:
+                errors += 1
+            if not written and spi.last != before:
+                errors += 1
+            if written and chain_outputs(before, outputs) == want:
+                errors += 1
+    return errors
+
+
+def bench(outputs, updates=UPDATES, seed=2):
+    # Returns (us per update with a change, us per update without a change,
+    # pairs)
+    rnd = random.Random(seed)
+    pm, spi, out = make_output(outputs, rnd)
+    out.compile()
+    states = []
+    state = bytearray(shiftout.STATE_SIZE)
+    for i in range(updates):
+        # Lamp column 0 usually has mapped bits
+        state = bytearray(state)
+        state[0] ^= 0xff
+        states.append(state)
+
+    start = utime.ticks_us()
+    for state in states:
+        pm.set(state)
+        out.update()
+    changed = utime.ticks_diff(utime.ticks_us(), start) / updates
+
+    start = utime.ticks_us()
+    for i in range(updates):
+        out.update()
+    unchanged = utime.ticks_diff(utime.ticks_us(), start) / updates
+    return changed, unchanged, out.get_stats()["pairs"]
+
+
+def main(argv):
+    counts = [int(a) for a in argv] or OUTPUTS
+    print("{:>8} {:>7} {:>7} {:>12} {:>14}".format(
+        "outputs", "pairs", "errors", "changed us", "unchanged us"))
+    failed = False
+    for n in counts:
+        errors = check(n)
+        changed, unchanged, pairs = bench(n)
+        failed = failed or errors
+        print("{:>8} {:>7} {:>7} {:>12.1f} {:>14.1f}".format(
+            n, pairs, errors, changed, unchanged))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,454 @@
+# Simulated PIO backend for the power monitor
+#
+# Provides stand-ins for the parts of the Pico the poller depends on:
+#
+# SimFIFO:       RX FIFO of a state machine, fed by synthetic traffic. Words
+#                arrive at their scheduled time. If the FIFO is full, the state
+#                machine would stall and miss bus cycles, so the word is dropped.
+# SimClock:      utime replacement, runs on the host clock (optionally scaled)
+# InlineThreads: _thread replacement that runs "threads" inline when run() is
+#                called, so a poller run is deterministic
+#
+# Traffic is generated by make_traffic() with a configurable rate and burst
+# shape. Everything here runs on CPython and on the unix port of MicroPython.
+#
+#   import hostsim.sim as sim
+#   res = sim.run_poller("powermon_viper", sim.make_traffic(100000, 20000))
+
+import sys
+
+import hostsim
+hostsim.install()
+
+import rp2
+import utime
+
+# Joined RX FIFO of the data state machine and (not joined) FIFO of the zero
+# cross state machine
+FIFO_DEPTH = 8
+ZC_FIFO_DEPTH = 4
+
+# A transfer on the WPC bus takes about 400ns, add some time between two
+# transfers
+BUS_CYCLE_US = 1.0
+
+# Zero crossings per second (2x mains frequency)
+ZC_RATE = 100
+
+SHAPE_UNIFORM = "uniform"
+SHAPE_BURST = "burst"
+SHAPE_POISSON = "poisson"
+SHAPES = (SHAPE_UNIFORM, SHAPE_BURST, SHAPE_POISSON)
+
+# Bus addresses (see powermon_viper.py)
+A_TRIACS = 1
+A_SOL1 = 2
+A_SOL3 = 4
+A_SOL4 = 8
+A_SOL2 = 16
+A_LCOL = 32
+A_LROW = 64
+
+# jmp pin of read_data_paired
+LCOL_PIN = 13
+
+
+def load_build(name, config=None):
+    # Import a fresh copy of a poller module, no state of a previous run is kept.
+    # config is a dict of module globals to set (e.g. {"ingest_burst": 1})
+    if name in sys.modules:
+        del sys.modules[name]
+    pv = __import__(name)
+    if config:
+        for key in config:
+            setattr(pv, key, config[key])
+    return pv
+
+
+def parse_build(spec):
+    # "module:name=value,name=value" -> (module, config)
+    if ":" not in spec:
+        return spec, None
+    name, settings = spec.split(":", 1)
+    config = {}
+    for item in settings.split(","):
+        key, value = item.split("=", 1)
+        config[key] = int(value)
+    return name, config
+
+
+class Random():
+    # xorshift32, the same sequence on CPython and MicroPython
+
+    def __init__(self, seed=1):
+        self.state = (seed & 0xffffffff) or 1
+
+    def next(self):
+        x = self.state
+        x ^= (x << 13) & 0xffffffff
+        x ^= x >> 17
+        x ^= (x << 5) & 0xffffffff
+        self.state = x
+        return x
+
+    def random(self):
+        return self.next() / 4294967296.0
+
+    def bits(self, n):
+        return self.next() >> (32 - n)
+
+
+class SimClock():
+    # Microseconds since start(), taken from the host clock. With scale < 1 the
+    # simulated bus runs slower than the host, which can be used to model a
+    # slower CPU.
+
+    TICKS_MAX = (1 << 30) - 1
+    TICKS_HALFPERIOD = 1 << 29
+
+    def __init__(self, scale=1.0):
+        self.scale = scale
+        self.t0 = utime.ticks_us()
+
+    def start(self):
+        self.t0 = utime.ticks_us()
+
+    def now_us(self):
+        return utime.ticks_diff(utime.ticks_us(), self.t0) * self.scale
+
+    # utime API used by the poller
+    def ticks_us(self):
+        return int(self.now_us()) & self.TICKS_MAX
+
+    def ticks_ms(self):
+        return int(self.now_us() / 1000) & self.TICKS_MAX
+
+    def ticks_add(self, ticks, delta):
+        return (ticks + delta) & self.TICKS_MAX
+
+    def ticks_diff(self, ticks1, ticks2):
+        return ((ticks1 - ticks2 + self.TICKS_HALFPERIOD) & self.TICKS_MAX) \
+            - self.TICKS_HALFPERIOD
+
+    def sleep(self, seconds):
+        utime.sleep(seconds)
+
+    def sleep_ms(self, ms):
+        utime.sleep_ms(ms)
+
+    def sleep_us(self, us):
+        utime.sleep_us(us)
+
+
+class SimLock():
+
+    def __init__(self):
+        self.locked_ = False
+        self.acquired = 0
+
+    def acquire(self, waitflag=1, timeout=-1):
+        if self.locked_:
+            if not waitflag:
+                return False
+            # There is only one thread, waiting would block forever
+            raise RuntimeError("deadlock: lock already acquired")
+        self.locked_ = True
+        self.acquired += 1
+        return True
+
+    def release(self):
+        if not self.locked_:
+            raise RuntimeError("release unlocked lock")
+        self.locked_ = False
+
+    def locked(self):
+        return self.locked_
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class InlineThreads():
+    # Stand-in for _thread
+
+    def __init__(self):
+        self.pending = []
+        self.started = 0
+
+    def allocate_lock(self):
+        return SimLock()
+
+    def start_new_thread(self, func, args):
+        self.pending.append((func, args))
+        self.started += 1
+        return self.started
+
+    def get_ident(self):
+        return 1
+
+    def run(self):
+        while self.pending:
+            func, args = self.pending.pop(0)
+            func(*args)
+
+
+class SimFIFO():
+    # RX FIFO of a state machine fed from a list of (time, word) pairs
+
+    def __init__(self, times, words, depth=FIFO_DEPTH, clock=None):
+        self.times = times
+        self.words = words
+        self.depth = depth
+        self.clock = clock
+        self.pos = 0
+
+        self.fifo = [0] * depth
+        self.head = 0
+        self.count = 0
+
+        self.delivered = 0
+        self.dropped = 0
+        self.consumed = 0
+        self.max_depth = 0
+        self.on_done = None
+
+    def done(self):
+        return self.pos >= len(self.times) and not self.count
+
+    def advance(self):
+        now = self.clock.now_us()
+        times = self.times
+        n = len(times)
+        while self.pos < n and times[self.pos] <= now:
+            if self.count < self.depth:
+                self.fifo[(self.head + self.count) % self.depth] = self.words[self.pos]
+                self.count += 1
+                self.delivered += 1
+            else:
+                # The state machine stalls on a full FIFO and misses this transfer
+                self.dropped += 1
+            self.pos += 1
+        if self.count > self.max_depth:
+            self.max_depth = self.count
+
+    def rx_fifo(self):
+        self.advance()
+        if self.on_done is not None and self.done():
+            self.on_done()
+        return self.count
+
+    def get(self):
+        # Blocks like StateMachine.get() until a word is available
+        while not self.count:
+            if self.pos >= len(self.times):
+                raise RuntimeError("get() on empty FIFO without further traffic")
+            self.advance()
+        w = self.fifo[self.head]
+        self.head = (self.head + 1) % self.depth
+        self.count -= 1
+        self.consumed += 1
+        return w
+
+
+class FloodFIFO():
+    # A FIFO that is always full, used to measure the maximum throughput
+
+    def __init__(self, words, count, depth=FIFO_DEPTH):
+        self.words = words
+        self.count = count
+        self.depth = depth
+        self.consumed = 0
+        self.on_done = None
+
+    def rx_fifo(self):
+        if self.consumed >= self.count:
+            if self.on_done is not None:
+                self.on_done()
+            return 0
+        return self.depth
+
+    def get(self):
+        w = self.words[self.consumed % len(self.words)]
+        self.consumed += 1
+        return w
+
+
+class Traffic():
+    # times:    arrival time of each data word (us)
+    # words:    15-bit words as pushed by read_data
+    # zc_times: arrival time of each zero crossing (us)
+
+    def __init__(self, times, words, zc_times, rate=0, shape=""):
+        self.times = times
+        self.words = words
+        self.zc_times = zc_times
+        self.rate = rate
+        self.shape = shape
+
+    def __len__(self):
+        return len(self.words)
+
+    def duration_us(self):
+        if not self.times:
+            return 0
+        return self.times[-1]
+
+
+def wpc_words(n, seed=1, change_rate=0.05):
+    # A sequence of bus words that looks like WPC traffic: the row transfers at
+    # the end of a cycle and lamp columns with their row data, followed by the
+    # solenoid groups and the triacs after each scan of the matrix. Lamp rows
+    # and solenoids change randomly.
+    rnd = Random(seed)
+    rows = bytearray(8)
+    sols = bytearray(4)
+    sol_addr = (A_SOL1, A_SOL2, A_SOL3, A_SOL4)
+    triacs = 0x1f
+    words = []
+    while True:
+        for col in range(8):
+            if rnd.random() < change_rate:
+                rows[col] ^= 1 << rnd.bits(3)
+            words.append((A_LROW << 8) | 0x8f)
+            words.append(A_LROW << 8)
+            words.append((A_LCOL << 8) | (1 << col))
+            words.append((A_LROW << 8) | rows[col])
+        for i in range(4):
+            if rnd.random() < change_rate:
+                sols[i] ^= 1 << rnd.bits(3)
+            words.append((sol_addr[i] << 8) | sols[i])
+        words.append((A_TRIACS << 8) | triacs)
+        if len(words) >= n:
+            return words[:n]
+
+
+def make_times(rate, n, shape=SHAPE_UNIFORM, burst=8, burst_gap_us=BUS_CYCLE_US,
+               seed=1):
+    # Arrival times for n words with an average rate (words/s)
+    period = 1000000.0 / rate
+    times = []
+    if shape == SHAPE_UNIFORM:
+        for i in range(n):
+            times.append(i * period)
+    elif shape == SHAPE_BURST:
+        # "burst" words back-to-back, then a pause to reach the average rate
+        burst_period = period * burst
+        for i in range(n):
+            times.append((i // burst) * burst_period + (i % burst) * burst_gap_us)
+    elif shape == SHAPE_POISSON:
+        import math
+        rnd = Random(seed)
+        t = 0.0
+        for i in range(n):
+            times.append(t)
+            t += -math.log(1.0 - rnd.random()) * period
+    else:
+        raise ValueError("unknown traffic shape " + str(shape))
+    return times
+
+
+def make_traffic(rate, n, shape=SHAPE_UNIFORM, burst=8,
+                 burst_gap_us=BUS_CYCLE_US, zc_rate=ZC_RATE, seed=1):
+    times = make_times(rate, n, shape, burst, burst_gap_us, seed)
+    words = wpc_words(n, seed)
+    zc_times = []
+    if zc_rate and times:
+        t = 0.0
+        while t <= times[-1]:
+            zc_times.append(t)
+            t += 1000000.0 / zc_rate
+    return Traffic(times, words, zc_times, rate, shape)
+
+
+def pair_traffic(traffic, program):
+    # The traffic as a data program that pairs lamp columns and rows
+    # (read_data_paired) pushes it. Words the program drops or holds back are
+    # removed, the others keep their arrival time.
+    from hostsim import pio
+    indices, words = pio.run_bus_words(program, traffic.words,
+                                       jmp_pin=LCOL_PIN)
+    times = [traffic.times[i] for i in indices]
+    return Traffic(times, words, traffic.zc_times, traffic.rate, traffic.shape)
+
+
+def plug(pv, clock=None, threads=None):
+    # Replace utime and _thread of a poller module with the simulated versions
+    if clock is not None:
+        pv.utime = clock
+    if threads is not None:
+        pv._thread = threads
+        for name in dir(pv):
+            if name.endswith("_lock"):
+                setattr(pv, name, threads.allocate_lock())
+
+
+def attach(pv, data_source, zc_source):
+    # Create the state machines of a poller module with the given FIFO sources
+    pv.datamachine = rp2.StateMachine(1, pv.read_data)
+    pv.datamachine.attach(data_source)
+    pv.zcmachine = rp2.StateMachine(2, pv.wait_zerocrossing)
+    pv.zcmachine.attach(zc_source)
+
+
+def _run(pv, clock, data, zc):
+    def stop():
+        pv.running = False
+
+    data.on_done = stop
+    threads = InlineThreads()
+    plug(pv, clock, threads)
+    attach(pv, data, zc)
+
+    pv.running = True
+    pv.finished = False
+    threads.start_new_thread(pv.updateloop, ())
+    clock.start()
+    threads.run()
+    return clock.now_us()
+
+
+def run_poller(build, traffic, scale=1.0, config=None):
+    # Runs the poller of a build (module name) against the traffic. Returns a
+    # dict with the results.
+    pv = load_build(build, config)
+    clock = SimClock(scale)
+    data = SimFIFO(traffic.times, traffic.words, FIFO_DEPTH, clock)
+    zc = SimFIFO(traffic.zc_times, [0] * len(traffic.zc_times), ZC_FIFO_DEPTH,
+                 clock)
+
+    elapsed = _run(pv, clock, data, zc)
+
+    n = len(traffic)
+    return {
+        "build": build,
+        "shape": traffic.shape,
+        "rate": traffic.rate,
+        "words": n,
+        "consumed": data.consumed,
+        "dropped": data.dropped,
+        "drop_rate": data.dropped / n if n else 0,
+        "max_depth": data.max_depth,
+        "max_fifo": pv.max_fifo,
+        "overflow": pv.overflow,
+        "ring_overruns": getattr(pv, "ring_overruns", 0),
+        "zc_dropped": zc.dropped,
+        "elapsed_us": elapsed,
+        "module": pv,
+        }
+
+
+def run_flood(build, n, scale=1.0, config=None):
+    # Runs the poller with a FIFO that is always full, returns words/s
+    pv = load_build(build, config)
+    clock = SimClock(scale)
+    data = FloodFIFO(wpc_words(1024), n)
+    zc = SimFIFO([], [], ZC_FIFO_DEPTH, clock)
+
+    elapsed = _run(pv, clock, data, zc)
+    if elapsed <= 0:
+        return 0
+    return data.consumed * 1000000.0 / elapsed
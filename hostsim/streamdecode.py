@@ -0,0 +1,306 @@
+# Decoder for the state stream of stream.py
+#
+# Decodes the frames StateStreamer sends over a UART and rebuilds the state
+# (lamps, solenoids, GI) on the PC:
+#
+#   python3 -m hostsim.streamdecode /dev/ttyUSB0 --baud 115200
+#
+# With --loopback, a capture is replayed through the decoder, the state changes
+# are streamed by StateStreamer into a pty and decoded from the other end of the
+# pty. The decoded state is compared with the state the streamer sent after
+# every write. --corrupt N flips a bit in the CRC of every Nth frame to check
+# that the decoder drops the frames until the next key frame and resyncs:
+#
+#   python3 -m hostsim.streamdecode --loopback logicanalyzer/wpcpower.LPF
+#   python3 -m hostsim.streamdecode --loopback --corrupt 10 logicanalyzer/wpcpower.LPF
+
+import binascii
+import os
+import select
+import sys
+
+import hostsim
+hostsim.install()
+
+import stream
+
+STATE_OFFSETS = {"lamp": 0, "solenoid": 8, "gi": 12}
+
+
+class StreamDecoder():
+    # feed() returns a list of (seq, keyframe, state) for every frame that was
+    # applied. Delta frames are only applied if the previous frame has been
+    # received, otherwise the decoder waits for the next key frame.
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.state = bytearray(stream.STREAM_STATE_SIZE)
+        self.synced = False
+        self.seq = None
+        self.frames = 0
+        self.keyframes = 0
+        self.crc_errors = 0
+        self.gaps = 0
+        self.ignored = 0
+        self.skipped = 0
+
+    def _skip(self, n):
+        self.skipped += n
+        del self.buf[:n]
+
+    def feed(self, data):
+        self.buf.extend(data)
+        buf = self.buf
+        applied = []
+        while True:
+            i = buf.find(stream.STREAM_MAGIC)
+            if i < 0:
+                self._skip(len(buf))
+                break
+            if i > 0:
+                self._skip(i)
+            if len(buf) < stream.F_DATA:
+                break
+
+            ftype = buf[stream.F_TYPE]
+            bitmap = int.from_bytes(buf[stream.F_BITMAP:stream.F_DATA], "little")
+            if (ftype not in (stream.FRAME_DELTA, stream.FRAME_KEY) or
+                    bitmap >> stream.STREAM_STATE_SIZE):
+                self._skip(1)
+                continue
+            end = stream.F_DATA + bin(bitmap).count("1")
+            if len(buf) < end + stream.FRAME_CRC_SIZE:
+                break
+            crc = buf[end] | buf[end+1] << 8
+            if binascii.crc_hqx(bytes(buf[stream.F_TYPE:end]), 0xffff) != crc:
+                self.crc_errors += 1
+                self._skip(1)
+                continue
+
+            seq = buf[stream.F_SEQ] | buf[stream.F_SEQ+1] << 8
+            data = buf[stream.F_DATA:end]
+            del buf[:end + stream.FRAME_CRC_SIZE]
+            self.frames += 1
+
+            if ftype == stream.FRAME_KEY:
+                self.keyframes += 1
+                self.synced = True
+            elif not self.synced:
+                self.ignored += 1
+                continue
+            elif seq != (self.seq + 1) & 0xffff:
+                self.gaps += 1
+                self.ignored += 1
+                self.synced = False
+                continue
+
+            p = 0
+            for b in range(stream.STREAM_STATE_SIZE):
+                if bitmap & (1 << b):
+                    self.state[b] = data[p]
+                    p += 1
+            self.seq = seq
+            applied.append((seq, ftype == stream.FRAME_KEY, bytes(self.state)))
+        return applied
+
+    def get_stats(self):
+        return {
+            "frames": self.frames,
+            "keyframes": self.keyframes,
+            "crc_errors": self.crc_errors,
+            "gaps": self.gaps,
+            "ignored": self.ignored,
+            "skipped_bytes": self.skipped,
+            }
+
+
+def format_state(state):
+    return "lamps {} solenoids {} gi {}".format(state[0:8].hex(),
+                                               state[8:12].hex(),
+                                               state[12:17].hex())
+
+
+class _TimelineMonitor():
+    # Serves the state of a replay timeline through snapshot()
+
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.pos = 0
+        self.seq = 0
+        self.state = bytearray(stream.STREAM_STATE_SIZE)
+
+    def advance(self, time_us):
+        while (self.pos < len(self.timeline) and
+               self.timeline[self.pos][0] <= time_us):
+            t, kind, index, old, new = self.timeline[self.pos]
+            self.state[STATE_OFFSETS[kind] + index] = new
+            self.seq += 1
+            self.pos += 1
+
+    def done(self):
+        return self.pos >= len(self.timeline)
+
+    def snapshot(self, buf=None):
+        if buf is None:
+            buf = bytearray(stream.STREAM_STATE_SIZE)
+        buf[:] = self.state
+        return self.seq, buf
+
+
+class _CorruptingUART():
+    # Flips a bit in the CRC of every Nth frame written, the same frames are
+    # corrupted on every run. The writes of StateStreamer hold whole frames.
+
+    def __init__(self, uart, every):
+        self.uart = uart
+        self.every = every
+        self.frames = 0
+        self.corrupted = []
+
+    def write(self, buf):
+        data = bytearray(buf)
+        p = 0
+        while p < len(data):
+            bitmap = int.from_bytes(data[p+stream.F_BITMAP:p+stream.F_DATA],
+                                    "little")
+            end = p + stream.F_DATA + bin(bitmap).count("1")
+            self.frames += 1
+            if self.frames % self.every == 0:
+                data[end] ^= 0x01
+                self.corrupted.append(data[p+stream.F_SEQ] |
+                                      data[p+stream.F_SEQ+1] << 8)
+            p = end + stream.FRAME_CRC_SIZE
+        return self.uart.write(data)
+
+
+def _read_available(fd):
+    data = bytearray()
+    while select.select([fd], [], [], 0)[0]:
+        data.extend(os.read(fd, 4096))
+    return data
+
+
+def loopback(path, budget=stream.STREAM_BUDGET, poll_ms=5, corrupt=0):
+    # Returns (ok, results): ok is False if a decoded state differed from the
+    # state that was sent
+    import tty
+    import machine
+    import utime
+    from hostsim import lpf, replay
+
+    res = replay.replay(lpf.read_lpf(path))
+    monitor = _TimelineMonitor(res.timeline)
+
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    uart = machine.UART(0)
+    uart.attach(master)
+    out = uart
+    if corrupt:
+        out = _CorruptingUART(uart, corrupt)
+
+    now_us = 0
+    utime.set_time_source(lambda: now_us)
+    try:
+        streamer = stream.StateStreamer(monitor, out, budget=budget)
+        decoder = StreamDecoder()
+        mismatches = 0
+        checks = 0
+        # Run until the whole timeline has been sent and one more key frame
+        while True:
+            monitor.advance(now_us)
+            streamer.poll(utime.ticks_ms())
+            # The decoder is only checked once it has the last frame sent, a
+            # corrupt last frame is noticed with the next one
+            current = False
+            if streamer.batchlen == 0:
+                decoder.feed(_read_available(slave))
+                current = (decoder.synced and
+                           decoder.seq == (streamer.seq - 1) & 0xffff)
+                if current:
+                    checks += 1
+                    if decoder.state != streamer.sent:
+                        mismatches += 1
+            if (monitor.done() and streamer.sent == monitor.state and
+                    streamer.keyframes > 1 and current):
+                break
+            now_us += poll_ms * 1000
+    finally:
+        utime.set_time_source(None)
+        os.close(master)
+        os.close(slave)
+
+    duration = now_us / 1000000
+    results = {
+        "changes": len(res.timeline),
+        "duration_s": duration,
+        "stream": streamer.get_stats(),
+        "decoder": decoder.get_stats(),
+        "bytes_per_s": streamer.bytes / duration if duration else 0,
+        "checks": checks,
+        "mismatches": mismatches,
+        }
+    if corrupt:
+        results["corrupted_frames"] = len(out.corrupted)
+    ok = mismatches == 0 and decoder.state == monitor.state
+    return ok, results
+
+
+def open_port(path, baud):
+    import termios
+    import tty
+    fd = os.open(path, os.O_RDONLY | os.O_NOCTTY)
+    tty.setraw(fd)
+    attrs = termios.tcgetattr(fd)
+    speed = getattr(termios, "B{}".format(baud))
+    attrs[4] = speed
+    attrs[5] = speed
+    termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    return fd
+
+
+def read_port(path, baud):
+    fd = open_port(path, baud)
+    decoder = StreamDecoder()
+    previous = None
+    try:
+        while True:
+            for seq, key, state in decoder.feed(os.read(fd, 256)):
+                if state != previous:
+                    print("{:5d}{} {}".format(seq, "K" if key else " ",
+                                              format_state(state)))
+                    previous = state
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(fd)
+    print(decoder.get_stats())
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("source", help="serial port or LPF capture (--loopback)")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--loopback", action="store_true",
+                        help="stream a capture through a pty and verify it")
+    parser.add_argument("--budget", type=int, default=stream.STREAM_BUDGET,
+                        help="bytes per second (loopback)")
+    parser.add_argument("--corrupt", type=int, default=0,
+                        help="corrupt every Nth frame (loopback)")
+    args = parser.parse_args(argv)
+
+    if not args.loopback:
+        read_port(args.source, args.baud)
+        return 0
+
+    ok, results = loopback(args.source, args.budget, corrupt=args.corrupt)
+    for key, value in results.items():
+        print("{}: {}".format(key, value))
+    print("OK" if ok else "MISMATCH")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
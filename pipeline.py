@@ -0,0 +1,256 @@
+from micropython import const
+from array import array
+import utime
+
+# Two core pipeline
+#
+# The poller thread runs on the second core and only reads and decodes the bus
+# words. Every change of a lamp column, solenoid group or GI string goes into a
+# preallocated single producer/single consumer queue. The pipeline runs on the
+# first core (the main program), takes the changes from the queue in batches,
+# keeps its own copy of the state and runs the stages (rules, effects, outputs,
+# streaming) and the notify functions:
+#
+#   pipe = Pipeline()
+#   pipe.add_rules(engine)
+#   pipe.add_stage(lambda state, now: strip.update())
+#   pipe.add_stage(lambda state, now: streamer.poll(now), on_change=False)
+#   pm.start(pipeline=pipe)
+#   pipe.run()
+#
+# The poller never waits for the pipeline: if the queue is full, changes are
+# dropped and counted, the pipeline then copies the state from the
+# PowerMonitor (resync). get_stats() shows how close the queue got to that.
+#
+# Queue records use 2 words, like the event journal of the PowerMonitor:
+#   timestamp (utime.ticks_us)
+#   index << 16 | old << 8 | new   (index is the offset in the state)
+# The queue indices have the layout of the journal (EV_* of powermon_viper):
+# the producer only writes Q_HEAD, the consumer only Q_TAIL. Head and tail
+# count records and wrap at 32 bits.
+
+QUEUE_SIZE = const(256)     # records, must be a power of two
+Q_WORDS = const(2)
+Q_HEAD = const(0)
+Q_TAIL = const(1)
+Q_DROPS = const(2)
+Q_HIGH = const(3)
+Q_MASK = const(4)
+Q_FIELDS = const(5)
+PIPE_BATCH = const(32)
+
+STATE_SIZE = const(17)
+STATE_SOLENOIDS = const(8)
+STATE_GI = const(12)
+
+# Parts of the state that changed in a batch
+CHANGED_LAMPS = const(1)
+CHANGED_SOLENOIDS = const(2)
+CHANGED_GI = const(4)
+
+
+@micropython.viper
+def queue_push(buf: ptr32, idx: ptr32, timestamp: int, word: int) -> int:
+    # Returns 0 if the queue is full
+    head = idx[Q_HEAD]
+    mask = idx[Q_MASK]
+    depth = head - idx[Q_TAIL]
+    if depth > mask:
+        idx[Q_DROPS] = idx[Q_DROPS] + 1
+        return 0
+    if depth >= idx[Q_HIGH]:
+        idx[Q_HIGH] = depth + 1
+    pos = (head & mask) * Q_WORDS
+    buf[pos] = timestamp
+    buf[pos+1] = word
+    # Publish the record after it has been written
+    idx[Q_HEAD] = head + 1
+    return 1
+
+
+@micropython.viper
+def queue_pop(buf: ptr32, idx: ptr32, out: ptr32, n: int) -> int:
+    # Copies up to n records into out, returns the number of records
+    tail = idx[Q_TAIL]
+    mask = idx[Q_MASK]
+    count = idx[Q_HEAD] - tail
+    if count > n:
+        count = n
+    for i in range(count):
+        pos = ((tail + i) & mask) * Q_WORDS
+        out[i*Q_WORDS] = buf[pos]
+        out[i*Q_WORDS+1] = buf[pos+1]
+    # The records can be overwritten after this
+    idx[Q_TAIL] = tail + count
+    return count
+
+
+@micropython.viper
+def apply_changes(state: ptr8, records: ptr32, n: int) -> int:
+    # Applies n queue records to the state, returns CHANGED_* of the records
+    changed = 0
+    for i in range(n):
+        w = records[i*Q_WORDS+1]
+        index = w >> 16
+        state[index] = w & 0xff
+        if index < STATE_SOLENOIDS:
+            changed |= CHANGED_LAMPS
+        elif index < STATE_GI:
+            changed |= CHANGED_SOLENOIDS
+        else:
+            changed |= CHANGED_GI
+    return changed
+
+
+class SPSCQueue():
+    # Preallocated queue for one producer thread and one consumer thread
+
+    def __init__(self, size=QUEUE_SIZE):
+        if size < 1 or size & (size - 1):
+            raise ValueError("size must be a power of two")
+        self.size = size
+        self.buf = array('I', [0]*(size*Q_WORDS))
+        self.idx = array('I', [0]*Q_FIELDS)
+        self.idx[Q_MASK] = size - 1
+
+    def push(self, timestamp, word):
+        # Returns False if the queue is full
+        return queue_push(self.buf, self.idx, timestamp, word) != 0
+
+    def pop(self, out):
+        # Copies up to len(out)//Q_WORDS records into out (an array('I')),
+        # returns the number of records
+        return queue_pop(self.buf, self.idx, out, len(out) // Q_WORDS)
+
+    def __len__(self):
+        return (self.idx[Q_HEAD] - self.idx[Q_TAIL]) & 0xffffffff
+
+    def get_drops(self):
+        return self.idx[Q_DROPS]
+
+    def get_stats(self):
+        return {
+            "size": self.size,
+            "depth": len(self),
+            "high_water": self.idx[Q_HIGH],
+            "drops": self.idx[Q_DROPS],
+            }
+
+
+class Pipeline():
+
+    def __init__(self, queue_size=QUEUE_SIZE, batch=PIPE_BATCH):
+        # batch: records taken from the queue per poll()
+        self.queue = SPSCQueue(queue_size)
+        self.records = array('I', [0]*(batch*Q_WORDS))
+        self.batch = batch
+        self.state = bytearray(STATE_SIZE)
+        self.pm = None
+        self.stages = []
+        self.idle_stages = []
+        self.engines = []
+        self.lamp_notify = None
+        self.solenoid_notify = None
+        self.running = False
+        self.drops = 0
+        self.events = 0
+        self.batches = 0
+        self.full_batches = 0
+        self.resyncs = 0
+        self.max_lag_us = 0
+
+    def attach(self, pm):
+        # Called by PowerMonitor.start(pipeline)
+        self.pm = pm
+        self.resync()
+        for engine in self.engines:
+            engine.reset(self.state)
+
+    def add_stage(self, func, on_change=True):
+        # func(state, now) is called with the state (see
+        # PowerMonitor.snapshot()) and utime.ticks_ms() after changes, with
+        # on_change=False on every poll()
+        if on_change:
+            self.stages.append(func)
+        else:
+            self.idle_stages.append(func)
+
+    def add_rules(self, engine):
+        # Evaluates a RuleEngine on changes and fires its held rules
+        self.engines.append(engine)
+        engine.reset(self.state)
+        self.add_stage(engine.update)
+        self.add_stage(lambda state, now: engine.poll(now), on_change=False)
+
+    def set_lamp_notify(self, notify_func):
+        self.lamp_notify = notify_func
+
+    def set_solenoid_notify(self, notify_func):
+        self.solenoid_notify = notify_func
+
+    def resync(self):
+        # Discards the queue and copies the state from the PowerMonitor. The
+        # poller publishes a change before it queues it, so the copy has the
+        # discarded changes and the changes queued after this only repeat
+        # what the copy has or are newer. The rule engines see the difference
+        # to the last state as one change.
+        idx = self.queue.idx
+        idx[Q_TAIL] = idx[Q_HEAD]
+        if self.pm:
+            self.pm.snapshot(self.state)
+        self.drops = self.queue.get_drops()
+
+    def poll(self, now=None):
+        # Runs the stages for the changes in the queue, returns the number of
+        # changes
+        if now is None:
+            now = utime.ticks_ms()
+        records = self.records
+        state = self.state
+        n = queue_pop(self.queue.buf, self.queue.idx, records, self.batch)
+        changed = 0
+        if n:
+            changed = apply_changes(state, records, n)
+            self.events += n
+            self.batches += 1
+            if n == self.batch:
+                self.full_batches += 1
+            lag = utime.ticks_diff(utime.ticks_us(), records[0])
+            if lag > self.max_lag_us:
+                self.max_lag_us = lag
+        if self.queue.get_drops() != self.drops:
+            # Changes were lost
+            self.resync()
+            self.resyncs += 1
+            changed = CHANGED_LAMPS | CHANGED_SOLENOIDS | CHANGED_GI
+
+        if changed:
+            if changed & CHANGED_LAMPS and self.lamp_notify:
+                self.lamp_notify()
+            if changed & CHANGED_SOLENOIDS and self.solenoid_notify:
+                self.solenoid_notify()
+            for stage in self.stages:
+                stage(state, now)
+        for stage in self.idle_stages:
+            stage(state, now)
+        return n
+
+    def run(self, poll_ms=1):
+        # Runs the pipeline until stop() is called. The queue is drained
+        # before sleeping.
+        self.running = True
+        while self.running:
+            if self.poll() < self.batch:
+                utime.sleep_ms(poll_ms)
+
+    def stop(self):
+        self.running = False
+
+    def get_stats(self):
+        stats = self.queue.get_stats()
+        stats["events"] = self.events
+        stats["batches"] = self.batches
+        stats["full_batches"] = self.full_batches
+        stats["resyncs"] = self.resyncs
+        stats["max_lag_us"] = self.max_lag_us
+        return stats
@@ -0,0 +1,42 @@
+# Selects a variant of the poller
+#
+#   from powermon import PowerMonitor
+#   pm = PowerMonitor(build="release", stamp_gi=True)
+#
+# The variants are generated from powermon_viper.py by hostsim/build.py:
+#   release:       DEBUG=0, INSTRUMENT=0, no debug or instrumentation code
+#   instrumented:  DEBUG=1, INSTRUMENT=1, counters and histograms in get_stats()
+#   verbose:       DEBUG=2, INSTRUMENT=1, also prints every change
+# The variants are not in git, run python3 -m hostsim.build and copy the module
+# of the variant to the Pico. powermon_viper.py itself can be used as before,
+# it is the instrumented variant. If the module of a variant is missing,
+# load_build() falls back to powermon_viper.
+
+BUILD_RELEASE = "release"
+BUILD_INSTRUMENTED = "instrumented"
+BUILD_VERBOSE = "verbose"
+
+FALLBACK_MODULE = "powermon_viper"
+
+BUILDS = {
+    BUILD_RELEASE: "powermon_release",
+    BUILD_INSTRUMENTED: "powermon_instrumented",
+    BUILD_VERBOSE: "powermon_verbose",
+    }
+
+
+def load_build(build=BUILD_RELEASE):
+    # Returns the module of a variant
+    if build not in BUILDS:
+        raise ValueError("unknown build: " + str(build))
+    try:
+        return __import__(BUILDS[build])
+    except ImportError:
+        print("{}.py not found (generate it with python3 -m hostsim.build), "
+              "using {}.py".format(BUILDS[build], FALLBACK_MODULE))
+        return __import__(FALLBACK_MODULE)
+
+
+def PowerMonitor(build=BUILD_RELEASE, **kwargs):
+    # Creates the PowerMonitor of a variant, kwargs are passed to it
+    return load_build(build).PowerMonitor(**kwargs)
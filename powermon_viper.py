@@ -23,6 +23,9 @@ DEBUG_NONE=const(0)
 DEBUG_SOME=const(1)
 DEBUG_VERBOSE=const(2)
 
+# 1: collect histograms of the poller (see get_stats()), 0: compile them out
+INSTRUMENT=const(1)
+
 # Pins as constants
 A_TRIACS=const(1)
 A_SOL1=const(2)
@@ -33,6 +36,28 @@ A_LCOL=const(32)
 A_LROW=const(64)
 A_ZEROCROSS=const(128)
 
+# Lamp column strobe (one bit set) to column 0-7, 0xff for anything else. This
+# is a performance hack to replace 8 if statements by a table lookup. The
+# tables are bytes literals, so they don't have to be built when the poller
+# starts (and stay in flash if the module is frozen).
+COLMAPPING = (
+    b"\xff\x00\x01\xff\x02\xff\xff\xff\x03\xff\xff\xff\xff\xff\xff\xff"
+    b"\x04\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\x05\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\x06\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\x07\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff"
+    b"\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff")
+
 
 # Global variables
 update_counter=0
@@ -41,11 +66,7 @@ max_fifo=int(0)
 
 overflow=0
 address_errors=0
-
-# Thread synchronisation
-lamp_lock    = _thread.allocate_lock()
-solenoid_lock = _thread.allocate_lock()
-triac_lock    = _thread.allocate_lock()
+ring_overruns=0
 
 if DEBUG:
     DEBUGSIZE = const(40)
@@ -65,10 +86,332 @@ solenoids = bytearray(4)
 TRIAC_NUM = const(5)
 gi_brightness = bytearray(TRIAC_NUM)
 
+# Published state
+#
+# The poller never blocks on a lock. Every change is published into two copies
+# of the state together with a sequence counter (seqlock latch): the counter is
+# incremented before each copy is written, so it is odd while copy 0 is written
+# and even while copy 1 is written. Readers use the copy that is not being
+# written (counter & 1) and retry if the counter changed while they were
+# copying. See PowerMonitor.snapshot()
+STATE_LAMPS = const(0)
+STATE_SOLENOIDS = const(8)
+STATE_GI = const(12)
+STATE_SIZE = const(17)
+statebuf = bytearray(2*STATE_SIZE)
+stateseq = array('I', [0])
+
+# Event journal
+#
+# The poller appends a record for every change to a preallocated ring buffer.
+# Consumers drain it with PowerMonitor.read_events(), so no user code has to run
+# in the poller thread. Each record uses 2 words:
+#   timestamp (utime.ticks_us)
+#   index << 16 | old << 8 | new   (index is the offset in the state, see STATE_*)
+# If the journal is full, new events are dropped and counted. The journal is a
+# single producer/single consumer queue: the poller only writes EV_HEAD, the
+# consumer only EV_TAIL. With PowerMonitor.start(pipeline), the poller writes
+# the events into the queue of the pipeline (see pipeline.py, same layout)
+# instead.
+EVENT_NUM = const(256)    # must be a power of two
+EVENT_MASK = const(255)
+EVENT_WORDS = const(2)
+EV_HEAD = const(0)        # written by the poller
+EV_TAIL = const(1)        # written by the consumer
+EV_DROPS = const(2)
+EV_HIGH = const(3)        # most events that were waiting in the journal
+EV_MASK = const(4)        # number of events - 1
+eventbuf = array('I', [0]*(EVENT_NUM*EVENT_WORDS))
+eventidx = array('I', [0, 0, 0, 0, EVENT_MASK])
+journalbuf = eventbuf
+journalidx = eventidx
+
+# Lamp intensity
+#
+# Lamps that are flickered or dimmed by WPC are on in some scans of the matrix
+# and off in others. For each lamp, the poller counts the scans in which it was
+# on over the last INTENSITY_WINDOW scans. The 8 lamps of a column are counted
+# in parallel: the counters are bit-sliced, byte b of a column holds bit b of
+# the counters of all 8 lamps. Adding the new row byte and subtracting the one
+# that leaves the window are done with carry/borrow chains over these bytes.
+INTENSITY_WINDOW = const(16)   # scans, must be a power of two
+INTENSITY_MASK = const(15)
+INTENSITY_SHIFT = const(4)     # log2(INTENSITY_WINDOW)
+INTENSITY_BITS = const(5)      # counters go up to INTENSITY_WINDOW
+intensityplanes = bytearray(8*INTENSITY_BITS)
+intensityhist = bytearray(8*INTENSITY_WINDOW)
+intensitypos = bytearray(8)
+intensityseq = array('I', [0])
+
+# Glitch filter
+#
+# A corrupted lamp row or solenoid word changes the state for one scan. With
+# PowerMonitor.set_glitch_filter(n, m), a bit of a lamp column or solenoid group
+# only changes when at least n of the last m words of this column/group agree
+# on the new value. The filter works on whole bytes: for every byte, the
+# number of ones of each bit in the last m words is kept in bit-sliced counters
+# (like the lamp intensity) and compared with n in parallel for all 8 bits.
+# Each byte uses GF_FIELDS bytes of glitchbuf:
+#   GF_HIST:   the last m words
+#   GF_PLANES: GLITCH_PLANES bit-sliced counters
+#   GF_POS:    next position in GF_HIST
+#   GF_OUT:    filtered value
+#   GF_PEND:   bits where the last word differed from the filtered value
+# A deviation that disappears without changing the filtered value is counted
+# as a suppressed glitch (per bit) in glitchstats.
+GLITCH_MAX = const(8)      # maximum m
+GLITCH_PLANES = const(4)   # counters go up to GLITCH_MAX
+GLITCH_BYTES = const(12)   # lamp columns 0-7, solenoid groups 8-11
+GF_HIST = const(0)
+GF_PLANES = const(8)
+GF_POS = const(12)
+GF_OUT = const(13)
+GF_PEND = const(14)
+GF_FIELDS = const(16)
+GF_N = const(192)          # GLITCH_BYTES*GF_FIELDS
+GF_M = const(193)
+glitchbuf = bytearray(GLITCH_BYTES*GF_FIELDS + 2)
+glitchstats = array('I', [0])
+# 0: filter off, set with PowerMonitor.set_glitch_filter()
+glitch_n = 0
+glitch_m = 0
+
+# Lamp matrix frames
+#
+# lamps is updated column by column, so it can mix two scans of the matrix.
+# The poller collects the rows of a scan (column 0 to 7) and publishes the
+# complete matrix as a frame into two copies with a sequence counter like the state (see Published
+# state). framecount holds the frame number of each copy. A scan that doesn't
+# contain all columns in order is dropped and counted in frameinfo:
+#   FRI_INCOMPLETE: number of dropped scans
+#   FRI_PERIOD:     average time between two scans in us
+FRAME_SIZE = const(8)
+FRI_INCOMPLETE = const(0)
+FRI_PERIOD = const(1)
+framebuf = bytearray(2*FRAME_SIZE)
+framecount = array('I', [0, 0])
+frameseq = array('I', [0])
+frameinfo = array('I', [0, 0])
+
+# Solenoid pulses
+#
+# For every solenoid (index group*8+bit, group 0-3 is SOL1-SOL4) the poller
+# keeps SOL_FIELDS words in solpulse: the timestamp of the last rising edge,
+# the width of the last pulse in us, the number of activations and whether the
+# solenoid is on (the timestamp uses all 30 bits of the ticks, a flag bit above
+# them wouldn't be a small int in viper). solhist holds a histogram of the pulse
+# widths with SOL_HIST_BINS bins per solenoid: bin 0 counts pulses shorter than
+# 2^SOL_HIST_SHIFT us, each further bin doubles the width, the last bin counts
+# everything longer.
+#
+# soltime is the time in ms since start() or reset_solenoid_stats() for the
+# activation rate. ticks_diff() is only valid for half of the ticks period
+# (537s for ticks_us), so get_solenoid_stats() adds the ticks_ms since its last
+# call instead of taking the difference to the start time. This works as long
+# as the calls are less than 6 days apart.
+SOL_NUM = const(32)
+SOL_FIELDS = const(4)
+SP_ON = const(0)
+SP_LAST = const(1)
+SP_COUNT = const(2)
+SP_ACTIVE = const(3)
+TICKS_MASK = const(0x3fffffff)
+SOL_HIST_BINS = const(16)
+SOL_HIST_SHIFT = const(8)
+solpulse = array('I', [0]*(SOL_NUM*SOL_FIELDS))
+solhist = array('I', [0]*(SOL_NUM*SOL_HIST_BINS))
+solticks = 0
+soltime = 0
+
+# Instrumentation
+#
+# The poller collects the following histograms and counters in instrwork. They
+# are copied to instrpub every PUBLISH_WORDS words, and after PUBLISH_US while
+# the bus is idle, readers use instrpub.
+# IH_LOOP:  time of the poller loop iterations that decoded words, bin n
+#           counts times < 2^n us
+# IH_FIFO:  FIFO depth when data is read (0-8)
+# IH_ZC:    time since the last zero crossing when data is read, ZC_BIN_US per bin
+# IH_ADDR:  words per address (triacs, sol1, sol3, sol4, sol2, lamp columns,
+#           lamp rows, other)
+# I_WORDS:  decoded words
+# I_ELAPSED_MS: time covered by the data
+PUBLISH_WORDS = const(1024)
+PUBLISH_US = const(100000)
+LOOP_BINS = const(16)
+FIFO_BINS = const(9)
+ZC_BINS = const(20)
+ZC_BIN_SHIFT = const(9)
+ZC_BIN_US = const(512)
+ADDR_BINS = const(8)
+IH_LOOP = const(0)
+IH_FIFO = const(16)
+IH_ZC = const(25)
+IH_ADDR = const(45)
+I_WORDS = const(53)
+I_ELAPSED_MS = const(54)
+INSTR_SIZE = const(55)
+ADDRESS_NAMES = ("triacs", "sol1", "sol3", "sol4", "sol2", "lamp_cols",
+                 "lamp_rows", "other")
+instrwork = array('I', [0]*INSTR_SIZE)
+instrpub = array('I', [0]*INSTR_SIZE)
+instrseq = array('I', [0])
+# Address bit to IH_ADDR bin
+ADDRBIN = (
+    b"\x07\x00\x01\x07\x02\x07\x07\x07\x03\x07\x07\x07\x07\x07\x07\x07"
+    b"\x04\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07"
+    b"\x05\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07"
+    b"\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07"
+    b"\x06\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07"
+    b"\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07"
+    b"\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07"
+    b"\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07\x07")
+
 # Average GI over some cycles, must be a power of two to allow shifting to calculate average
 TRIAC_CYCLES = const(8)
 TRIAC_AVGBITS = const(3)
 
+# GI brightness
+#
+# The delay between the zero crossing and the triac strobe is converted to a
+# brightness (0-GI_LEVELS) with a lookup table, one entry per GI_LUT_STEP_US.
+# Delays beyond the table are 0 (triac not fired in this half wave), a delay of
+# 0 means the triac was still on at the zero crossing (GI_LEVELS). The default
+# table uses the thresholds that worked on the test machine, calibrate_gi()
+# builds one from the delays observed on the running machine.
+#
+# gi_delayhist counts the delays per table entry for the calibration. gi_info
+# holds the triacs that fired since the start (GI_TRIAC_MASK, WPC has 5 triacs,
+# WPC-95 only 3) and the average zero cross period in us (GI_PERIOD).
+GI_LEVELS = const(8)
+GI_LUT_STEP_US = const(100)
+GI_LUT_SIZE = const(100)
+GI_TRIAC_MASK = const(0)
+GI_PERIOD = const(1)
+GI_PERIOD_MIN = const(7000)     # 70Hz
+GI_PERIOD_MAX = const(11000)    # 45Hz
+GI_CAL_MIN_COUNT = const(16)
+GI_CALIBRATION_FILE = "gi_calibration.bin"
+GI_DEFAULT_THRESHOLDS = ((3300, 6), (3500, 5), (4800, 4), (6000, 2), (8000, 1))
+
+def default_gi_lut():
+    lut = bytearray(GI_LUT_SIZE)
+    for i in range(GI_LUT_SIZE):
+        delay = i*GI_LUT_STEP_US
+        for (limit, level) in GI_DEFAULT_THRESHOLDS:
+            if delay < limit:
+                lut[i] = level
+                break
+    return lut
+
+def gi_phase_level(delay, period_us):
+    # Brightness of a triac fired delay us after the zero crossing
+    if delay >= period_us:
+        return 0
+    level = (GI_LEVELS * (period_us - delay) + period_us // 2) // period_us
+    return max(1, min(GI_LEVELS-1, level))
+
+def gi_lut_from_histogram(hist, period_us, min_count=GI_CAL_MIN_COUNT):
+    # Builds a lookup table from a histogram of delays (GI_LUT_STEP_US per
+    # bin) and the zero cross period. WPC fires the triacs at a few positions
+    # in the half wave, these show up as clusters in the histogram. All delays
+    # of a cluster get the level of its center, other delays the level of
+    # their phase position. Returns None if no cluster has min_count delays.
+    if period_us <= 0:
+        return None
+    lut = bytearray(GI_LUT_SIZE)
+    for i in range(GI_LUT_SIZE):
+        lut[i] = gi_phase_level(i*GI_LUT_STEP_US + GI_LUT_STEP_US // 2,
+                                period_us)
+    
+    clusters = 0
+    i = 0
+    while i < len(hist):
+        if not hist[i]:
+            i += 1
+            continue
+        first = i
+        count = 0
+        weighted = 0
+        while i < len(hist) and hist[i]:
+            count += hist[i]
+            weighted += hist[i] * (2*i + 1)
+            i += 1
+        if count >= min_count:
+            level = gi_phase_level(weighted * GI_LUT_STEP_US // (2*count),
+                                   period_us)
+            for j in range(max(0, first-1), min(GI_LUT_SIZE, i+1)):
+                lut[j] = level
+            clusters += 1
+    if not clusters:
+        return None
+    return lut
+
+gi_lut = default_gi_lut()
+gi_delayhist = array('I', [0]*GI_LUT_SIZE)
+gi_info = array('I', [0, 0])
+
+
+# Ingestion: the poller drains up to ingest_burst words from the RX FIFO into a
+# ring buffer in RAM and decodes up to decode_batch words from the ring before it
+# checks the FIFOs again. ingest_burst=1, decode_batch=1 reads one word per loop
+# iteration.
+RING_SIZE = const(64)    # must be a power of two
+RING_MASK = const(63)
+FIFO_DEPTH = const(8)    # the joined RX FIFO holds 8 words
+INGEST_BURST = const(8)
+DECODE_BATCH = const(8)
+ingest_burst = INGEST_BURST
+decode_batch = DECODE_BATCH
+ringbuf = array('I', [0]*RING_SIZE)
+
+# Flight recorder
+#
+# The poller records the last FLIGHT_SIZE words it reads from the FIFOs in
+# flightbuf, 2 words per record: the timestamp (utime.ticks_us, one per burst
+# of words) and the word. flightzc is 1 for the records of the zero cross
+# machine, get_flight_records() sets FLIGHT_ZC in their words (a flag bit in
+# the word itself wouldn't be a small int in viper, stamp_zc_triacs pushes 31
+# bits).
+# When an anomaly is detected (FIFO overflow, ring overrun, unknown address),
+# FLIGHT_POST more words are recorded and the recorder stops, so the words
+# before and after the anomaly are kept until PowerMonitor.dump_flight_record()
+# writes them in the capture format of hostsim/capture.py.
+# flightinfo holds the state:
+#   FR_HEAD:    number of records written
+#   FR_STATE:   FR_ARMED, FR_TRIGGERED or FR_FROZEN
+#   FR_REASON:  FLIGHT_OVERFLOW | FLIGHT_RING | FLIGHT_ADDRESS that triggered
+#   FR_TRIGGER: FR_HEAD at the trigger
+#   FR_TIME:    utime.ticks_us at the trigger
+FLIGHT_SIZE = const(1024)    # must be a power of two
+FLIGHT_MASK = const(1023)
+FLIGHT_POST = const(64)
+FLIGHT_ZC = const(0x80000000)
+FR_HEAD = const(0)
+FR_STATE = const(1)
+FR_REASON = const(2)
+FR_TRIGGER = const(3)
+FR_TIME = const(4)
+FR_ARMED = const(0)
+FR_TRIGGERED = const(1)
+FR_FROZEN = const(2)
+FLIGHT_OVERFLOW = const(1)
+FLIGHT_RING = const(2)
+FLIGHT_ADDRESS = const(4)
+FLIGHT_FILE = "flight.wpcc"
+flightbuf = array('I', [0]*(2*FLIGHT_SIZE))
+flightzc = bytearray(FLIGHT_SIZE)
+flightinfo = array('I', [0]*5)
+
+# Capture format (.wpcc) of the flight recorder dumps, see hostsim/capture.py
+CAPTURE_MAGIC = b"WPCC"
+CAPTURE_VERSION = const(1)
+CAPTURE_HEADER = "<4sHHIIQQQ"
+CAPTURE_HEADER_SIZE = const(40)
+CAPTURE_INDEX = "<QQ"
+CAPTURE_BLOCK = const(4096)
+CAPTURE_ZC = const(0x8000)
+CAPTURE_TIME_EXT = const(0xffff)
 
 running=False
 finished=True
@@ -82,6 +425,70 @@ zcmachine = 0
 lamp_notify = 0
 solenoid_notify = 0
 
+# Change signals for asyncio (see asyncmon.py)
+#
+# After each batch of words, the poller increments the counter of each kind of
+# change (SIG_*) that happened in the batch and sets signal_flag (a
+# ThreadSafeFlag) if there is one. A burst of changes only sets it once per
+# batch, and several set() before the asyncio task runs wake it once.
+# SIG_READY counts the changes of readyinfo[RD_SEEN].
+SIG_LAMPS = const(0)
+SIG_SOLENOIDS = const(1)
+SIG_GI = const(2)
+SIG_FRAME = const(3)
+SIG_READY = const(4)
+SIG_NUM = const(5)
+SIG_ANY = const(5)       # asyncmon.py: all but SIG_FRAME, not counted
+signalseq = array('I', [0]*SIG_NUM)
+signal_flag = None
+
+# Readiness
+#
+# The state is valid once the poller has seen a complete lamp matrix scan, all
+# four solenoid groups and a complete GI averaging window (TRIAC_CYCLES zero
+# crossings). start() stores the time in RD_START, the poller sets RD_READY and
+# the time it took in RD_TIME_US when all READY_* bits are set. RD_SEEN has the
+# READY_* bits seen so far (READY_DONE is added once the state is valid).
+READY_FRAME = const(1)
+READY_SOL1 = const(2)
+READY_SOL2 = const(4)
+READY_SOL3 = const(8)
+READY_SOL4 = const(16)
+READY_GI = const(32)
+READY_ALL = const(63)
+READY_DONE = const(64)
+RD_START = const(0)
+RD_READY = const(1)
+RD_TIME_US = const(2)
+RD_SEEN = const(3)
+readyinfo = array('I', [0]*4)
+
+# PIO programs
+#
+# Assembling the programs takes a while on import. freeze_pio_programs() writes
+# the assembled programs to powermon_pio.py. If that module can be imported
+# (copied to the Pico, compiled with mpy-cross or frozen into the firmware),
+# the programs are taken from it instead. Freeze them again after changing a
+# program.
+PIO_MODULE = "powermon_pio"
+PIO_PROGRAMS = ("read_data", "read_data_paired", "wait_clock",
+                "wait_zerocrossing", "stamp_zc_triacs")
+# Entries of an assembled program that hold where it is loaded (PIO0/PIO1)
+PIO_PROG_OFFSETS = (1, 2)
+try:
+    pio_frozen = __import__(PIO_MODULE)
+except ImportError:
+    pio_frozen = None
+
+
+def pio_program(**kw):
+    # Like rp2.asm_pio(), but returns the frozen program if there is one
+    def assemble(func):
+        if pio_frozen is not None and hasattr(pio_frozen, func.__name__):
+            return getattr(pio_frozen, func.__name__)
+        return rp2.asm_pio(**kw)(func)
+    return assemble
+
 # Wait for a low/high change on GPIO8-14
 # As the "wait" command can only wait for a single pin, we need to poll the stat
 # of 8 pin here and then check if these are zero/non-zero
@@ -96,7 +503,7 @@ solenoid_notify = 0
 # clocks, active high and overlapping. This has to be sampled completely independent.
 
 DATABITS=const(15)
-@rp2.asm_pio(autopush=True,
+@pio_program(autopush=True,
              push_thresh=DATABITS,
              fifo_join=rp2.PIO.JOIN_RX,
              set_init=rp2.PIO.OUT_LOW,
@@ -111,8 +518,48 @@ def read_data():
     wrap()
 
 
+# Alternative to read_data that pairs lamp columns and rows (see protocol.md).
+# A lamp column word (detected with the jmp pin, GPIO13) isn't pushed, its data
+# is latched in Y. When the row word arrives, one word is pushed:
+#   row word (15 bits) << 8 | column data
+# so the CPU gets a single word per matrix column. A row without a latched
+# column is the transfer at the end of the cycle and is dropped. Empty columns
+# are ignored like the decoder does. All other words are pushed unchanged, so
+# words > 0x7fff are combined lamp words.
+@pio_program(fifo_join=rp2.PIO.JOIN_RX,
+             in_shiftdir=rp2.PIO.SHIFT_LEFT,
+             out_shiftdir=rp2.PIO.SHIFT_RIGHT
+             )
+def read_data_paired():
+    wrap_target()
+    label("next")
+    wait(1, irq, 0)
+    mov(osr,invert(pins))
+    jmp(pin, "notcol")       # lamp column strobe is active low
+    out(x,8)                 # column data
+    jmp(not_x, "next")       # ignore empty columns
+    mov(y,x)                 # latch the column
+    jmp("next")
+    
+    label("notcol")
+    in_(osr,DATABITS)        # the word itself
+    out(null,14)
+    out(x,1)                 # lamp row strobe (active low, inverted)
+    jmp(not_x, "push")
+    jmp(not_y, "drop")       # no column latched
+    in_(y,8)                 # append the column
+    mov(y,null)
+    label("push")
+    push()
+    wrap()
+    
+    label("drop")
+    mov(isr,null)            # discard the word and reset the shift counter
+    jmp("next")
+
+
 CTLBITS=const(7)
-@rp2.asm_pio()
+@pio_program()
 def wait_clock():
     wrap_target()
 
@@ -138,7 +585,7 @@ def wait_clock():
     
     wrap()
  
-@rp2.asm_pio()
+@pio_program()
 def wait_zerocrossing():
     wrap_target()
     wait(0,pin,15) [10]
@@ -148,63 +595,244 @@ def wait_zerocrossing():
     wrap()
     
     
+# Zero cross and triac timestamps
+#
+# GI brightness is derived from the delay between the zero crossing and the
+# triac strobe. stamp_zc_triacs measures it in hardware instead of taking
+# utime timestamps when the words are decoded, so a FIFO backlog doesn't change
+# the result. It runs in the other PIO block and replaces wait_zerocrossing.
+#
+# X is a free running counter, decremented every STAMP_LOOP cycles (STAMP_FREQ
+# gives 1/16us per count). On every rising edge of the zero cross signal, the
+# counter is pushed (22 bits). On every triac strobe (the jmp pin), the data
+# bus is sampled after about 200ns and pushed as well:
+#   strobe << 30 | data << 22 | counter
+# so words above STAMP_MASK are triacs.
+# The counter pauses for a few cycles while a word is pushed (less than 1us per
+# half wave).
+STAMP_FREQ = const(80000000)
+STAMP_LOOP = const(5)
+STAMP_SHIFT = const(4)          # 16 counts per us
+STAMP_MASK = const(0x3fffff)
+STAMP_DATA_SHIFT = const(22)
+
+@pio_program(fifo_join=rp2.PIO.JOIN_RX,
+             in_shiftdir=rp2.PIO.SHIFT_LEFT,
+             out_shiftdir=rp2.PIO.SHIFT_RIGHT
+             )
+def stamp_zc_triacs():
+    # in_base: GPIO15 (zero cross), jmp pin: GPIO8 (triacs, active low)
+    wrap_target()
+    label("zclow")
+    jmp(x_dec, "zclow1")
+    label("zclow1")
+    mov(osr,pins)
+    out(y,1)                 # zero cross
+    jmp(not_y, "zclow2")
+    in_(x,22)                # rising edge
+    push(noblock)
+    jmp("zchigh")
+    label("zclow2")
+    jmp(pin, "zclow")
+    
+    nop() [15]               # triac strobe, let the data settle
+    mov(osr,invert(pins))
+    out(null,17)             # GPIO0 follows GPIO31
+    in_(osr,9)               # data and the strobe
+    in_(x,22)
+    push(noblock)
+    label("triacwait1")      # wait for the end of the strobe
+    jmp(x_dec, "triacwait2")
+    label("triacwait2")
+    jmp(pin, "zclow") [1]
+    jmp("triacwait1") [1]
+    
+    label("zchigh")
+    jmp(x_dec, "zchigh1")
+    label("zchigh1")
+    mov(osr,pins)
+    out(y,1)
+    jmp(not_y, "zclow")      # falling edge
+    jmp(pin, "zchigh")
+    
+    nop() [15]
+    mov(osr,invert(pins))
+    out(null,17)
+    in_(osr,9)
+    in_(x,22)
+    push(noblock)
+    label("triacwait3")
+    jmp(x_dec, "triacwait4")
+    label("triacwait4")
+    jmp(pin, "zchigh") [1]
+    jmp("triacwait3") [1]
+    wrap()
+
+# Set by PowerMonitor(stamp_gi=True), zcmachine runs stamp_zc_triacs then
+gi_stamped = False
+
+
+def freeze_pio_programs(path=PIO_MODULE + ".py"):
+    # Writes the assembled PIO programs to a module, see pio_program(). Run on
+    # the Pico, the host stand-in of rp2 doesn't assemble the programs.
+    g = globals()
+    with open(path, "w") as f:
+        f.write("# Generated by powermon_viper.freeze_pio_programs(), don't edit\n")
+        f.write("from array import array\n\n")
+        for name in PIO_PROGRAMS:
+            prog = g[name]
+            if not isinstance(prog, list):
+                raise ValueError("PIO programs can only be frozen on the Pico")
+            prog = list(prog)
+            # Not loaded into a PIO block yet
+            for i in PIO_PROG_OFFSETS:
+                prog[i] = -1
+            f.write("{} = {}\n".format(name, repr(prog)))
+
+    
 def set_max_fifo(m):
+    # New high-water mark of the RX FIFO
     global max_fifo
-    global overflow
-    if m == 8:
-        # If the queue is completely filled, there is most likely an overflow
-        # We can't be sure at the state machine will just block but it's a bad sign
-        overflow = 1
     max_fifo=m
     
+def found_overflow():
+    # Called whenever the RX FIFO is full, not only the first time, so the
+    # flight recorder catches every overflow after it was rearmed
+    global overflow
+    # If the queue is completely filled, there is most likely an overflow
+    # We can't be sure at the state machine will just block but it's a bad sign
+    overflow = 1
+    flight_trigger(FLIGHT_OVERFLOW)
+    
 def found_address_error():
     global address_errors
     address_errors += 1
+    flight_trigger(FLIGHT_ADDRESS)
+    
+def reset_soltime():
+    global solticks
+    global soltime
+    solticks = utime.ticks_ms()
+    soltime = 0
+    
+def update_soltime():
+    # Adds the time since the last call to soltime, returns soltime
+    global solticks
+    global soltime
+    now = utime.ticks_ms()
+    soltime += utime.ticks_diff(now, solticks)
+    solticks = now
+    return soltime
+    
+def flight_bus_words(records, stamped):
+    # Converts flight recorder records to (timestamp, word) of the capture
+    # format: words of read_data_paired are split into the column and the row
+    # word, words of stamp_zc_triacs into triac words and zero crossings.
+    # With stamped, the data machine records the triac strobes as well, they
+    # are only taken from stamp_zc_triacs so they aren't in the capture twice.
+    words = []
+    for t, w in records:
+        if w & FLIGHT_ZC:
+            w &= ~FLIGHT_ZC
+            if stamped and w > STAMP_MASK:
+                words.append((t, (w >> STAMP_DATA_SHIFT) & 0x1ff))
+            else:
+                words.append((t, CAPTURE_ZC))
+        elif w > 0x7fff:
+            words.append((t, (A_LCOL << 8) | (w & 0xff)))
+            words.append((t, w >> 8))
+        elif not (stamped and (w >> 8) == A_TRIACS):
+            words.append((t, w))
+    return words
+
+def write_capture(out, words, unit_ns=1000):
+    # Writes (timestamp, word) with utime.ticks_us timestamps as a capture
+    # file to out (a file or a UART). Returns the number of records.
+    import struct
+    data = bytearray()
+    index = []
+    time = 0
+    last = None
+    for t, w in words:
+        delta = 0
+        if last is not None:
+            delta = utime.ticks_diff(t, last)
+        if delta < 0:
+            # Data words are stamped at the start of the poller loop, a zero
+            # crossing of the same iteration can have a later timestamp
+            delta = 0
+        else:
+            last = t
+        high = delta >> 16
+        while high:
+            step = min(high, 0xffff)
+            if not (len(data) >> 2) % CAPTURE_BLOCK:
+                index.append((time, len(data) >> 2))
+            data.extend(struct.pack("<HH", step, CAPTURE_TIME_EXT))
+            time += step << 16
+            high -= step
+        if not (len(data) >> 2) % CAPTURE_BLOCK:
+            index.append((time, len(data) >> 2))
+        data.extend(struct.pack("<HH", delta & 0xffff, w))
+        time += delta & 0xffff
+    records = len(data) >> 2
+    out.write(struct.pack(CAPTURE_HEADER, CAPTURE_MAGIC, CAPTURE_VERSION, 0,
+                          unit_ns, CAPTURE_BLOCK, records,
+                          CAPTURE_HEADER_SIZE + len(data), time))
+    out.write(data)
+    for entry in index:
+        out.write(struct.pack(CAPTURE_INDEX, entry[0], entry[1]))
+    return records
+    
+def flight_trigger(reason):
+    # Called by the poller on anomalies
+    if flightinfo[FR_STATE] == FR_ARMED:
+        flightinfo[FR_TRIGGER] = flightinfo[FR_HEAD]
+        flightinfo[FR_TIME] = utime.ticks_us()
+        flightinfo[FR_STATE] = FR_TRIGGERED
+    if flightinfo[FR_STATE] == FR_TRIGGERED:
+        flightinfo[FR_REASON] |= reason
     
 #def set_update_counter(new_value)
 
 @micropython.viper
 def updatebrightness(timediff:int, triacdata: int, brightnessdata: ptr8, offset: int):
     
-    # Convert time to brightness
+    # Convert time to brightness with the lookup table
     # See https://github.com/bitfieldlabs/aggi/tree/master/scopes
     # for examples
-    # This doesn't work perfectly, but good enough
+    info = ptr32(gi_info)
+    info[GI_TRIAC_MASK] = info[GI_TRIAC_MASK] | (triacdata & 0x1f)
     if timediff == 0:
-        brightness = 8
-    elif timediff < 3300:
-        brightness = 6
-    elif timediff < 3500:
-        brightness = 5
-    elif timediff < 4800:
-        brightness = 4
-    elif timediff < 6000:
-        brightness = 2
-    elif timediff < 8000:
-        brightness = 1
+        brightness = GI_LEVELS
     else:
-        brightness=0
+        bucket = timediff // GI_LUT_STEP_US
+        if bucket < GI_LUT_SIZE:
+            lut = ptr8(gi_lut)
+            hist = ptr32(gi_delayhist)
+            brightness = lut[bucket]
+            hist[bucket] = hist[bucket] + 1
+        else:
+            brightness = 0
     
     # WPC has 5 triacs, WPC95 only 3
-    if (triacdata & 0x01) and not brightnessdata[offset+0]:
-        brightnessdata[offset+0] = brightness
-    if (triacdata & 0x02) and not brightnessdata[offset+1]:
-        brightnessdata[offset+1] = brightness
-    if (triacdata & 0x04) and not brightnessdata[offset+2]:
-        brightnessdata[offset+2] = brightness
-    if (triacdata & 0x08) and not brightnessdata[offset+3]:
-        brightnessdata[offset+3] = brightness
-    if (triacdata & 0x10) and not brightnessdata[offset+4]:
-        brightnessdata[offset+4] = brightness
+    for i in range(TRIAC_NUM):
+        if (triacdata & (1 << i)) and not brightnessdata[offset+i]:
+            brightnessdata[offset+i] = brightness
 
 
 @micropython.viper
 def new_power_cycle(triacdata: int, brightnessdata: ptr8, averagearray: ptr8):
     
     sum=int(0)
+    active=int(ptr32(gi_info)[GI_TRIAC_MASK])
         
-    # Cleanup array and calculate averages over the previous cycle
-    for i in range(5):
+    # Cleanup array and calculate averages over the previous cycle, triacs
+    # that never fired (not connected on WPC-95) are skipped
+    for i in range(TRIAC_NUM):
+        if not (active & (1 << i)):
+            averagearray[i]=0
+            continue
         sum=int(0)
         for j in range(0,8):
             offset=int(j*TRIAC_NUM+i)
@@ -218,270 +846,1076 @@ def new_power_cycle(triacdata: int, brightnessdata: ptr8, averagearray: ptr8):
     updatebrightness(0, triacdata, brightnessdata, 0)
     
 @micropython.viper
-def updateloop():
-    global update_counter
-    global finished
+def publish_state(state: ptr8, seq: ptr32, offset: int, src: ptr8, n: int):
+    # Copy n bytes into both copies of the published state
+    seq[0] = seq[0] + 1
+    for i in range(n):
+        state[offset+i] = src[i]
+    seq[0] = seq[0] + 1
+    offset += STATE_SIZE
+    for i in range(n):
+        state[offset+i] = src[i]
     
-    if DEBUG:
+@micropython.viper
+def journal_event(journal: ptr32, idx: ptr32, timestamp: int, index: int, old: int, new: int):
+    head = idx[EV_HEAD]
+    mask = idx[EV_MASK]
+    depth = head - idx[EV_TAIL]
+    if depth > mask:
+        # The consumer didn't keep up
+        idx[EV_DROPS] = idx[EV_DROPS] + 1
+        return
+    if depth >= idx[EV_HIGH]:
+        idx[EV_HIGH] = depth + 1
+    pos = (head & mask) * EVENT_WORDS
+    journal[pos] = timestamp
+    journal[pos+1] = (index << 16) | (old << 8) | new
+    idx[EV_HEAD] = head + 1
+    
+@micropython.viper
+def drain_events(journal: ptr32, idx: ptr32, buf: ptr32, n: int) -> int:
+    tail = idx[EV_TAIL]
+    mask = idx[EV_MASK]
+    count = idx[EV_HEAD] - tail
+    if count > n:
+        count = n
+    for i in range(count):
+        pos = ((tail + i) & mask) * EVENT_WORDS
+        buf[i*EVENT_WORDS] = journal[pos]
+        buf[i*EVENT_WORDS+1] = journal[pos+1]
+    idx[EV_TAIL] = tail + count
+    return count
+    
+@micropython.viper
+def filter_glitches(flt: ptr8, index: int, data: int, stats: ptr32) -> int:
+    # Adds a word to the window of byte index, returns the filtered value
+    base = index*GF_FIELDS
+    n = flt[GF_N]
+    m = flt[GF_M]
+    pos = flt[base+GF_POS]
+    sub = flt[base+GF_HIST+pos]
+    flt[base+GF_HIST+pos] = data
+    pos += 1
+    if pos >= m:
+        pos = 0
+    flt[base+GF_POS] = pos
+    
+    # Add the new word to the counters, subtract the one that leaves the window
+    p = base+GF_PLANES
+    add = data
+    for b in range(GLITCH_PLANES):
+        plane = flt[p+b]
+        carry = plane & add
+        plane ^= add
+        borrow = (plane ^ 0xff) & sub
+        plane ^= sub
+        flt[p+b] = plane
+        add = carry
+        sub = borrow
+    
+    # Compare the counters with n (ones) and m-n+1 (zeros), highest bit first
+    k = m - n + 1
+    gt1 = 0
+    eq1 = 0xff
+    gt0 = 0
+    eq0 = 0xff
+    b = GLITCH_PLANES-1
+    while b >= 0:
+        plane = flt[p+b]
+        if (n >> b) & 1:
+            eq1 &= plane
+        else:
+            gt1 |= eq1 & plane
+        if (k >> b) & 1:
+            eq0 &= plane
+        else:
+            gt0 |= eq0 & plane
+        b -= 1
+    ones = gt1 | eq1
+    zeros = (gt0 | eq0) ^ 0xff
+    
+    old = flt[base+GF_OUT]
+    out = (old | ones) & (zeros ^ 0xff)
+    flt[base+GF_OUT] = out
+    
+    diff = data ^ out
+    ended = flt[base+GF_PEND] & (diff ^ 0xff) & ((old ^ out) ^ 0xff)
+    flt[base+GF_PEND] = diff
+    if ended:
+        c = 0
+        while ended:
+            c += ended & 1
+            ended = ended >> 1
+        stats[0] = stats[0] + c
+    return out
+    
+@micropython.viper
+def publish_frame(frame: ptr8, count: ptr32, seq: ptr32, src: ptr8):
+    # Copy a complete matrix into both copies of the published frame
+    n = count[0] + 1
+    seq[0] = seq[0] + 1
+    for i in range(FRAME_SIZE):
+        frame[i] = src[i]
+    count[0] = n
+    seq[0] = seq[0] + 1
+    for i in range(FRAME_SIZE):
+        frame[FRAME_SIZE+i] = src[i]
+    count[1] = n
+    
+@micropython.viper
+def extract_intensity(planes: ptr8, out: ptr8):
+    # Convert the bit-sliced counters to one brightness byte (0-255) per lamp
+    for col in range(8):
+        for row in range(8):
+            count = 0
+            for b in range(INTENSITY_BITS):
+                count |= ((planes[col*INTENSITY_BITS+b] >> row) & 1) << b
+            out[col*8+row] = (count*255) >> INTENSITY_SHIFT
+    
+@micropython.viper
+def solenoid_edges(pulse: ptr32, hist: ptr32, group: int, old: int, new: int, now: int):
+    # Record the edges of all solenoids of a group that changed
+    changed = old ^ new
+    sol = group*8
+    while changed:
+        if changed & 1:
+            p = sol*SOL_FIELDS
+            if new & 1:
+                pulse[p+SP_ON] = now & TICKS_MASK
+                pulse[p+SP_ACTIVE] = 1
+                pulse[p+SP_COUNT] = pulse[p+SP_COUNT] + 1
+            elif pulse[p+SP_ACTIVE]:
+                width = (now - pulse[p+SP_ON]) & TICKS_MASK
+                pulse[p+SP_ACTIVE] = 0
+                pulse[p+SP_LAST] = width
+                bin = 0
+                width = width >> SOL_HIST_SHIFT
+                while width and bin < SOL_HIST_BINS-1:
+                    width = width >> 1
+                    bin += 1
+                h = sol*SOL_HIST_BINS + bin
+                hist[h] = hist[h] + 1
+        changed = changed >> 1
+        new = new >> 1
+        sol += 1
+    
+@micropython.viper
+def publish_instrumentation(work: ptr32, pub: ptr32, seq: ptr32):
+    seq[0] = seq[0] + 1
+    for i in range(INSTR_SIZE):
+        pub[i] = work[i]
+    seq[0] = seq[0] + 1
+    
+# Poller state
+#
+# updateloop() only reads the FIFOs and moves the words into the ring buffer,
+# the words are decoded by the helpers below. Their state is kept in pollstate
+# (PS_*), so it survives between the calls. Splitting the work keeps the native
+# code of each function within the branch range of Thumb-1 (armv6m, the
+# RP2040): with everything in updateloop(), mpy-cross fails with "native method
+# too big". The values are never negative, viper and the host stand-in read
+# ptr32 differently otherwise.
+#   PS_LAMPSCOL:    lamp column of the next row word, NO_COLUMN if none
+#   PS_FRAMEMASK:   columns of the matrix scan in progress
+#   PS_FRAMELAST:   column of the last row word
+#   PS_FRAMESTART:  utime.ticks_us at the start of the scan
+#   PS_ZCTIME:      utime.ticks_us of the last zero crossing, 0 before the first
+#   PS_ZCSTAMP:     counter of stamp_zc_triacs at the last zero crossing,
+#                   NO_STAMP before the first
+#   PS_GIOFFSET:    slots of the current half wave in gi_samples
+#   PS_TRIACDATA:   last triac word
+#   PS_GIWINDOW:    READY_GI after the first GI window, that one is empty
+#   PS_SIGNALS:     SIG_* bits of the changes since the last signal
+#   PS_READY:       READY_* seen so far, READY_DONE added once the state is
+#                   valid
+#   PS_UPDATES:     counter behind update_counter
+#   PS_FIFO_COUNT .. PS_TRIAC_MAX: DEBUG counters, published to the globals
+PS_LAMPSCOL = const(0)
+PS_FRAMEMASK = const(1)
+PS_FRAMELAST = const(2)
+PS_FRAMESTART = const(3)
+PS_ZCTIME = const(4)
+PS_ZCSTAMP = const(5)
+PS_GIOFFSET = const(6)
+PS_TRIACDATA = const(7)
+PS_GIWINDOW = const(8)
+PS_SIGNALS = const(9)
+PS_READY = const(10)
+PS_UPDATES = const(11)
+PS_FIFO_COUNT = const(12)
+PS_FIFO_SUM = const(13)
+PS_ZC_COUNT = const(14)
+PS_ROWS = const(15)
+PS_COLS = const(16)
+PS_TRIACS = const(17)
+PS_TRIAC_MIN = const(18)
+PS_TRIAC_MAX = const(19)
+PS_SIZE = const(20)
+NO_COLUMN = const(0xff)
+NO_STAMP = const(0x400000)      # STAMP_MASK+1
+pollstate = array('I', [0]*PS_SIZE)
+# Rows of the matrix scan in progress
+framework = bytearray(FRAME_SIZE)
+# Triac brightness of the last TRIAC_CYCLES half waves
+gi_samples = bytearray(TRIAC_NUM*TRIAC_CYCLES)
+gi_old = bytearray(TRIAC_NUM)
+
+def reset_pollstate():
+    ps = pollstate
+    for i in range(PS_SIZE):
+        ps[i] = 0
+    ps[PS_LAMPSCOL] = NO_COLUMN
+    ps[PS_ZCSTAMP] = NO_STAMP
+    # Start storing with the first zero crossing
+    ps[PS_GIOFFSET] = TRIAC_NUM*TRIAC_CYCLES
+    ps[PS_TRIAC_MIN] = 10000
+    for i in range(FRAME_SIZE):
+        framework[i] = 0
+    for i in range(TRIAC_NUM*TRIAC_CYCLES):
+        gi_samples[i] = 0
+
+if DEBUG:
+    def publish_debug_counters():
+        global fifo_count
+        global fifo_sum
+        global zc_detected
         global rows_detected
         global cols_detected
         global triacs_detected
-        global zc_detected
-        global fifo_count
-        global fifo_sum
         global triac_min_time
         global triac_max_time
-        
-        lfifo_count = int(0)
-        lfifo_sum = int(0)
-        lrows_detected = int(0)
-        lcols_detected = int(0)
-        ltriacs_detected = int(0)
-        lzc_detected = int(0)
-        ltriac_min_time = int(10000)
-        ltriac_max_time = int(0)
-        
+        ps = pollstate
+        fifo_count = ps[PS_FIFO_COUNT]
+        fifo_sum = ps[PS_FIFO_SUM]
+        zc_detected = ps[PS_ZC_COUNT]
+        rows_detected = ps[PS_ROWS]
+        cols_detected = ps[PS_COLS]
+        triacs_detected = ps[PS_TRIACS]
+        triac_min_time = ps[PS_TRIAC_MIN]
+        triac_max_time = ps[PS_TRIAC_MAX]
 
+    @micropython.viper
+    def triac_delay(ps: ptr32, delay: int):
+        if delay < ps[PS_TRIAC_MIN]:
+            ps[PS_TRIAC_MIN] = delay
+        if delay > ps[PS_TRIAC_MAX]:
+            ps[PS_TRIAC_MAX] = delay
 
-    # Cache some global objects
-    llock =  lamp_lock
-    slock =  solenoid_lock
-    ldatamachine = datamachine
-    lzcmachine = zcmachine
-    
+@micropython.viper
+def flight_zc(flight: ptr32, flightzc: ptr8, info: ptr32, timestamp: int, word: int):
+    # Records a word of the zero cross machine in the flight recorder
+    head = info[FR_HEAD]
+    fidx = (head & FLIGHT_MASK) << 1
+    flight[fidx] = timestamp
+    flight[fidx+1] = word
+    flightzc[head & FLIGHT_MASK] = 1
+    info[FR_HEAD] = head + 1
+
+@micropython.viper
+def ingest_words(sm, ring: ptr32, ringhead: int, n: int, flight: ptr32, flightzc: ptr8, info: ptr32, timestamp: int) -> int:
+    # Moves n words from the RX FIFO of sm into the ring buffer and records
+    # them in the flight recorder (one timestamp per burst) unless it is
+    # frozen. Returns the new head of the ring.
+    if info[FR_STATE] == FR_FROZEN:
+        while n > 0:
+            ring[ringhead & RING_MASK] = int(sm.get())
+            ringhead += 1
+            n -= 1
+        return ringhead
+    head = info[FR_HEAD]
+    while n > 0:
+        w = int(sm.get())
+        ring[ringhead & RING_MASK] = w
+        ringhead += 1
+        fidx = (head & FLIGHT_MASK) << 1
+        flight[fidx] = timestamp
+        flight[fidx+1] = w
+        flightzc[head & FLIGHT_MASK] = 0
+        head += 1
+        n -= 1
+    info[FR_HEAD] = head
+    if info[FR_STATE] == FR_TRIGGERED:
+        if head - info[FR_TRIGGER] >= FLIGHT_POST:
+            info[FR_STATE] = FR_FROZEN
+    return ringhead
+
+@micropython.viper
+def publish_change(state: ptr8, seq: ptr32, journal: ptr32, idx: ptr32, index: int, old: int, new: int, timestamp: int):
+    # Publishes a changed byte of the state, then journals the change. The
+    # state is published first, so a consumer that resyncs from the state
+    # after lost events doesn't miss this change.
+    seq[0] = seq[0] + 1
+    state[index] = new
+    seq[0] = seq[0] + 1
+    state[STATE_SIZE+index] = new
+    journal_event(journal, idx, timestamp, index, old, new)
+
+@micropython.viper
+def publish_gi(state: ptr8, seq: ptr32, journal: ptr32, idx: ptr32, brightness: ptr8, giold: ptr8, timestamp: int) -> int:
+    # Publishes the GI brightness of a power cycle and journals the channels
+    # that changed, returns the number of changes
+    # Copy 1 of the published state still holds the previous values
+    for j in range(TRIAC_NUM):
+        giold[j] = state[STATE_SIZE+STATE_GI+j]
+    publish_state(state, seq, STATE_GI, brightness, TRIAC_NUM)
+    changes = 0
+    for j in range(TRIAC_NUM):
+        if giold[j] != brightness[j]:
+            journal_event(journal, idx, timestamp, STATE_GI+j,
+                          giold[j], brightness[j])
+            changes += 1
+    return changes
+
+@micropython.viper
+def update_intensity(planes: ptr8, hist: ptr8, histpos: ptr8, seq: ptr32, col: int, data: int):
+    # Lamp intensity: add the new row byte to the counters of the column,
+    # subtract the one that leaves the window
+    hpos = histpos[col]
+    hidx = col*INTENSITY_WINDOW + hpos
+    add = data
+    sub = hist[hidx]
+    if add != sub:
+        hist[hidx] = add
+        seq[0] = seq[0] + 1
+        base = col*INTENSITY_BITS
+        for b in range(INTENSITY_BITS):
+            plane = planes[base+b]
+            carry = plane & add
+            plane ^= add
+            borrow = (plane ^ 0xff) & sub
+            plane ^= sub
+            planes[base+b] = plane
+            add = carry
+            sub = borrow
+        seq[0] = seq[0] + 1
+    histpos[col] = (hpos + 1) & INTENSITY_MASK
+
+@micropython.viper
+def collect_frame(ps: ptr32, col: int, data: int):
+    # Collects the rows of a complete scan of the lamp matrix
+    frameinf = ptr32(frameinfo)
+    work = ptr8(framework)
+    framemask = ps[PS_FRAMEMASK]
+    if col == 0:
+        if framemask:
+            frameinf[FRI_INCOMPLETE] = frameinf[FRI_INCOMPLETE] + 1
+        framenow = int(utime.ticks_us())
+        framestart = ps[PS_FRAMESTART]
+        if framestart:
+            period = (framenow - framestart) & TICKS_MASK
+            if frameinf[FRI_PERIOD]:
+                frameinf[FRI_PERIOD] = frameinf[FRI_PERIOD] + ((period - frameinf[FRI_PERIOD]) >> 3)
+            else:
+                frameinf[FRI_PERIOD] = period
+        ps[PS_FRAMESTART] = framenow
+        work[0] = data
+        framemask = 1
+    elif framemask:
+        framelast = ps[PS_FRAMELAST]
+        if col == framelast + 1:
+            work[col] = data
+            framemask |= 1 << col
+            if framemask == 0xff:
+                publish_frame(ptr8(framebuf), ptr32(framecount), ptr32(frameseq), work)
+                ps[PS_SIGNALS] = ps[PS_SIGNALS] | (1 << SIG_FRAME)
+                ps[PS_READY] = ps[PS_READY] | READY_FRAME
+                framemask = 0
+        else:
+            # A column is missing or repeated
+            frameinf[FRI_INCOMPLETE] = frameinf[FRI_INCOMPLETE] + 1
+            framemask = 0
+    ps[PS_FRAMEMASK] = framemask
+    ps[PS_FRAMELAST] = col
+
+@micropython.viper
+def decode_row(ps: ptr32, col: int, data: int) -> int:
+    # Handles the row word of a lamp column, returns 1 if a lamp changed
+    if DEBUG:
+        ps[PS_ROWS] = ps[PS_ROWS] + 1
+    update_intensity(ptr8(intensityplanes), ptr8(intensityhist),
+                     ptr8(intensitypos), ptr32(intensityseq), col, data)
+    if int(glitch_m):
+        data = int(filter_glitches(ptr8(glitchbuf), col, data, ptr32(glitchstats)))
+    changed = 0
     llamps = ptr8(lamps)
+    if llamps[col] != data:
+        old = llamps[col]
+        llamps[col] = data
+        publish_change(ptr8(statebuf), ptr32(stateseq), ptr32(journalbuf), ptr32(journalidx),
+                       STATE_LAMPS+col, old, data, int(utime.ticks_us()))
+        changed = 1
+    collect_frame(ps, col, data)
+    return changed
+
+@micropython.viper
+def decode_solenoids(ps: ptr32, group: int, data: int) -> int:
+    # Handles the word of a solenoid group (0-3 is SOL1-SOL4), returns 1 if
+    # a solenoid changed
+    if int(glitch_m):
+        data = int(filter_glitches(ptr8(glitchbuf), 8+group, data, ptr32(glitchstats)))
+    ps[PS_READY] = ps[PS_READY] | (READY_SOL1 << group)
     lsolenoids = ptr8(solenoids)
-    lbrightness = ptr8(gi_brightness)
-    
+    if data == lsolenoids[group]:
+        return 0
+    now = int(utime.ticks_us())
+    old = lsolenoids[group]
+    solenoid_edges(ptr32(solpulse), ptr32(solhist), group, old, data, now)
+    lsolenoids[group] = data
+    publish_change(ptr8(statebuf), ptr32(stateseq), ptr32(journalbuf), ptr32(journalidx),
+                   STATE_SOLENOIDS+group, old, data, now)
+    return 1
 
+@micropython.viper
+def decode_triacs(ps: ptr32, data: int):
+    # Handles a triac word read from the bus (without stamp_zc_triacs)
+    if DEBUG:
+        ps[PS_TRIACS] = ps[PS_TRIACS] + 1
+    # Only do something if zero crossing is set
+    zctime = ps[PS_ZCTIME]
+    if zctime:
+        ps[PS_TRIACDATA] = data
+        delay = (int(utime.ticks_us()) - zctime) & TICKS_MASK
+        updatebrightness(delay, data, ptr8(gi_samples), ps[PS_GIOFFSET])
+        if DEBUG:
+            triac_delay(ps, delay)
+
+@micropython.viper
+def decode_zc(ps: ptr32, word: int, stamped: int):
+    # Handles a word of the zero cross machine: a zero crossing or, with
+    # stamp_zc_triacs, a stamped triac strobe
+    if stamped and word > STAMP_MASK:
+        # Triac strobe stamped by stamp_zc_triacs
+        if DEBUG:
+            ps[PS_TRIACS] = ps[PS_TRIACS] + 1
+        zcstamp = ps[PS_ZCSTAMP]
+        if zcstamp != NO_STAMP:
+            triacdata = (word >> STAMP_DATA_SHIFT) & 0xff
+            ps[PS_TRIACDATA] = triacdata
+            delay = ((zcstamp - word) & STAMP_MASK) >> STAMP_SHIFT
+            updatebrightness(delay, triacdata, ptr8(gi_samples), ps[PS_GIOFFSET])
+            if DEBUG:
+                triac_delay(ps, delay)
+        return
+
+    # Zerocrossing detected, without stamps the data are not interesting
+    period = 0
+    if stamped:
+        zcstamp = ps[PS_ZCSTAMP]
+        if zcstamp != NO_STAMP:
+            period = ((zcstamp - word) & STAMP_MASK) >> STAMP_SHIFT
+        ps[PS_ZCSTAMP] = word & STAMP_MASK
+        zctime = int(utime.ticks_us())
+    else:
+        zctime = int(utime.ticks_us())
+        if ps[PS_ZCTIME]:
+            period = (zctime - ps[PS_ZCTIME]) & TICKS_MASK
+    ps[PS_ZCTIME] = zctime
+    # Average period for the GI calibration
+    giinfo = ptr32(gi_info)
+    if period > GI_PERIOD_MIN and period < GI_PERIOD_MAX:
+        if giinfo[GI_PERIOD]:
+            giinfo[GI_PERIOD] = giinfo[GI_PERIOD] + ((period - giinfo[GI_PERIOD]) >> 3)
+        else:
+            giinfo[GI_PERIOD] = period
+
+    if DEBUG:
+        ps[PS_ZC_COUNT] = ps[PS_ZC_COUNT] + 1
+    # Start storing data to the next slots in gi_samples
+    offset = ps[PS_GIOFFSET] + TRIAC_NUM
+    if offset >= TRIAC_NUM*TRIAC_CYCLES:
+        brightness = ptr8(gi_brightness)
+        new_power_cycle(ps[PS_TRIACDATA], ptr8(gi_samples), brightness)
+        if int(publish_gi(ptr8(statebuf), ptr32(stateseq), ptr32(journalbuf), ptr32(journalidx),
+                          brightness, ptr8(gi_old), zctime)):
+            ps[PS_SIGNALS] = ps[PS_SIGNALS] | (1 << SIG_GI)
+        offset = 0
+        ps[PS_READY] = ps[PS_READY] | ps[PS_GIWINDOW]
+        ps[PS_GIWINDOW] = READY_GI
+    ps[PS_GIOFFSET] = offset
+
+@micropython.viper
+def decode_words(ps: ptr32, ring: ptr32, ringtail: int, n: int) -> int:
+    # Decodes n words from the ring buffer, returns the new tail
+    global update_counter
+    colmapping = ptr8(COLMAPPING)
+    if INSTRUMENT:
+        linstr = ptr32(instrwork)
+        addrbin = ptr8(ADDRBIN)
+    lampscol = ps[PS_LAMPSCOL]
+    updates = ps[PS_UPDATES]
+
+    while n > 0:
+        n -= 1
 
-    # This is a performance hack to replace 8 if statements by a table lookup
-    # when mapping colums to an 0-7 value
-    colmapping = ptr8(bytearray(256))
-    for i in range(0,255):
-        colmapping[i] = -1
-    for i in range(0,7):
-        colmapping[1<<i]=i
-        
-    pindata=int(0)
-    fdata=int(0)
-    zc=int(0)
-    lfifo_count=int(0)
-    lmax_fifo=int(0)
-    lupdate_counter=int(0)
-    
-    lampscol=int(0)
-    lampsrow=int(0)
-    
-    zctime=int(0)
-    triac_set=int(0)
-    
-    brightness=int(0)
-    
-    # We store 10 triac cycles and caulculate the averegae over these to
-    # set the GI values as timing
-    max_brightnessoffset=int(TRIAC_NUM*TRIAC_CYCLES)
-    brightnessoffset = int(TRIAC_NUM*TRIAC_CYCLES)
-    brightnessdata = ptr8(bytearray(TRIAC_NUM*TRIAC_CYCLES))
-    triacdata = int(0)
-    
-    i=0
-    
-    
-    while running:
-    
         lamps_updated=0
         solenoids_updated=0
-        
-        # Check zero crossing first
-        fdata=int(lzcmachine.rx_fifo())
-        if fdata:
-            # Zerocrossing detected, just clean queue, data
-            # are not interesting
-            zctime=int(utime.ticks_us())
-            lzcmachine.get()
-            
+
+        pindata = ring[ringtail & RING_MASK]
+        ringtail += 1
+
+        if pindata > 0x7fff:
+            # Column and row combined by read_data_paired, decode the
+            # column and continue with the row word
+            lampscol = colmapping[pindata & 0xff]
             if DEBUG:
-                lzc_detected += 1
-                zc_detected=lzc_detected
-            # Start storing data to the next slots in triacsarray
-            brightnessoffset += TRIAC_NUM
-            if brightnessoffset>=max_brightnessoffset:
-                new_power_cycle(triacdata, brightnessdata, lbrightness)
-                brightnessoffset = 0
+                ps[PS_COLS] = ps[PS_COLS] + 1
+            pindata = pindata >> 8
 
-        fdata=int(ldatamachine.rx_fifo())
-        if not fdata:
-            continue
-        
-        if DEBUG:
-            lfifo_count += 1
-            lfifo_sum += fdata
-            fifo_count=lfifo_count
-            fifo_sum=lfifo_sum
-        
-        if fdata > lmax_fifo:
-            lmax_fifo=fdata
-            set_max_fifo(lmax_fifo)
+        updates += 1
 
-            
-        d = int(ldatamachine.get())
-        pindata = d & 0x7fff
-            
-        lupdate_counter += 1
-        
         data=pindata & 0xff
-        address=pindata >> 8
-        zc=address>>7
-        address=address & 0x7f
- 
+        address=(pindata >> 8) & 0x7f
+
+        if INSTRUMENT:
+            linstr[IH_ADDR+addrbin[address]] = linstr[IH_ADDR+addrbin[address]] + 1
+            linstr[I_WORDS] = linstr[I_WORDS] + 1
+
         if address==A_LROW:
-            if lampscol >=0:
-                if DEBUG:
-                    lrows_detected += 1
-                    rows_detected=lrows_detected
-                if llamps[lampscol] != data:
-                    llock.acquire()
-                    llamps[lampscol] = data
-                    llock.release()
-                    lamps_updated=1
-            else:
+            if lampscol == NO_COLUMN:
                 continue
-            lampscol = -1
-            
-        elif (address==A_LCOL):
-            
+            lamps_updated = int(decode_row(ps, lampscol, data))
+            lampscol = NO_COLUMN
+
+        elif address==A_LCOL:
             if data==0:
                 continue
-            
+            # NO_COLUMN for anything but a single bit
             lampscol = colmapping[data]
-            
-            if (lampscol < 0) or (lampscol > 7):
-                lampscol = -1
-                
-            if DEBUG:
-                lcols_detected += 1
-                cols_detected=lcols_detected
-
-        elif (address==A_SOL1):
-            if data != lsolenoids[0]:
-                slock.acquire()
-                lsolenoids[0]=data
-                slock.release()
-                solenoids_updated=1
-        elif (address==A_SOL2):
-            if data != lsolenoids[1]:
-                slock.acquire()
-                lsolenoids[1]=data
-                slock.release()
-                solenoids_updated=1
-        elif (address==A_SOL3):
-            if data != lsolenoids[2]:
-                slock.acquire()
-                lsolenoids[2]=data
-                slock.release()
-                solenoids_updated=1
-        elif (address==A_SOL4):
-            if data != lsolenoids[3]:
-                slock.acquire()
-                lsolenoids[3]=data
-                slock.release()
-                solenoids_updated=1
-        elif (address==A_TRIACS):
             if DEBUG:
-                ltriacs_detected += 1
-                triacs_detected=ltriacs_detected
-                
-                # Only do something if zero crossing is set
-                if zctime:
-                    triacdata=data
-                    ttime=int(utime.ticks_us())
-                    updatebrightness(ttime-zctime, triacdata, brightnessdata, brightnessoffset)
-                    
-        elif address==0:
-            # this should not happen
-            if DEBUG >= DEBUG_VERBOSE:
-                print("Ooops, got a 0 address: ",pindata)
-            found_address_error()
+                ps[PS_COLS] = ps[PS_COLS] + 1
+
+        elif address==A_SOL1:
+            solenoids_updated = int(decode_solenoids(ps, 0, data))
+        elif address==A_SOL2:
+            solenoids_updated = int(decode_solenoids(ps, 1, data))
+        elif address==A_SOL3:
+            solenoids_updated = int(decode_solenoids(ps, 2, data))
+        elif address==A_SOL4:
+            solenoids_updated = int(decode_solenoids(ps, 3, data))
+        elif address==A_TRIACS:
+            # With stamp_zc_triacs, triacs are handled with the zero crossings
+            if not int(gi_stamped):
+                decode_triacs(ps, data)
 
         else:
             # this should not happen
             if DEBUG >= DEBUG_VERBOSE:
                 print("Ooops, unknown address: ",pindata)
-            found_address_errors()
-        
+            found_address_error()
+
         if lamps_updated:
-            lupdate_counter += 1
-            update_counter = lupdate_counter
+            ps[PS_SIGNALS] = ps[PS_SIGNALS] | (1 << SIG_LAMPS)
+            updates += 1
+            update_counter = updates
             if lamp_notify:
                  lamp_notify()
             if DEBUG >= DEBUG_VERBOSE:
                 print("lamps: ",lamps)
- 
+
         if solenoids_updated:
-            lupdate_counter += 1
-            update_counter = lupdate_counter
+            ps[PS_SIGNALS] = ps[PS_SIGNALS] | (1 << SIG_SOLENOIDS)
+            updates += 1
+            update_counter = updates
             if solenoid_notify:
                  solenoid_notify()
             if DEBUG >= DEBUG_VERBOSE:
                 print("Solenoids: ",solenoids)
-                
+
+    ps[PS_LAMPSCOL] = lampscol
+    ps[PS_UPDATES] = updates
+    return ringtail
+
+@micropython.viper
+def signal_changes(ps: ptr32):
+    # Publishes the READY_* bits seen, marks the state valid once everything
+    # has been seen and signals the changes to asyncio
+    info = ptr32(readyinfo)
+    ready = ps[PS_READY]
+    if ready != info[RD_SEEN]:
+        if ready == READY_ALL:
+            info[RD_TIME_US] = (int(utime.ticks_us()) - info[RD_START]) & TICKS_MASK
+            info[RD_READY] = 1
+            ready = READY_ALL | READY_DONE
+            ps[PS_READY] = ready
+        info[RD_SEEN] = ready
+        ps[PS_SIGNALS] = ps[PS_SIGNALS] | (1 << SIG_READY)
+
+    signals = ps[PS_SIGNALS]
+    if signals:
+        sigseq = ptr32(signalseq)
+        for k in range(SIG_NUM):
+            if signals & (1 << k):
+                sigseq[k] = sigseq[k] + 1
+        flag = signal_flag
+        if flag:
+            flag.set()
+        ps[PS_SIGNALS] = 0
+
+@micropython.viper
+def updateloop():
+    global finished
+    global ring_overruns
+
+    # Cache some global objects
+    ldatamachine = datamachine
+    lzcmachine = zcmachine
+    lflight = ptr32(flightbuf)
+    lflightzc = ptr8(flightzc)
+    lfinfo = ptr32(flightinfo)
+    lrinfo = ptr32(readyinfo)
+    lstamped = int(gi_stamped)
+
+    reset_pollstate()
+    ps = ptr32(pollstate)
+
+    lglitch = int(glitch_m)
+    lgf = ptr8(glitchbuf)
+    if lglitch:
+        for i in range(GLITCH_BYTES*GF_FIELDS):
+            lgf[i] = 0
+        lgf[GF_N] = int(glitch_n)
+        lgf[GF_M] = lglitch
+
+    if INSTRUMENT:
+        linstr = ptr32(instrwork)
+        linstrpub = ptr32(instrpub)
+        linstrseq = ptr32(instrseq)
+        for i in range(INSTR_SIZE):
+            linstr[i] = 0
+        now = int(utime.ticks_us())
+        lastloop = now
+        lastpublish = now
+        busy = int(0)
+        elapsedus = int(0)
+    publishcount = int(0)
+
+    lmax_fifo=int(0)
+
+    # Ring buffer between the RX FIFO and the decoder
+    ring = ptr32(ringbuf)
+    ringhead = int(0)
+    ringtail = int(0)
+    lburst = int(ingest_burst)
+    lbatch = int(decode_batch)
+    lring_overruns = int(0)
+
+    while running:
+
+        if INSTRUMENT:
+            now = int(utime.ticks_us())
+            # Only iterations that decoded words, idle spins would make the
+            # loop look faster than it is
+            if busy:
+                dt = (now - lastloop) & TICKS_MASK
+                bin = 0
+                while dt and bin < LOOP_BINS-1:
+                    dt = dt >> 1
+                    bin += 1
+                linstr[IH_LOOP+bin] = linstr[IH_LOOP+bin] + 1
+            lastloop = now
+
+        # Publish statistics periodically instead of on every word, the
+        # instrumentation at least every PUBLISH_US
+        if INSTRUMENT:
+            if ((now - lastpublish) & TICKS_MASK) >= PUBLISH_US:
+                publishcount = PUBLISH_WORDS
+        if publishcount >= PUBLISH_WORDS:
+            publishcount = 0
+            if DEBUG:
+                publish_debug_counters()
+            if INSTRUMENT:
+                elapsedus += (now - lastpublish) & TICKS_MASK
+                lastpublish = now
+                linstr[I_ELAPSED_MS] = linstr[I_ELAPSED_MS] + elapsedus // 1000
+                elapsedus = elapsedus % 1000
+                publish_instrumentation(linstr, linstrpub, linstrseq)
+
+        # Check zero crossing first
+        fdata=int(lzcmachine.rx_fifo())
+        if fdata:
+            zcword=int(lzcmachine.get())
+            if lfinfo[FR_STATE] != FR_FROZEN:
+                flight_zc(lflight, lflightzc, lfinfo, int(utime.ticks_us()), zcword)
+            decode_zc(ps, zcword, lstamped)
+
+        fdata=int(ldatamachine.rx_fifo())
+        if fdata:
+            fnow = int(utime.ticks_us())
+            if DEBUG:
+                ps[PS_FIFO_COUNT] = ps[PS_FIFO_COUNT] + 1
+                ps[PS_FIFO_SUM] = ps[PS_FIFO_SUM] + fdata
+
+            if INSTRUMENT:
+                if fdata < FIFO_BINS:
+                    linstr[IH_FIFO+fdata] = linstr[IH_FIFO+fdata] + 1
+                else:
+                    linstr[IH_FIFO+FIFO_BINS-1] = linstr[IH_FIFO+FIFO_BINS-1] + 1
+                # fnow, not now: the zero crossing of this iteration was
+                # decoded after now was read
+                zctime = ps[PS_ZCTIME]
+                if zctime:
+                    bin = ((fnow - zctime) & TICKS_MASK) >> ZC_BIN_SHIFT
+                    if bin >= ZC_BINS:
+                        bin = ZC_BINS-1
+                    linstr[IH_ZC+bin] = linstr[IH_ZC+bin] + 1
+
+            if fdata > lmax_fifo:
+                lmax_fifo=fdata
+                set_max_fifo(lmax_fifo)
+            if fdata >= FIFO_DEPTH:
+                found_overflow()
+
+            # Drain the pending words into the ring buffer. If the ring is full,
+            # the remaining words stay in the FIFO
+            if fdata > lburst:
+                fdata = lburst
+            free = RING_SIZE - (ringhead - ringtail)
+            if fdata > free:
+                fdata = free
+                lring_overruns += 1
+                ring_overruns = lring_overruns
+                flight_trigger(FLIGHT_RING)
+            ringhead = int(ingest_words(ldatamachine, ring, ringhead, fdata,
+                                        lflight, lflightzc, lfinfo, fnow))
+
+        # Decode a batch of words from the ring buffer
+        nwords = ringhead - ringtail
+        if nwords > lbatch:
+            nwords = lbatch
+        if nwords:
+            publishcount += nwords
+            ringtail = int(decode_words(ps, ring, ringtail, nwords))
+        if INSTRUMENT:
+            busy = nwords
+
+        if ps[PS_SIGNALS] or ps[PS_READY] != lrinfo[RD_SEEN]:
+            signal_changes(ps)
+
+    # Publish the final statistics
+    if DEBUG:
+        publish_debug_counters()
+    if INSTRUMENT:
+        now = int(utime.ticks_us())
+        elapsedus += (now - lastpublish) & TICKS_MASK
+        lastpublish = now
+        linstr[I_ELAPSED_MS] = linstr[I_ELAPSED_MS] + elapsedus // 1000
+        elapsedus = elapsedus % 1000
+        publish_instrumentation(linstr, linstrpub, linstrseq)
     finished=True
-    
+
 class PowerMonitor():
 
-    def __init__(self, gpio_base=0, statemachine_base=0):
+    def __init__(self, gpio_base=0, statemachine_base=0,
+                 ingest_burst=INGEST_BURST, decode_batch=DECODE_BATCH,
+                 pair_lamps=False, stamp_gi=False, glitch_filter=None):
         global clockmachine
         global datamachine
         global zcmachine
+        global gi_stamped
+        
+        self.set_ingestion(ingest_burst, decode_batch)
+        if glitch_filter:
+            self.set_glitch_filter(*glitch_filter)
         
         clockmachine = rp2.StateMachine(statemachine_base,
                                         wait_clock,
                                         in_base=machine.Pin(gpio_base+8))
 
-        datamachine = rp2.StateMachine(statemachine_base+1,
-                                       read_data,
-                                       in_base=machine.Pin(gpio_base))
+        if pair_lamps:
+            # Lamp columns and rows are combined in the state machine
+            datamachine = rp2.StateMachine(statemachine_base+1,
+                                           read_data_paired,
+                                           in_base=machine.Pin(gpio_base),
+                                           jmp_pin=machine.Pin(gpio_base+13))
+        else:
+            datamachine = rp2.StateMachine(statemachine_base+1,
+                                           read_data,
+                                           in_base=machine.Pin(gpio_base))
+        self.pair_lamps = pair_lamps
         
-        zcmachine = rp2.StateMachine(statemachine_base+2,
-                                       wait_zerocrossing,
-                                       in_base=machine.Pin(gpio_base))
+        if stamp_gi:
+            # There's no space left in the PIO block of the other state
+            # machines, use a state machine of the other block
+            zcmachine = rp2.StateMachine((statemachine_base+4) % 8,
+                                         stamp_zc_triacs,
+                                         freq=STAMP_FREQ,
+                                         in_base=machine.Pin(gpio_base+15),
+                                         jmp_pin=machine.Pin(gpio_base+8))
+        else:
+            zcmachine = rp2.StateMachine(statemachine_base+2,
+                                         wait_zerocrossing,
+                                         in_base=machine.Pin(gpio_base))
+        gi_stamped = stamp_gi
         
         self.monitor_thread=None
+        self.pipeline=None
+        self.notifier=None
+        self.intensity = bytearray(64)
+        self.load_gi_calibration()
 
         if DEBUG:
             print ("State machines started")
             
 
+    def set_ingestion(self, burst=INGEST_BURST, batch=DECODE_BATCH):
+        # Needs to be set before start()
+        global ingest_burst
+        global decode_batch
+        if burst < 1 or burst > RING_SIZE or batch < 1:
+            raise ValueError("invalid ingestion parameters")
+        ingest_burst = burst
+        decode_batch = batch
+
+    def set_glitch_filter(self, n=0, m=0):
+        # A lamp or solenoid only changes if n of the last m words agree,
+        # n=0 turns the filter off. Needs to be set before start().
+        global glitch_n
+        global glitch_m
+        if n == 0:
+            glitch_n = 0
+            glitch_m = 0
+            return
+        if m > GLITCH_MAX or n > m or 2*n <= m:
+            raise ValueError("invalid glitch filter, m <= 8 and m/2 < n <= m")
+        glitch_n = n
+        glitch_m = m
+    
+    def calibrate_gi(self, save=True, path=GI_CALIBRATION_FILE):
+        # Builds the GI lookup table from the delays observed since the start
+        # (or reset_gi_calibration()). The GI should have been dimmed through
+        # its levels, e.g. in attract mode. Returns the table or None if there
+        # isn't enough data. If save is set, it is written to flash.
+        lut = gi_lut_from_histogram(gi_delayhist, gi_info[GI_PERIOD])
+        if lut is None:
+            return None
+        gi_lut[:] = lut
+        if save:
+            with open(path, "wb") as f:
+                f.write(lut)
+        return lut
+    
+    def load_gi_calibration(self, path=GI_CALIBRATION_FILE):
+        # Loads a table saved by calibrate_gi(), returns False if there is none
+        try:
+            with open(path, "rb") as f:
+                lut = f.read()
+        except OSError:
+            return False
+        if len(lut) != GI_LUT_SIZE:
+            return False
+        gi_lut[:] = lut
+        return True
+    
+    def reset_gi_calibration(self, defaults=False):
+        # Clears the observed delays, optionally restores the default table
+        for i in range(GI_LUT_SIZE):
+            gi_delayhist[i] = 0
+        if defaults:
+            gi_lut[:] = default_gi_lut()
+    
+    def get_gi_delay_histogram(self):
+        # Observed delays between zero crossing and triac, GI_LUT_STEP_US per bin
+        return list(gi_delayhist)
+    
+    def get_gi_triacs(self):
+        # Bit mask of the triacs that fired since the start (0x1f on WPC,
+        # 0x07 on WPC-95)
+        return gi_info[GI_TRIAC_MASK]
+    
+    def get_lamp_intensity(self, buf=None):
+        # Returns a bytearray(64) with the brightness (0-255) of each lamp,
+        # index is column*8+row. The value is the fraction of the last
+        # INTENSITY_WINDOW matrix scans in which the lamp was on.
+        if buf is None:
+            buf = self.intensity
+        while True:
+            seq = intensityseq[0]
+            if not seq & 1:
+                extract_intensity(intensityplanes, buf)
+                if intensityseq[0] == seq:
+                    return buf
+    
+    def get_solenoid_stats(self, sol):
+        # Pulse statistics of a solenoid (group*8+bit, group 0-3 is SOL1-SOL4)
+        p = sol*SOL_FIELDS
+        on = solpulse[p+SP_ON]
+        activations = solpulse[p+SP_COUNT]
+        now = utime.ticks_us()
+        
+        on_us = 0
+        if solpulse[p+SP_ACTIVE]:
+            on_us = utime.ticks_diff(now, on)
+            
+        rate = 0
+        elapsed = update_soltime()
+        if elapsed > 0:
+            rate = activations * 1000 / elapsed
+            
+        h = sol*SOL_HIST_BINS
+        return {
+            "activations": activations,
+            "rate": rate,
+            "last_pulse_us": solpulse[p+SP_LAST],
+            "on_us": on_us,
+            "histogram": list(solhist[h:h+SOL_HIST_BINS]),
+            }
+    
+    def reset_solenoid_stats(self):
+        for i in range(len(solhist)):
+            solhist[i] = 0
+        for i in range(SOL_NUM):
+            solpulse[i*SOL_FIELDS+SP_COUNT] = 0
+        reset_soltime()
+    
+    def read_events(self, buf):
+        # Copies up to len(buf)//EVENT_WORDS events from the journal into buf
+        # (an array('I')) and returns the number of events. Each event uses
+        # EVENT_WORDS entries: the timestamp (utime.ticks_us) and
+        # index << 16 | old << 8 | new, index is the offset in the state
+        # (see STATE_*). With a pipeline, the events go to the pipeline
+        # instead.
+        return drain_events(eventbuf, eventidx, buf, len(buf) // EVENT_WORDS)
+    
+    def get_event_drops(self):
+        return journalidx[EV_DROPS]
+        
     def set_lamp_notify(self, notify_func):
+        # With a pipeline, the pipeline calls the function instead of the
+        # poller
         global lamp_notify
-        lamp_notify = notify_func
+        if self.pipeline:
+            self.pipeline.set_lamp_notify(notify_func)
+        else:
+            lamp_notify = notify_func
         
     def set_solenoid_notify(self, notify_func):
         global solenoid_notify
-        solenoid_notify = notify_func
+        if self.pipeline:
+            self.pipeline.set_solenoid_notify(notify_func)
+        else:
+            solenoid_notify = notify_func
+        
+    def snapshot(self, buf=None):
+        # Returns (seq, buf) with a consistent copy of lamps, solenoids and GI in
+        # buf (STATE_SIZE bytes, see STATE_LAMPS, STATE_SOLENOIDS, STATE_GI).
+        # seq increases with every published change. This never blocks the
+        # poller, if the state changes while copying, the copy is repeated.
+        if buf is None:
+            buf = bytearray(STATE_SIZE)
+        state = memoryview(statebuf)
+        while True:
+            seq = stateseq[0]
+            offset = (seq & 1) * STATE_SIZE
+            buf[0:STATE_SIZE] = state[offset:offset+STATE_SIZE]
+            if stateseq[0] == seq:
+                return seq, buf
         
+    def get_lamp_frame(self, buf=None):
+        # Returns (frame, buf) with the last complete scan of the lamp matrix
+        # in buf (FRAME_SIZE bytes, one per column). frame is the number of the
+        # scan, it increases with every complete scan.
+        if buf is None:
+            buf = bytearray(FRAME_SIZE)
+        frame = memoryview(framebuf)
+        while True:
+            seq = frameseq[0]
+            copy = seq & 1
+            offset = copy * FRAME_SIZE
+            buf[0:FRAME_SIZE] = frame[offset:offset+FRAME_SIZE]
+            n = framecount[copy]
+            if frameseq[0] == seq:
+                return n, buf
+    
+    def get_frame_count(self):
+        return framecount[1]
+    
+    def async_notifier(self):
+        # The ChangeNotifier (see asyncmon.py) the poller signals
+        global signal_flag
+        if self.notifier is None:
+            import asyncmon
+            self.notifier = asyncmon.ChangeNotifier(signalseq)
+            signal_flag = self.notifier.flag
+        return self.notifier
+    
+    async def lamps_changed(self):
+        # Waits until a lamp changed, returns get_lamps()
+        await self.async_notifier().wait(SIG_LAMPS)
+        return self.get_lamps()
+    
+    async def solenoids_changed(self):
+        await self.async_notifier().wait(SIG_SOLENOIDS)
+        return self.get_solenoids()
+    
+    async def gi_changed(self):
+        await self.async_notifier().wait(SIG_GI)
+        return self.get_gi()
+    
+    async def frame(self, buf=None):
+        # Waits for the next complete lamp matrix scan, returns
+        # get_lamp_frame()
+        await self.async_notifier().wait(SIG_FRAME)
+        return self.get_lamp_frame(buf)
+    
+    async def ready(self, mask=READY_ALL):
+        # Waits until the READY_* bits of mask have been seen, with READY_ALL
+        # until the state is valid (see is_ready())
+        notifier = self.async_notifier()
+        while (readyinfo[RD_SEEN] & mask) != mask:
+            await notifier.wait(SIG_ANY)
+    
+    def changes(self, batch=16):
+        # Async iterator over the changes in the event journal, yields
+        # (timestamp, index, old, new), see read_events()
+        import asyncmon
+        return asyncmon.ChangeStream(self, self.async_notifier(), batch)
+    
     def get_lamps(self):
-        lamp_lock.acquire()
-        res=int.from_bytes(lamps,'big')
-        lamp_lock.release()
-        return res
+        seq, buf = self.snapshot()
+        return int.from_bytes(buf[STATE_LAMPS:STATE_SOLENOIDS],'big')
         
     def get_solenoids(self):
-        lamp_lock.acquire()
-        res=int.from_bytes(solenoids,'big')
-        lamp_lock.release()
-        return res
+        seq, buf = self.snapshot()
+        return int.from_bytes(buf[STATE_SOLENOIDS:STATE_GI],'big')
     
     def get_gi(self):
-        res=int.from_bytes(gi_brightness,'big')
-        return res
+        seq, buf = self.snapshot()
+        return int.from_bytes(buf[STATE_GI:STATE_SIZE],'big')
         
         
-    def start(self):
+    def start(self, pipeline=None):
+        # Starts the poller thread (second core). With a pipeline (see
+        # pipeline.py), the poller only reads and decodes the bus words and
+        # writes the changes into the queue of the pipeline, the notify
+        # functions are called by the pipeline. Run the pipeline on the first
+        # core (the main program) with pipeline.run().
         global running
         global finished
+        global journalbuf
+        global journalidx
+        global lamp_notify
+        global solenoid_notify
         
+        if pipeline:
+            journalbuf = pipeline.queue.buf
+            journalidx = pipeline.queue.idx
+            if lamp_notify:
+                pipeline.set_lamp_notify(lamp_notify)
+            if solenoid_notify:
+                pipeline.set_solenoid_notify(solenoid_notify)
+            lamp_notify = 0
+            solenoid_notify = 0
+            pipeline.attach(self)
+        else:
+            journalbuf = eventbuf
+            journalidx = eventidx
+        self.pipeline = pipeline
+        
+        reset_soltime()
+        readyinfo[RD_READY] = 0
+        readyinfo[RD_TIME_US] = 0
+        readyinfo[RD_SEEN] = 0
+        readyinfo[RD_START] = utime.ticks_us()
         running=True
         finished=False
         
@@ -495,9 +1929,25 @@ class PowerMonitor():
             print ("Monitoring thread started")
             
 
+    def is_ready(self):
+        # True once the poller has seen a complete lamp scan, all solenoid
+        # groups and a GI power cycle since start()
+        return readyinfo[RD_READY] == 1
+    
+    def wait_ready(self, timeout_ms=1000):
+        # Waits until is_ready(), returns False after timeout_ms
+        start = utime.ticks_ms()
+        while not readyinfo[RD_READY]:
+            if utime.ticks_diff(utime.ticks_ms(), start) >= timeout_ms:
+                return False
+            utime.sleep_ms(1)
+        return True
+    
     def stop(self):
         global running
         global finished
+        global lamp_notify
+        global solenoid_notify
         
         running=False
         
@@ -511,36 +1961,128 @@ class PowerMonitor():
         datamachine.active(0)
             
         self.monitor_thread=None
+        if self.pipeline:
+            # The poller calls the notify functions again after the next start()
+            lamp_notify = self.pipeline.lamp_notify or 0
+            solenoid_notify = self.pipeline.solenoid_notify or 0
+            self.pipeline = None
         
         if DEBUG:
             print ("Monitoring thread stopped")
             
     def get_stats(self):
         
+        stats = {
+            "max_fifo": max_fifo,
+            "update_counter": update_counter,
+            "overflow": overflow,
+            "address_errors": address_errors,
+            "ring_overruns": ring_overruns,
+            "event_drops": journalidx[EV_DROPS],
+            "event_high_water": journalidx[EV_HIGH],
+            "gi_triacs": gi_info[GI_TRIAC_MASK],
+            "gi_period_us": gi_info[GI_PERIOD],
+            "glitches_suppressed": glitchstats[0],
+            "lamp_frames": framecount[1],
+            "lamp_frames_incomplete": frameinfo[FRI_INCOMPLETE],
+            "lamp_scan_hz": 1000000 / frameinfo[FRI_PERIOD] if frameinfo[FRI_PERIOD] else 0,
+            "flight_state": flightinfo[FR_STATE],
+            "flight_reason": flightinfo[FR_REASON],
+            "ready": readyinfo[RD_READY] == 1,
+            "time_to_ready_ms": readyinfo[RD_TIME_US] / 1000 if readyinfo[RD_READY] else None,
+            }
+        
+        if self.notifier:
+            # Changes the poller signalled and how often asyncio woke up
+            notifier = self.notifier.get_stats()
+            stats["async_signals"] = notifier["signals"]
+            stats["async_wakeups"] = notifier["wakeups"]
+            
         if DEBUG:
-            return {
-                "max_fifo": max_fifo,
-                "update_counter": update_counter,
-                "overflow": overflow,
-                "address_errors": address_errors,
-                "rows_detected": rows_detected,
-                "cols_detected": cols_detected,
-                "zc_detected": zc_detected,
-                "triacs_detected": triacs_detected,
-                "triac_min_time": triac_min_time,
-                "triac_max_time": triac_max_time,
-                }
-        else:
-            return {
-                "max_fifo": max_fifo,
-                "update_counter": update_counter,
-                "overflow": overflow,
-                "address_errors": address_errors,
-                }
+            stats["rows_detected"] = rows_detected
+            stats["cols_detected"] = cols_detected
+            stats["zc_detected"] = zc_detected
+            stats["triacs_detected"] = triacs_detected
+            stats["triac_min_time"] = triac_min_time
+            stats["triac_max_time"] = triac_max_time
+            
+        if INSTRUMENT:
+            instr = self.get_instrumentation()
+            stats["loop_us_hist"] = list(instr[IH_LOOP:IH_LOOP+LOOP_BINS])
+            stats["fifo_depth_hist"] = list(instr[IH_FIFO:IH_FIFO+FIFO_BINS])
+            stats["zc_phase_hist"] = list(instr[IH_ZC:IH_ZC+ZC_BINS])
+            rates = {}
+            for i in range(ADDR_BINS):
+                count = instr[IH_ADDR+i]
+                if instr[I_ELAPSED_MS]:
+                    rates[ADDRESS_NAMES[i]] = count * 1000 / instr[I_ELAPSED_MS]
+                else:
+                    rates[ADDRESS_NAMES[i]] = 0
+            stats["address_rates"] = rates
+            
+        return stats
+    
+    def get_instrumentation(self, buf=None):
+        # Copy of the published instrumentation data (INSTR_SIZE words, see
+        # IH_*, I_WORDS, I_ELAPSED_MS). The poller publishes it every
+        # PUBLISH_WORDS words or PUBLISH_US, whichever comes first.
+        if buf is None:
+            buf = array('I', [0]*INSTR_SIZE)
+        while True:
+            seq = instrseq[0]
+            if not seq & 1:
+                buf[0:INSTR_SIZE] = instrpub
+                if instrseq[0] == seq:
+                    return buf
     
     def get_overflow(self):
         return overflow
     
+    def get_flight_records(self):
+        # Records of the flight recorder as (timestamp, word), oldest first.
+        # Unless the recorder is frozen, the poller keeps overwriting them.
+        # The words of the zero cross machine have FLIGHT_ZC set, with
+        # stamp_gi a triac strobe is recorded by both machines.
+        head = flightinfo[FR_HEAD]
+        n = min(head, FLIGHT_SIZE)
+        records = []
+        for i in range(head - n, head):
+            j = (i & FLIGHT_MASK) << 1
+            w = flightbuf[j+1]
+            if flightzc[i & FLIGHT_MASK]:
+                w |= FLIGHT_ZC
+            records.append((flightbuf[j], w))
+        return records
+    
+    def flight_frozen(self):
+        # Returns the anomalies (FLIGHT_*) that froze the flight recorder or 0
+        if flightinfo[FR_STATE] == FR_FROZEN:
+            return flightinfo[FR_REASON]
+        return 0
+    
+    def dump_flight_record(self, out=FLIGHT_FILE):
+        # Writes the flight recorder as a capture file (replay it with
+        # hostsim.replay). out is a file name or an object with write(), e.g.
+        # a UART. Returns the number of records.
+        words = flight_bus_words(self.get_flight_records(), gi_stamped)
+        if isinstance(out, str):
+            with open(out, "wb") as f:
+                return write_capture(f, words)
+        return write_capture(out, words)
+    
+    def rearm_flight_recorder(self):
+        flightinfo[FR_REASON] = 0
+        flightinfo[FR_STATE] = FR_ARMED
+    
+    def check_flight_recorder(self, out=FLIGHT_FILE):
+        # Call this periodically: if an anomaly froze the flight recorder, it
+        # is dumped and rearmed. Returns the anomalies or 0.
+        reason = self.flight_frozen()
+        if reason:
+            self.dump_flight_record(out)
+            self.rearm_flight_recorder()
+        return reason
+    
     def reset_overflow(self):
         global overflow
         overflow=0
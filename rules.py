@@ -0,0 +1,290 @@
+from micropython import const
+from array import array
+import utime
+
+# Rule engine
+#
+# Rules trigger actions (e.g. effects) on changes of lamps and solenoids:
+#
+#   engine = RuleEngine()
+#   engine.add_rule([solenoid(3)], play(sched, shaker, shake))
+#   engine.add_rule([lamp(12), lamp(13)], play(sched, led, ramp, PWM_RAMP),
+#                   hold_ms=200)
+#   engine.run(pm)
+#
+# A rule is a condition on the state bits: bits that must be on and bits that
+# must be off. It fires when the condition becomes true (RISING) or false
+# (FALLING), with hold_ms only if it stays like this for hold_ms.
+#
+# compile() converts the rules into tables: each rule is a list of terms
+# (state byte, mask, value), the condition is true if state & mask == value for
+# all terms. For each of the 96 state bits there's a list of the rules that
+# depend on it. On a change, only the rules of the bits that changed are
+# evaluated, so the cost depends on the change, not on the number of rules.
+
+# State bytes the rules use: lamps (8), solenoids (4), same layout as
+# PowerMonitor.snapshot()
+RULE_LAMPS = const(0)
+RULE_SOLENOIDS = const(8)
+RULE_STATE_SIZE = const(12)
+RULE_BITS = const(96)
+# Size of the whole snapshot (with the GI brightness)
+STATE_SIZE = const(17)
+
+RISING = const(1)
+FALLING = const(0)
+
+# Default mode of the effect actions, same as effects.PWM_SINGLESHOT
+PWM_SINGLESHOT = const(1)
+
+TERM_FIELDS = const(3)
+TERM_BYTE = const(0)
+TERM_MASK = const(1)
+TERM_VALUE = const(2)
+
+# counters
+RC_PASS = const(0)
+
+
+def lamp(n):
+    # State bit of lamp n (column*8+row)
+    return RULE_LAMPS*8 + n
+
+def solenoid(n):
+    # State bit of solenoid n (group*8+bit, group 0-3 is SOL1-SOL4)
+    return RULE_SOLENOIDS*8 + n
+
+def play_output(output, effect, mode=PWM_SINGLESHOT):
+    # Action that plays an effect on a PWMEffect, the length comes from the
+    # effect
+    return lambda: output.play_effect(effect, None, mode)
+
+def stop_output(output, rampdown=False):
+    return lambda: output.stop_effect(rampdown=rampdown)
+
+def play(scheduler, ch, effect, mode=PWM_SINGLESHOT):
+    # Action that plays an effect on a channel of an EffectScheduler
+    return lambda: scheduler.play_effect(ch, effect, None, mode)
+
+def stop(scheduler, ch, rampdown=False):
+    return lambda: scheduler.stop_effect(ch, rampdown=rampdown)
+
+
+@micropython.viper
+def eval_rules(eng, state: ptr8) -> int:
+    # Updates eng.state to state and evaluates the rules that depend on bits
+    # that changed. Rules whose condition changed are stored in eng.out as
+    # rule << 1 | condition. Returns their number.
+    prev = ptr8(eng.state)
+    changed = ptr8(eng.changed)
+    terms = ptr8(eng.terms)
+    info = ptr16(eng.info)
+    bitstart = ptr16(eng.bitstart)
+    bitrules = ptr16(eng.bitrules)
+    truth = ptr8(eng.truth)
+    mark = ptr16(eng.mark)
+    counters = ptr16(eng.counters)
+    out = ptr16(eng.out)
+
+    anychange = int(0)
+    for b in range(RULE_STATE_SIZE):
+        c = prev[b] ^ state[b]
+        changed[b] = c
+        if c:
+            prev[b] = state[b]
+            anychange = 1
+    if not anychange:
+        return 0
+
+    # Each rule is evaluated at most once per pass
+    passno = (counters[RC_PASS] + 1) & 0xffff
+    if passno == 0:
+        for r in range(int(eng.nrules)):
+            mark[r] = 0
+        passno = 1
+    counters[RC_PASS] = passno
+
+    nout = int(0)
+    for b in range(RULE_STATE_SIZE):
+        c = changed[b]
+        bit = b*8
+        while c:
+            if c & 1:
+                for i in range(bitstart[bit], bitstart[bit+1]):
+                    r = bitrules[i]
+                    if mark[r] == passno:
+                        continue
+                    mark[r] = passno
+
+                    t = info[2*r]*TERM_FIELDS
+                    end = t + info[2*r+1]*TERM_FIELDS
+                    ok = int(1)
+                    while t < end:
+                        if (prev[terms[t+TERM_BYTE]] & terms[t+TERM_MASK]) != terms[t+TERM_VALUE]:
+                            ok = 0
+                            break
+                        t += TERM_FIELDS
+                    if ok != truth[r]:
+                        truth[r] = ok
+                        out[nout] = (r << 1) | ok
+                        nout += 1
+            c = c >> 1
+            bit += 1
+    return nout
+
+
+class Rule():
+
+    def __init__(self, on, off, action, edge, hold_ms):
+        self.on = on
+        self.off = off
+        self.action = action
+        self.edge = edge
+        self.hold_ms = hold_ms
+        self.count = 0
+
+
+class RuleEngine():
+
+    def __init__(self):
+        self.rules = []
+        self.compiled = False
+        self.pending = {}
+        self.counters = array('H', [0])
+        self.state = bytearray(RULE_STATE_SIZE)
+        self.changed = bytearray(RULE_STATE_SIZE)
+        self.nrules = 0
+        self.evaluations = 0
+        self.running = False
+
+    def add_rule(self, on, action, off=(), edge=RISING, hold_ms=0):
+        # on/off: state bits (see lamp(), solenoid()) that must be on/off.
+        # action is called without arguments when the rule fires. Returns the
+        # number of the rule.
+        if not on and not off:
+            raise ValueError("empty rule")
+        for bit in tuple(on) + tuple(off):
+            if bit < 0 or bit >= RULE_BITS:
+                raise ValueError("invalid state bit")
+        self.rules.append(Rule(tuple(on), tuple(off), action, edge, hold_ms))
+        self.compiled = False
+        return len(self.rules) - 1
+
+    def compile(self):
+        n = len(self.rules)
+        terms = []
+        info = array('H', [0]*(2*n))
+        bitlists = [[] for i in range(RULE_BITS)]
+        for r in range(n):
+            rule = self.rules[r]
+            masks = {}
+            values = {}
+            for bit in rule.on + rule.off:
+                b = bit >> 3
+                masks[b] = masks.get(b, 0) | (1 << (bit & 7))
+                if bit in rule.on:
+                    values[b] = values.get(b, 0) | (1 << (bit & 7))
+                bitlists[bit].append(r)
+            info[2*r] = len(terms) // TERM_FIELDS
+            info[2*r+1] = len(masks)
+            for b in sorted(masks):
+                terms.extend((b, masks[b], values.get(b, 0)))
+
+        self.terms = bytearray(terms)
+        self.info = info
+        self.bitstart = array('H', [0]*(RULE_BITS+1))
+        flat = []
+        for bit in range(RULE_BITS):
+            self.bitstart[bit] = len(flat)
+            flat.extend(bitlists[bit])
+        self.bitstart[RULE_BITS] = len(flat)
+        self.bitrules = array('H', flat or [0])
+        self.truth = bytearray(n)
+        self.mark = array('H', [0]*max(1, n))
+        self.out = array('H', [0]*max(1, n))
+        self.nrules = n
+        self.pending = {}
+        self.compiled = True
+        self.reset(self.state)
+
+    def reset(self, state):
+        # Sets the state without firing any rule
+        if not self.compiled:
+            self.compile()
+        for b in range(RULE_STATE_SIZE):
+            self.state[b] = 0
+        # Rules that only have off bits are true in the empty state
+        for r in range(self.nrules):
+            self.truth[r] = 0 if self.rules[r].on else 1
+        eval_rules(self, state)
+        self.pending = {}
+
+    def update(self, state, now=None):
+        # Evaluates a new state (lamps and solenoids, e.g. a snapshot) and
+        # runs the actions of the rules that fire. Returns the number of
+        # rules that fired.
+        if not self.compiled:
+            self.compile()
+        if now is None:
+            now = utime.ticks_ms()
+        fired = 0
+        n = eval_rules(self, state)
+        self.evaluations += n
+        for i in range(n):
+            v = self.out[i]
+            r = v >> 1
+            rule = self.rules[r]
+            if (v & 1) == rule.edge:
+                if rule.hold_ms:
+                    self.pending[r] = utime.ticks_add(now, rule.hold_ms)
+                else:
+                    self.fire(r)
+                    fired += 1
+            elif r in self.pending:
+                del self.pending[r]
+        return fired + self.poll(now)
+
+    def poll(self, now=None):
+        # Fires the rules whose hold time has passed
+        if not self.pending:
+            return 0
+        if now is None:
+            now = utime.ticks_ms()
+        due = []
+        for r in self.pending:
+            if utime.ticks_diff(now, self.pending[r]) >= 0:
+                due.append(r)
+        for r in due:
+            del self.pending[r]
+            self.fire(r)
+        return len(due)
+
+    def fire(self, r):
+        rule = self.rules[r]
+        rule.count += 1
+        rule.action()
+
+    def get_count(self, r):
+        # How often a rule fired
+        return self.rules[r].count
+
+    def run(self, pm, poll_ms=1):
+        # Evaluates the rules on every change of the PowerMonitor state until
+        # stop() is called. Run this on the core that doesn't run the poller
+        # (the poller thread runs on the second core, so this is the main
+        # program).
+        buf = bytearray(STATE_SIZE)
+        seq, buf = pm.snapshot(buf)
+        self.reset(buf)
+        self.running = True
+        while self.running:
+            newseq, buf = pm.snapshot(buf)
+            if newseq != seq:
+                seq = newseq
+                self.update(buf)
+            elif self.pending:
+                self.poll()
+            utime.sleep_ms(poll_ms)
+
+    def stop(self):
+        self.running = False
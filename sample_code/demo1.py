@@ -25,7 +25,7 @@ def lamp_notify_demo():
     
     lamp_notifications += 1
     
-    l = pm.get_lights()
+    l = pm.get_lamps()
     
     ldiff = l_prev ^ l
     
@@ -63,10 +63,12 @@ def demo():
     
     pm = PowerMonitor()
     pm.start()
-    # Just delay a bit to make sure we get the current state of everything correctly
-    utime.sleep(0.1)
+    # Wait until the poller has seen the whole state (a complete lamp scan, all
+    # solenoids and the GI)
+    if not pm.wait_ready(1000):
+        print("No valid state after 1s, is the machine running?")
     # Read the initial lamp state
-    l_prev = pm.get_lights()
+    l_prev = pm.get_lamps()
     l_initial = l_prev
     
     # Read the initial solenoid state
@@ -87,7 +89,7 @@ def demo():
     print("Lamp change notifications: ", lamp_notifications)
     print("Initial lamps:     {0:0>64b}".format(l_initial))
     print("Lamps changed:     {0:0>64b}".format(l_changed))
-    print("Final lamps:       {0:0>64b}".format(pm.get_lights()))
+    print("Final lamps:       {0:0>64b}".format(pm.get_lamps()))
 
     print("Solenoid change notifications: ", solenoid_notifications)
     print("Initial solenoids: {0:0>32b}".format(s_initial))
@@ -0,0 +1,198 @@
+from micropython import const
+import utime
+
+# Shift register outputs
+#
+# Mirrors lamps, solenoids and GI strings to a chain of shift registers (e.g.
+# 74HC595) on the SPI outputs IO7+8 (GPIO 18/19, see doc/hardware.md):
+#
+#   spi = machine.SPI(0, baudrate=10000000, sck=machine.Pin(18),
+#                     mosi=machine.Pin(19))
+#   out = ShiftOutput(pm, spi, outputs=32, latch=machine.Pin(22, machine.Pin.OUT))
+#   out.map_lamp(12, 0)           # lamp 12 (column*8+row) -> output 0
+#   out.map_solenoid(3, 1)        # solenoid 3 (group*8+bit) -> output 1
+#   out.map_gi(0, 2)              # GI string 0 on -> output 2
+#   out.run()
+#
+# Output n is bit n%8 (Q0-Q7) of register n//8, register 0 is the first one
+# after the Pico. The whole chain is written with a single SPI write, only if a
+# mapped input changed.
+#
+# compile() converts the mapping into a bit permutation: for each pair of input
+# byte (lamp column, solenoid group, GI) and output byte that has mapped bits,
+# a table with 256 entries gives the output bits for every value of the input
+# byte. An update costs one table lookup per pair instead of one operation per
+# output.
+
+# Input bytes: lamp columns 0-7, solenoid groups 8-11, GI strings (bit n =
+# string n is on) 12
+IN_LAMPS = const(0)
+IN_SOLENOIDS = const(8)
+IN_GI = const(12)
+IN_SIZE = const(13)
+IN_BITS = const(104)
+GI_NUM = const(5)
+STATE_GI = const(12)
+STATE_SIZE = const(17)
+
+# mask: mapped bits of the input bytes, followed by the GI thresholds
+M_THRESHOLD = const(13)
+
+
+@micropython.viper
+def update_inputs(inp: ptr8, state: ptr8, mask: ptr8) -> int:
+    # Updates the input bytes from the state (see PowerMonitor.snapshot()),
+    # returns 1 if a mapped bit changed
+    changed = 0
+    for i in range(IN_GI):
+        v = state[i]
+        if (v ^ inp[i]) & mask[i]:
+            changed = 1
+        inp[i] = v
+    v = 0
+    for i in range(GI_NUM):
+        if state[STATE_GI+i] >= mask[M_THRESHOLD+i]:
+            v |= 1 << i
+    if (v ^ inp[IN_GI]) & mask[IN_GI]:
+        changed = 1
+    inp[IN_GI] = v
+    return changed
+
+
+@micropython.viper
+def permute(out: ptr8, inp: ptr8, pairs: ptr8, luts: ptr8):
+    # pairs: number of pairs (2 bytes), then input byte and output byte of each
+    # pair. luts: 256 bytes per pair. out must hold the inverted outputs.
+    n = pairs[0] | (pairs[1] << 8)
+    p = 2
+    lut = 0
+    for i in range(n):
+        o = pairs[p+1]
+        out[o] = out[o] ^ luts[lut + inp[pairs[p]]]
+        p += 2
+        lut += 256
+
+
+class ShiftOutput():
+
+    def __init__(self, pm, spi, outputs=8, latch=None, invert=False):
+        # outputs: length of the chain (a multiple of 8). latch: pin that
+        # transfers the shifted data to the outputs (RCLK of a 74HC595), pulsed
+        # after each write. invert: outputs are active low.
+        if outputs <= 0 or outputs % 8:
+            raise ValueError("outputs must be a multiple of 8")
+        self.pm = pm
+        self.spi = spi
+        self.latch = latch
+        self.invert = invert
+        self.outputs = outputs
+        self.nbytes = outputs // 8
+        self.sources = [None] * outputs
+        self.thresholds = bytearray([1] * GI_NUM)
+        self.state = bytearray(STATE_SIZE)
+        self.inp = bytearray(IN_SIZE)
+        self.buf = bytearray(self.nbytes)
+        self.compiled = False
+        self.running = False
+        self.updates = 0
+        self.writes = 0
+        if latch is not None:
+            latch.value(0)
+
+    def map_input(self, bit, output):
+        # Maps input bit (input byte*8+bit, see IN_*) to an output
+        if bit < 0 or bit >= IN_BITS:
+            raise ValueError("invalid input")
+        if output < 0 or output >= self.outputs:
+            raise ValueError("invalid output")
+        self.sources[output] = bit
+        self.compiled = False
+
+    def map_lamp(self, lamp, output):
+        # lamp: column*8+row
+        self.map_input(IN_LAMPS*8 + lamp, output)
+
+    def map_solenoid(self, sol, output):
+        # sol: group*8+bit, group 0-3 is SOL1-SOL4
+        self.map_input(IN_SOLENOIDS*8 + sol, output)
+
+    def map_gi(self, gi, output, threshold=1):
+        # The output is on while the brightness of GI string gi is at least
+        # threshold (1-8)
+        self.thresholds[gi] = threshold
+        self.map_input(IN_GI*8 + gi, output)
+
+    def unmap(self, output):
+        self.sources[output] = None
+        self.compiled = False
+
+    def compile(self):
+        # Bits of each (input byte, buffer byte) pair. Register 0 is sent
+        # last, so it is the last byte of the buffer.
+        groups = {}
+        for output in range(self.outputs):
+            bit = self.sources[output]
+            if bit is None:
+                continue
+            o = self.nbytes - 1 - output // 8
+            key = (bit >> 3, o)
+            groups.setdefault(key, []).append((bit & 7, output & 7))
+
+        keys = sorted(groups)
+        pairs = bytearray(2 + 2*len(keys))
+        pairs[0] = len(keys) & 0xff
+        pairs[1] = len(keys) >> 8
+        luts = bytearray(256 * len(keys))
+        mask = bytearray(IN_SIZE + GI_NUM)
+        for k in range(len(keys)):
+            i, o = keys[k]
+            pairs[2+2*k] = i
+            pairs[3+2*k] = o
+            base = 256*k
+            for inbit, outbit in groups[keys[k]]:
+                mask[i] |= 1 << inbit
+                for v in range(256):
+                    if v & (1 << inbit):
+                        luts[base+v] |= 1 << outbit
+        mask[M_THRESHOLD:M_THRESHOLD+GI_NUM] = self.thresholds
+
+        self.pairs = pairs
+        self.luts = luts
+        self.mask = mask
+        self.base = bytearray([0xff if self.invert else 0] * self.nbytes)
+        self.compiled = True
+        self.update(force=True)
+
+    def update(self, force=False):
+        # Writes the outputs if a mapped input changed. Returns True if the
+        # chain was written.
+        if not self.compiled:
+            self.compile()
+            return True
+        seq, state = self.pm.snapshot(self.state)
+        self.updates += 1
+        if not update_inputs(self.inp, state, self.mask) and not force:
+            return False
+        buf = self.buf
+        buf[:] = self.base
+        permute(buf, self.inp, self.pairs, self.luts)
+        self.spi.write(buf)
+        if self.latch is not None:
+            self.latch.value(1)
+            self.latch.value(0)
+        self.writes += 1
+        return True
+
+    def get_stats(self):
+        return {"updates": self.updates, "writes": self.writes,
+                "pairs": len(self.pairs) // 2 - 1 if self.compiled else 0}
+
+    def run(self, poll_ms=1):
+        # Updates the outputs until stop() is called
+        self.running = True
+        while self.running:
+            self.update()
+            utime.sleep_ms(poll_ms)
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,215 @@
+from micropython import const
+from array import array
+import utime
+
+# Streaming of the machine state over a UART
+#
+#   uart = machine.UART(0, baudrate=115200, tx=machine.Pin(16), rx=machine.Pin(17))
+#   streamer = StateStreamer(pm, uart)
+#   streamer.run()
+#
+# Each frame contains the bytes of the state (lamps, solenoids, GI, same layout
+# as PowerMonitor.snapshot()) that changed since the previous frame:
+#
+#   0     STREAM_MAGIC
+#   1     type: FRAME_DELTA or FRAME_KEY
+#   2-3   frame sequence number (little endian)
+#   4-6   bitmap of the state bytes in the frame (bit n = state byte n)
+#   7-    the state bytes of the bitmap
+#   last  CRC-16/CCITT-FALSE of bytes 1 to the end of the state bytes (2 bytes,
+#         little endian)
+#
+# Key frames contain the full state and are sent every keyframe_ms, receivers
+# can start decoding at any key frame and resync there after a lost frame
+# (gap in the sequence numbers) or a CRC error. If the bandwidth budget doesn't
+# allow sending a frame, the changes are combined into the next frame. Frames
+# are collected for batch_ms and written with a single write.
+#
+# hostsim/streamdecode.py decodes the stream on a PC.
+
+STREAM_MAGIC = const(0xa5)
+FRAME_DELTA = const(0)
+FRAME_KEY = const(1)
+F_TYPE = const(1)
+F_SEQ = const(2)
+F_BITMAP = const(4)
+F_DATA = const(7)
+BITMAP_BYTES = const(3)
+STREAM_STATE_SIZE = const(17)
+FRAME_CRC_SIZE = const(2)
+FRAME_MAX = const(26)    # F_DATA + STREAM_STATE_SIZE + FRAME_CRC_SIZE
+BATCH_SIZE = const(256)
+
+# half of the bandwidth of a UART at 115200 baud (10 bits per byte)
+STREAM_BUDGET = const(5760)
+KEYFRAME_MS = const(1000)
+BATCH_MS = const(20)
+
+
+def crc16_table():
+    # CRC-16/CCITT-FALSE (polynomial 0x1021)
+    table = array('H', [0]*256)
+    for i in range(256):
+        crc = i << 8
+        for j in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+        table[i] = crc
+    return table
+
+crctable = crc16_table()
+
+
+@micropython.viper
+def crc16(buf: ptr8, start: int, end: int, table: ptr16) -> int:
+    crc = 0xffff
+    for i in range(start, end):
+        crc = ((crc << 8) ^ table[((crc >> 8) ^ buf[i]) & 0xff]) & 0xffff
+    return crc
+
+
+@micropython.viper
+def encode_frame(frame: ptr8, state: ptr8, sent: ptr8, full: int) -> int:
+    # Writes the bitmap and the bytes of state that differ from sent (all with
+    # full) into frame, returns the end of the data
+    p = F_DATA
+    bitmap = 0
+    for i in range(STREAM_STATE_SIZE):
+        if full or state[i] != sent[i]:
+            bitmap |= 1 << i
+            frame[p] = state[i]
+            p += 1
+    frame[F_BITMAP] = bitmap & 0xff
+    frame[F_BITMAP+1] = (bitmap >> 8) & 0xff
+    frame[F_BITMAP+2] = bitmap >> 16
+    return p
+
+
+class StateStreamer():
+
+    def __init__(self, pm, uart, budget=STREAM_BUDGET, keyframe_ms=KEYFRAME_MS,
+                 batch_ms=BATCH_MS):
+        # budget: bytes per second the stream may use
+        if budget < FRAME_MAX:
+            raise ValueError("budget too small")
+        self.pm = pm
+        self.uart = uart
+        self.budget = budget
+        self.keyframe_ms = keyframe_ms
+        self.batch_ms = batch_ms
+        self.state = bytearray(STREAM_STATE_SIZE)
+        self.sent = bytearray(STREAM_STATE_SIZE)
+        self.frame = bytearray(FRAME_MAX)
+        self.frameview = memoryview(self.frame)
+        self.batch = bytearray(BATCH_SIZE)
+        self.batchview = memoryview(self.batch)
+        self.batchlen = 0
+        self.running = False
+        self.reset()
+
+    def reset(self):
+        # The next frame is a key frame
+        now = utime.ticks_ms()
+        self.seq = 0
+        self.stateseq = -1
+        self.nextkey = now
+        self.lastpoll = now
+        self.batchstart = now
+        self.batchlen = 0
+        self.tokens = FRAME_MAX * 1000
+        self.frames = 0
+        self.keyframes = 0
+        self.bytes = 0
+        self.deferred = 0
+        self.writes = 0
+
+    def poll(self, now=None):
+        # Sends the changes of the state since the last frame if the budget
+        # allows it. Returns the size of the frame or 0.
+        if now is None:
+            now = utime.ticks_ms()
+        elapsed = utime.ticks_diff(now, self.lastpoll)
+        self.lastpoll = now
+        if elapsed > 0:
+            # In 1/1000 bytes, so low budgets work with short poll intervals
+            self.tokens = min(self.tokens + elapsed * self.budget,
+                              self.budget * self.batch_ms + FRAME_MAX * 1000)
+
+        n = 0
+        full = utime.ticks_diff(now, self.nextkey) >= 0
+        stateseq, state = self.pm.snapshot(self.state)
+        if full or stateseq != self.stateseq:
+            n = self.add_frame(state, full)
+            if n < 0:
+                # Retried on the next poll
+                n = 0
+            else:
+                self.stateseq = stateseq
+                if full:
+                    self.nextkey = utime.ticks_add(now, self.keyframe_ms)
+
+        if self.batchlen and (self.batchlen > BATCH_SIZE - FRAME_MAX or
+                              utime.ticks_diff(now, self.batchstart) >= self.batch_ms):
+            self.flush()
+        return n
+
+    def add_frame(self, state, full):
+        # Adds a frame to the batch, returns its size, 0 if nothing changed
+        # or -1 if it doesn't fit into the budget
+        frame = self.frame
+        end = encode_frame(frame, state, self.sent, full)
+        if end == F_DATA and not full:
+            return 0
+        n = end + FRAME_CRC_SIZE
+        if n * 1000 > self.tokens:
+            self.deferred += 1
+            return -1
+
+        frame[0] = STREAM_MAGIC
+        frame[F_TYPE] = FRAME_KEY if full else FRAME_DELTA
+        frame[F_SEQ] = self.seq & 0xff
+        frame[F_SEQ+1] = (self.seq >> 8) & 0xff
+        crc = crc16(frame, F_TYPE, end, crctable)
+        frame[end] = crc & 0xff
+        frame[end+1] = crc >> 8
+
+        if not self.batchlen:
+            self.batchstart = self.lastpoll
+        self.batch[self.batchlen:self.batchlen+n] = self.frameview[0:n]
+        self.batchlen += n
+        self.sent[0:STREAM_STATE_SIZE] = state
+        self.seq = (self.seq + 1) & 0xffff
+        self.tokens -= n * 1000
+        self.frames += 1
+        if full:
+            self.keyframes += 1
+        return n
+
+    def flush(self):
+        if self.batchlen:
+            self.uart.write(self.batchview[0:self.batchlen])
+            self.bytes += self.batchlen
+            self.writes += 1
+            self.batchlen = 0
+
+    def get_stats(self):
+        return {
+            "frames": self.frames,
+            "keyframes": self.keyframes,
+            "bytes": self.bytes,
+            "writes": self.writes,
+            "deferred": self.deferred,
+            }
+
+    def run(self, poll_ms=5):
+        # Streams the state until stop() is called
+        self.running = True
+        while self.running:
+            self.poll()
+            utime.sleep_ms(poll_ms)
+        self.flush()
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,70 @@
+# Shared helpers of the host tests
+#
+# The tests run the code of the Pico on the host with the stand-ins of
+# hostsim and replay the captures in logicanalyzer/:
+#
+#   python3 -m pytest tests
+
+import os
+
+import pytest
+
+import hostsim
+hostsim.install()
+
+from hostsim import lpf, replay
+
+CAPTURE_DIR = os.path.join(hostsim.ROOT_DIR, "logicanalyzer")
+CAPTURES = ("wpcpower.LPF", "wpcpower2.LPF", "wpcpower3.LPF")
+
+
+def capture_path(name):
+    return os.path.join(CAPTURE_DIR, name)
+
+
+class Recording():
+    # A replay with the words the decoder got, before the glitch filter:
+    #   rows:      (column, row data) of every lamp row word
+    #   solenoids: (group, data) of every solenoid word
+    # pv is the decoder module after the replay, res the ReplayResult
+
+    def __init__(self, pv, res, rows, solenoids):
+        self.pv = pv
+        self.res = res
+        self.rows = rows
+        self.solenoids = solenoids
+
+
+def record(name, glitch_filter=None, **kw):
+    # Replays a capture and records the words passed to the decoder
+    pv = replay.load_decoder()
+    if glitch_filter:
+        pv.glitch_n, pv.glitch_m = glitch_filter
+    rows = []
+    solenoids = []
+    decode_row = pv.decode_row
+    decode_solenoids = pv.decode_solenoids
+
+    def record_row(ps, col, data):
+        rows.append((col, data))
+        return decode_row(ps, col, data)
+
+    def record_solenoids(ps, group, data):
+        solenoids.append((group, data))
+        return decode_solenoids(ps, group, data)
+
+    pv.decode_row = record_row
+    pv.decode_solenoids = record_solenoids
+    res = replay.replay(lpf.read_lpf(capture_path(name)), decoder=pv, **kw)
+    return Recording(pv, res, rows, solenoids)
+
+
+@pytest.fixture
+def monitor(tmp_path, monkeypatch):
+    # Returns a function that creates the PowerMonitor of a decoder module,
+    # in an empty directory so no GI calibration file is loaded
+    monkeypatch.chdir(tmp_path)
+
+    def create(pv, **kw):
+        return pv.PowerMonitor(**kw)
+    return create
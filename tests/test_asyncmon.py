@@ -0,0 +1,105 @@
+# asyncio API of asyncmon.py, with the replay check of hostsim/asynccheck.py
+
+from array import array
+
+import pytest
+import uasyncio as asyncio
+
+import asyncmon
+from asyncmon import SIG_ANY, SIG_FRAME, SIG_LAMPS, ChangeNotifier
+
+from hostsim import asynccheck
+
+from conftest import CAPTURES, capture_path
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def waiter(notifier, kind, woken):
+    while True:
+        await notifier.wait(kind)
+        woken.append(kind)
+
+
+def test_coalesced_wakeups():
+    async def main():
+        seq = array('I', [0]*asyncmon.SIG_NUM)
+        notifier = ChangeNotifier(seq)
+        woken = []
+        tasks = [asyncio.create_task(waiter(notifier, kind, woken))
+                 for kind in (SIG_LAMPS, SIG_FRAME, SIG_ANY)]
+        await asyncio.sleep_ms(1)
+
+        # Several signals before the task runs wake each waiter once
+        for i in range(5):
+            seq[SIG_LAMPS] += 1
+            notifier.flag.set()
+        await asyncio.sleep_ms(1)
+        assert sorted(woken) == [SIG_LAMPS, SIG_ANY]
+
+        # A lamp frame isn't a change
+        del woken[:]
+        seq[SIG_FRAME] += 1
+        notifier.flag.set()
+        await asyncio.sleep_ms(1)
+        assert woken == [SIG_FRAME]
+
+        # A set() without a new count wakes nobody
+        del woken[:]
+        notifier.flag.set()
+        await asyncio.sleep_ms(1)
+        assert woken == []
+        assert notifier.get_stats() == {"signals": 6, "wakeups": 3}
+        for task in tasks:
+            task.cancel()
+        notifier.stop()
+    run(main())
+
+
+@pytest.mark.parametrize("name", CAPTURES)
+def test_replay(name):
+    errors, stats = run(asynccheck.check_async(capture_path(name)))
+    assert errors == []
+    assert stats["events"] == stats["changes"]
+    assert stats["async_wakeups"] <= stats["async_signals"]
+
+
+def test_ready_mask(monitor):
+    # ready() returns once the bits of the mask have been seen, even if the
+    # batch that completed them didn't change anything
+    from hostsim import replay
+    pv = replay.load_decoder()
+    pm = monitor(pv)
+    ps = pv.pollstate
+    pv.reset_pollstate()
+    pv.readyinfo[pv.RD_SEEN] = 0
+    pv.readyinfo[pv.RD_READY] = 0
+
+    async def main():
+        done = []
+
+        async def waiter(mask):
+            await pm.ready(mask)
+            done.append(mask)
+        for mask in (pv.READY_FRAME, pv.READY_SOL1 | pv.READY_GI,
+                     pv.READY_ALL):
+            asyncio.create_task(waiter(mask))
+        await asyncio.sleep_ms(1)
+
+        for bit, expected in ((pv.READY_SOL1, []),
+                              (pv.READY_FRAME, [pv.READY_FRAME]),
+                              (pv.READY_GI, [pv.READY_SOL1 | pv.READY_GI]),
+                              (pv.READY_SOL2 | pv.READY_SOL3, []),
+                              (pv.READY_SOL4, [pv.READY_ALL])):
+            del done[:]
+            ps[pv.PS_READY] |= bit
+            pv.signal_changes(ps)
+            await asyncio.sleep_ms(1)
+            assert done == expected, bit
+        assert pm.is_ready()
+        assert pv.signalseq[pv.SIG_READY] == 5
+        assert sum(pv.signalseq) == 5
+        pm.async_notifier().stop()
+    run(main())
@@ -0,0 +1,122 @@
+# .wpcc capture files of hostsim/capture.py
+
+import random
+
+import numpy as np
+import pytest
+
+from hostsim import capture, replay
+from hostsim.capture import CaptureError, CaptureFile, CaptureWriter
+
+from conftest import capture_path
+
+
+def synthetic_events(n=3000, seed=1):
+    # Bus words and zero crossings in us, with some gaps that need TIME_EXT
+    # records
+    rnd = random.Random(seed)
+    times = []
+    t = 0
+    for i in range(n):
+        if rnd.random() < 0.01:
+            t += rnd.randrange(70000, 300000)
+        else:
+            t += rnd.randrange(1, 10)
+        times.append(t)
+    times = np.array(times, dtype=float)
+    zc = np.array([rnd.random() < 0.05 for i in range(n)])
+    words = np.array([rnd.randrange(0x8000) for i in range(n)],
+                     dtype=np.uint32)
+    return times[~zc], words[~zc], times[zc]
+
+
+def test_write_and_read(tmp_path):
+    word_times, words, zc_times = synthetic_events()
+    path = str(tmp_path / "test.wpcc")
+    capture.write_events(path, word_times, words, zc_times, unit_ns=1000,
+                         block_records=64)
+    cap = CaptureFile(path)
+    assert cap.records > len(words) + len(zc_times)
+    assert len(cap.index_times) == -(-cap.records // 64)
+    assert cap.duration_us == max(word_times[-1], zc_times[-1])
+    t, w, z = cap.events()
+    assert list(t) == list(word_times)
+    assert list(w) == list(words)
+    assert list(z) == list(zc_times)
+
+
+def test_time_unit(tmp_path):
+    # Times are rounded to the unit
+    path = str(tmp_path / "test.wpcc")
+    capture.write_events(path, np.array([1.004, 2.5, 70000.0]),
+                         np.array([1, 2, 3]), np.array([3.26]), unit_ns=10)
+    cap = CaptureFile(path)
+    t, w, z = cap.events()
+    assert list(t) == pytest.approx([1.0, 2.5, 70000.0])
+    assert list(z) == pytest.approx([3.26])
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_slices(tmp_path, seed):
+    # read() of a time range only reads the blocks it needs and gives the
+    # records of the range
+    word_times, words, zc_times = synthetic_events(seed=seed)
+    path = str(tmp_path / "test.wpcc")
+    capture.write_events(path, word_times, words, zc_times, unit_ns=1000,
+                         block_records=32)
+    cap = CaptureFile(path)
+    rnd = random.Random(seed)
+    end = int(cap.duration_us)
+    for i in range(20):
+        start_us = rnd.randrange(end)
+        end_us = start_us + rnd.randrange(end // 4)
+        t, w, z = cap.events(start_us, end_us)
+        keep = (word_times >= start_us) & (word_times < end_us)
+        assert list(t) == list(word_times[keep])
+        assert list(w) == list(words[keep])
+        keep = (zc_times >= start_us) & (zc_times < end_us)
+        assert list(z) == list(zc_times[keep])
+
+
+def test_writer_chunks(tmp_path):
+    # Appending in chunks writes the same file as a single append
+    word_times, words, zc_times = synthetic_events()
+    times = np.concatenate((word_times, zc_times))
+    values = np.concatenate((words, np.full(len(zc_times), capture.ZC_FLAG)))
+    order = np.argsort(times, kind="stable")
+    times = times[order].astype(np.int64)
+    values = values[order]
+    with CaptureWriter(str(tmp_path / "a.wpcc"), 1000, 64) as w:
+        w.append(times, values)
+    with CaptureWriter(str(tmp_path / "b.wpcc"), 1000, 64) as w:
+        for i in range(0, len(times), 100):
+            w.append(times[i:i+100], values[i:i+100])
+    assert (tmp_path / "a.wpcc").read_bytes() == \
+        (tmp_path / "b.wpcc").read_bytes()
+
+    with pytest.raises(CaptureError):
+        with CaptureWriter(str(tmp_path / "c.wpcc")) as w:
+            w.append([10, 5], [1, 2])
+
+
+def test_not_a_capture(tmp_path):
+    path = tmp_path / "test.wpcc"
+    path.write_bytes(b"XXXX" + bytes(100))
+    with pytest.raises(CaptureError):
+        CaptureFile(str(path))
+    path.write_bytes(b"WPCC")
+    with pytest.raises(CaptureError):
+        CaptureFile(str(path))
+
+
+def test_replay_converted(tmp_path):
+    # A converted LPF capture replays with the same changes
+    path = str(tmp_path / "wpcpower.wpcc")
+    lpf_path = capture_path("wpcpower.LPF")
+    capture.convert_lpf(lpf_path, path)
+    res = replay.replay_words(*CaptureFile(path).events())
+    from hostsim import lpf
+    plain = replay.replay(lpf.read_lpf(lpf_path))
+    assert [c[1:] for c in res.timeline] == [c[1:] for c in plain.timeline]
+    assert res.lamps == plain.lamps
+    assert res.gi_brightness == plain.gi_brightness
@@ -0,0 +1,295 @@
+# Decoder of powermon_viper.py on the captures in logicanalyzer/
+
+import random
+
+import numpy as np
+import pytest
+
+from hostsim import replay
+
+from conftest import CAPTURES, capture_path, record
+
+# Time from the start of the capture until is_ready(), None if the capture
+# doesn't have everything (wpcpower3.LPF has no zero crossings)
+READY_US = {
+    "wpcpower.LPF": 90526,
+    "wpcpower2.LPF": 86012,
+    "wpcpower3.LPF": None,
+    }
+
+
+def reference_filter(words, n, m):
+    # n of the last m words (the window starts with zeros) have to agree on a
+    # bit before it changes, returns the filtered value after every word
+    window = [0] * m
+    out = 0
+    values = []
+    for data in words:
+        window = window[1:] + [data]
+        for bit in range(8):
+            ones = sum((w >> bit) & 1 for w in window)
+            if ones >= n:
+                out |= 1 << bit
+            elif m - ones >= n:
+                out &= ~(1 << bit)
+        values.append(out)
+    return values
+
+
+def lamp_changes(timeline):
+    # (column, new value) of the lamp changes of a replay
+    return [(index, new) for (t, kind, index, old, new) in timeline
+            if kind == "lamp"]
+
+
+def expected_lamp_changes(rows, filtered=None):
+    # (column, value) for every row word that changes the lamps
+    lamps = [0] * 8
+    changes = []
+    for i in range(len(rows)):
+        col, data = rows[i]
+        if filtered is not None:
+            data = filtered[i]
+        if lamps[col] != data:
+            lamps[col] = data
+            changes.append((col, data))
+    return changes
+
+
+def solenoid_words(pulses, group=0, start_us=1000):
+    # Bus words for pulses (width, pause) of bit 0 of a solenoid group
+    address = (2, 16, 4, 8)[group]
+    times = []
+    words = []
+    t = start_us
+    for width, pause in pulses:
+        times.extend((t, t + width))
+        words.extend(((address << 8) | 1, address << 8))
+        t += width + pause
+    return np.array(times, dtype=float), np.array(words, dtype=np.uint32)
+
+
+@pytest.mark.parametrize("name", CAPTURES)
+def test_ready_time(name, monitor):
+    rec = record(name)
+    assert rec.res.stats["ready_us"] == READY_US[name]
+    pm = monitor(rec.pv)
+    assert pm.is_ready() == (READY_US[name] is not None)
+
+
+@pytest.mark.parametrize("name", CAPTURES)
+def test_paired_and_stamped(name):
+    # Pairing the lamp words in the state machine and stamping the triacs
+    # don't change the result
+    plain = record(name)
+    for kw in ({"paired": True}, {"stamped": True}):
+        other = record(name, **kw)
+        assert other.res.lamps == plain.res.lamps
+        assert other.res.solenoids == plain.res.solenoids
+        assert lamp_changes(other.res.timeline) == \
+            lamp_changes(plain.res.timeline)
+
+
+@pytest.mark.parametrize("name", CAPTURES)
+def test_lamps_follow_row_words(name, monitor):
+    rec = record(name)
+    assert rec.rows
+    assert lamp_changes(rec.res.timeline) == expected_lamp_changes(rec.rows)
+    lamps = bytearray(8)
+    for col, data in rec.rows:
+        lamps[col] = data
+    assert rec.res.lamps == bytes(lamps)
+    seq, state = monitor(rec.pv).snapshot()
+    assert not seq & 1
+    assert state[rec.pv.STATE_LAMPS:rec.pv.STATE_LAMPS+8] == lamps
+
+
+@pytest.mark.parametrize("name", CAPTURES)
+def test_lamp_frame(name, monitor):
+    # The frame is the last scan with the columns 0-7 in order
+    rec = record(name)
+    scans = []
+    scan = None
+    for col, data in rec.rows:
+        if col == 0:
+            scan = [data]
+        elif scan is not None and col == len(scan):
+            scan.append(data)
+            if len(scan) == 8:
+                scans.append(bytes(scan))
+                scan = None
+        else:
+            scan = None
+    count, frame = monitor(rec.pv).get_lamp_frame()
+    assert count == len(scans)
+    assert bytes(frame) == scans[-1]
+
+
+@pytest.mark.parametrize("name", CAPTURES)
+def test_lamp_intensity(name, monitor):
+    # Fraction of the last INTENSITY_WINDOW row words of each column in which
+    # the lamp was on
+    rec = record(name)
+    pv = rec.pv
+    intensity = monitor(pv).get_lamp_intensity()
+    for col in range(8):
+        words = [d for (c, d) in rec.rows if c == col][-pv.INTENSITY_WINDOW:]
+        for row in range(8):
+            on = sum((d >> row) & 1 for d in words)
+            assert intensity[col*8+row] == \
+                (on * 255) >> pv.INTENSITY_SHIFT, (col, row)
+
+
+@pytest.mark.parametrize("n,m", [(1, 1), (2, 2), (2, 3), (3, 4), (3, 5),
+                                 (5, 8), (8, 8)])
+def test_filter_glitches(n, m):
+    pv = replay.load_decoder()
+    flt = bytearray(len(pv.glitchbuf))
+    flt[pv.GF_N] = n
+    flt[pv.GF_M] = m
+    stats = pv.array("I", [0])
+    rnd = random.Random(n * 16 + m)
+    for index in (0, 7, 11):
+        # Mostly stable words with some flipped bits
+        words = []
+        value = 0
+        for i in range(500):
+            if rnd.random() < 0.05:
+                value = rnd.randrange(256)
+            glitch = 1 << rnd.randrange(8) if rnd.random() < 0.2 else 0
+            words.append(value ^ glitch)
+        out = [pv.filter_glitches(flt, index, w, stats) for w in words]
+        assert out == reference_filter(words, n, m)
+
+
+@pytest.mark.parametrize("name", CAPTURES)
+def test_glitch_filter_replay(name):
+    rec = record(name, glitch_filter=(2, 3))
+    filtered = reference_filter_columns(rec.rows, 2, 3)
+    assert lamp_changes(rec.res.timeline) == \
+        expected_lamp_changes(rec.rows, filtered)
+
+
+def reference_filter_columns(rows, n, m):
+    # reference_filter() for each column, in the order of the words
+    columns = {}
+    for col, data in rows:
+        columns.setdefault(col, []).append(data)
+    outputs = {}
+    for col in columns:
+        outputs[col] = iter(reference_filter(columns[col], n, m))
+    return [next(outputs[col]) for col, data in rows]
+
+
+def test_glitch_filter_solenoid():
+    # A single word with the solenoid on is a glitch for a 2 of 3 filter, two
+    # words in a row aren't
+    pv = replay.load_decoder()
+    pv.glitch_n, pv.glitch_m = 2, 3
+    times = np.array([1000, 1002, 1004, 2000, 2002, 2004, 3000, 3002],
+                     dtype=float)
+    words = np.array([0x201, 0x200, 0x200, 0x201, 0x201, 0x200, 0x200, 0x200],
+                     dtype=np.uint32)
+    res = replay.replay_words(times, words, np.zeros(0), decoder=pv)
+    changes = [(t, new) for (t, kind, index, old, new) in res.timeline
+               if kind == "solenoid"]
+    assert changes == [(2002, 1), (3000, 0)]
+    assert pv.glitchstats[0] == 1
+
+
+def test_solenoid_stats(monitor):
+    pv = replay.load_decoder()
+    times, words = solenoid_words([(500, 10000), (3000, 10000), (40, 500)])
+    replay.replay_words(times, words, np.zeros(0), decoder=pv)
+    stats = monitor(pv).get_solenoid_stats(0)
+    assert stats["activations"] == 3
+    assert stats["last_pulse_us"] == 40
+    assert stats["on_us"] == 0
+    hist = [0] * pv.SOL_HIST_BINS
+    for width in (500, 3000, 40):
+        b = 0
+        width >>= pv.SOL_HIST_SHIFT
+        while width and b < pv.SOL_HIST_BINS - 1:
+            width >>= 1
+            b += 1
+        hist[b] += 1
+    assert stats["histogram"] == hist
+    assert monitor(pv).get_solenoid_stats(1)["activations"] == 0
+
+
+def test_solenoid_rate_past_wrap(monitor):
+    # The rate stays right after ticks_us() wrapped (2^30us, about 18 minutes)
+    import utime
+    pv = replay.load_decoder()
+    times, words = solenoid_words([(500, 10000), (3000, 10000), (40, 500)])
+    replay.replay_words(times, words, np.zeros(0), decoder=pv)
+    pm = monitor(pv)
+    now = [0]
+    utime.set_time_source(lambda: now[0])
+    try:
+        pv.reset_soltime()
+        for s in range(100, 2500, 100):
+            now[0] = s * 1000000
+            rate = pm.get_solenoid_stats(0)["rate"]
+            assert abs(rate - 3 / s) < 1e-9, s
+    finally:
+        utime.set_time_source(None)
+
+
+def test_instrumentation_published_while_idle(monitor):
+    # Fewer than PUBLISH_WORDS words followed by only zero crossings for a
+    # second: the instrumentation is published every PUBLISH_US
+    pv = replay.load_decoder()
+    published = []
+    publish = pv.publish_instrumentation
+
+    def record_publish(work, pub, seq):
+        published.append((work[pv.I_WORDS], work[pv.I_ELAPSED_MS]))
+        return publish(work, pub, seq)
+
+    pv.publish_instrumentation = record_publish
+    times, words = solenoid_words([(20, 20)] * 50)
+    zc_times = np.arange(10000, 1000001, 10000, dtype=float)
+    replay.replay_words(times, words, zc_times, decoder=pv)
+    assert len(words) < pv.PUBLISH_WORDS
+    # The last one is the final publish when the poller stops
+    step = pv.PUBLISH_US // 1000
+    assert published == [(len(words), ms) for ms in range(step, 1001, step)]
+    assert monitor(pv).get_instrumentation()[pv.I_WORDS] == len(words)
+
+
+def test_gi_calibration(monitor):
+    # wpcpower.LPF dims the GI through its levels, the table built from the
+    # delays gives each cluster of delays one level, decreasing with the delay
+    rec = record("wpcpower.LPF")
+    pv = rec.pv
+    pm = monitor(pv)
+    assert pm.get_gi_triacs() == 0x1f
+    hist = pm.get_gi_delay_histogram()
+    assert sum(hist) > 0
+    lut = pm.calibrate_gi(save=False)
+    assert lut is not None and len(lut) == pv.GI_LUT_SIZE
+    assert all(lut[i] >= lut[i+1] for i in range(len(lut) - 1))
+    assert pv.gi_lut == lut
+
+    # Not enough delays on the other captures, the table is kept
+    rec = record("wpcpower3.LPF")
+    assert monitor(rec.pv).calibrate_gi(save=False) is None
+    assert rec.pv.gi_lut == rec.pv.default_gi_lut()
+
+
+def test_ready_relative_to_slice(tmp_path):
+    # A slice of a .wpcc file is ready relative to its first record
+    from hostsim import capture
+    path = str(tmp_path / "wpcpower.wpcc")
+    capture.convert_lpf(capture_path("wpcpower.LPF"), path)
+    cap = capture.CaptureFile(path)
+    full = replay.replay_words(*cap.events())
+    assert abs(full.stats["ready_us"] - READY_US["wpcpower.LPF"]) <= 1
+
+    word_times, words, zc_times = cap.events(50000)
+    first = min(word_times[0], zc_times[0])
+    res = replay.replay_words(word_times, words, zc_times, start_us=None)
+    ready_at = replay.replay_words(word_times, words, zc_times).stats["ready_us"]
+    assert res.stats["ready_us"] == ready_at - int(first)
+    assert res.stats["ready_us"] < READY_US["wpcpower.LPF"]
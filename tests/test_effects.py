@@ -0,0 +1,232 @@
+# EffectScheduler and keyframe effects of effects.py with the PWM/Timer
+# stand-ins of hostsim
+
+import math
+
+import machine
+import pytest
+
+import effects
+from effects import (PWM_BACKANDFORTH, PWM_CYCLIC, PWM_RAMP, PWM_RAMPDOWN,
+                     PWM_SINGLESHOT, EffectScheduler, Keyframes, PWMEffect,
+                     from_samples)
+
+MODES = (PWM_SINGLESHOT, PWM_RAMP, PWM_CYCLIC, PWM_BACKANDFORTH)
+SAMPLES = bytearray([0, 4, 8, 16, 32, 64, 128, 255])
+
+
+def pwmeffect_duties(data, mode, ticks):
+    # Duty cycles of a PWMEffect after each tick
+    p = PWMEffect(machine.Pin(0), update_ms=10)
+    p.play_effect(data, mode=mode)
+    duties = []
+    for i in range(ticks):
+        p.update_data()
+        duties.append(p.pwm.duty_u16())
+    p.stop_effect()
+    return duties
+
+
+def scheduler_duties(data, mode, ticks):
+    sched = EffectScheduler(channels=2)
+    ch = sched.add_channel(machine.Pin(0))
+    sched.play_effect(ch, data, mode=mode)
+    duties = []
+    for i in range(ticks):
+        sched.tick()
+        duties.append(sched.pwms[ch].duty_u16())
+    return duties
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_modes_like_pwmeffect(mode):
+    assert scheduler_duties(SAMPLES, mode, 30) == \
+        pwmeffect_duties(SAMPLES, mode, 30)
+
+
+def test_rampdown():
+    sched = EffectScheduler(channels=1)
+    ch = sched.add_channel(machine.Pin(0))
+    sched.play_effect(ch, SAMPLES, mode=PWM_CYCLIC)
+    for i in range(3):
+        sched.tick()
+    assert sched.pwms[ch].duty_u16() == SAMPLES[2] << 8
+    # Backward from the current position, then the channel stops
+    sched.stop_effect(ch, rampdown=True)
+    duties = []
+    while sched.is_playing(ch):
+        sched.tick()
+        duties.append(sched.pwms[ch].duty_u16() >> 8)
+    assert duties == [SAMPLES[3], SAMPLES[2], SAMPLES[1], SAMPLES[0]]
+
+
+def test_divider():
+    sched = EffectScheduler(channels=2)
+    fast = sched.add_channel(machine.Pin(0))
+    slow = sched.add_channel(machine.Pin(1), divider=3)
+    for ch in (fast, slow):
+        sched.play_effect(ch, SAMPLES, mode=PWM_RAMP)
+    positions = []
+    for i in range(9):
+        sched.tick()
+        positions.append(SAMPLES.index(sched.pwms[slow].duty_u16() >> 8))
+    assert positions == [0, 0, 0, 1, 1, 1, 2, 2, 2]
+    assert sched.pwms[fast].duty_u16() == SAMPLES[7] << 8
+
+
+def test_writes_only_changes():
+    sched = EffectScheduler(channels=2)
+    a = sched.add_channel(machine.Pin(0))
+    b = sched.add_channel(machine.Pin(1))
+    sched.play_effect(a, bytearray([10] * 20), mode=PWM_CYCLIC)
+    sched.play_effect(b, SAMPLES, mode=PWM_CYCLIC)
+    writes = [sched.pwms[ch].writes for ch in (a, b)]
+    written = sum(sched.tick() for i in range(16))
+    assert sched.pwms[a].writes - writes[0] == 1
+    # The first sample is the initial duty cycle
+    assert sched.pwms[b].writes - writes[1] == 15
+    assert written == 16
+
+
+def test_single_timer():
+    machine.Timer.timers = []
+    created = machine.Timer.created
+    sched = EffectScheduler(channels=4, tick_ms=10)
+    channels = [sched.add_channel(machine.Pin(i)) for i in range(4)]
+    sched.start()
+    for i in range(3):
+        for ch in channels:
+            sched.play_effect(ch, SAMPLES, mode=PWM_SINGLESHOT)
+            sched.stop_effect(ch)
+    assert machine.Timer.created - created == 1
+    sched.play_effect(channels[0], SAMPLES, mode=PWM_RAMP)
+    for i in range(len(SAMPLES)):
+        machine.Timer.fire_all()
+    assert sched.pwms[channels[0]].duty_u16() == 255 << 8
+    sched.stop()
+    assert machine.Timer.timers == []
+    assert all(sched.pwms[ch].duty_u16() == 0 for ch in channels)
+
+
+def test_no_free_channel():
+    sched = EffectScheduler(channels=1)
+    sched.add_channel(machine.Pin(0))
+    with pytest.raises(ValueError):
+        sched.add_channel(machine.Pin(1))
+
+
+CURVES = {
+    effects.CURVE_LINEAR: lambda x: x,
+    effects.CURVE_EXP: lambda x: (2 ** (8*x) - 1) / 255,
+    effects.CURVE_GAMMA: lambda x: x ** 2.2,
+    effects.CURVE_SINE: lambda x: (1 - math.cos(math.pi * x)) / 2,
+    }
+
+
+@pytest.mark.parametrize("curve", sorted(CURVES))
+def test_keyframe_curves(curve):
+    # Interpolation within 0.1% of the curve, exact at the keyframes
+    kf = Keyframes([(0, 1000), (300, 60000), (1000, 200)], curve)
+    assert kf.length == 1001
+    for (t0, d0), (t1, d1) in (((0, 1000), (300, 60000)),
+                               ((300, 60000), (1000, 200))):
+        assert kf.value(t0) == d0
+        values = [kf.value(t) for t in range(t0, t1 + 1)]
+        assert values[-1] == d1
+        for t in range(t0, t1 + 1):
+            want = d0 + (d1 - d0) * CURVES[curve]((t - t0) / (t1 - t0))
+            assert abs(values[t - t0] - want) <= 66, t
+        # Monotone between two keyframes
+        step = 1 if d1 > d0 else -1
+        assert all((b - a) * step >= 0 for a, b in zip(values, values[1:]))
+    assert kf.value(5000) == 200
+
+
+def test_keyframes():
+    kf = Keyframes([(10, 500), (20, 1500, effects.CURVE_SINE), (30, 0)])
+    # Before the first keyframe, the effect has its duty
+    assert [kf.value(t) for t in (0, 5, 10)] == [500, 500, 500]
+    assert kf.value(15) == 1000
+    assert kf.value(25) == 750
+    assert list(kf.render()) == [kf.value(t) for t in range(31)]
+    fade = effects.fade(65535, 0, 50, effects.CURVE_EXP)
+    assert (fade.length, fade.value(0), fade.value(49)) == (50, 65535, 0)
+    with pytest.raises(ValueError):
+        Keyframes([])
+    with pytest.raises(ValueError):
+        Keyframes([(0, 0), (10, 5), (10, 7)])
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_pwmeffect_kinds(mode):
+    # PWMEffect plays 16-bit tables and keyframes like the scheduler
+    kf = Keyframes([(0, 0), (7, 65535, effects.CURVE_GAMMA), (12, 3000)])
+    for data in (kf, kf.render(), from_samples(SAMPLES)):
+        assert pwmeffect_duties(data, mode, 40) == \
+            scheduler_duties(data, mode, 40)
+
+
+def test_from_samples():
+    # Same duty cycles as the samples
+    for mode in MODES:
+        assert scheduler_duties(from_samples(SAMPLES), mode, 20) == \
+            scheduler_duties(SAMPLES, mode, 20)
+    assert from_samples(SAMPLES, 3) == effects.array('H', [0, 1024, 2048])
+
+
+@pytest.mark.parametrize("mode", MODES + (PWM_RAMPDOWN,))
+def test_keyframes_on_scheduler(mode):
+    # A Keyframes effect plays like its rendered table, also once the cache
+    # has rendered it
+    kf = Keyframes([(0, 0), (7, 65535, effects.CURVE_GAMMA), (12, 3000)])
+    table = kf.render()
+    for i in range(effects.CACHE_PLAYS + 1):
+        assert scheduler_duties(kf, mode, 40) == \
+            scheduler_duties(table, mode, 40)
+
+
+def test_effect_cache():
+    sched = EffectScheduler(channels=1)
+    ch = sched.add_channel(machine.Pin(0))
+    cache = sched.cache
+    kf = effects.fade(0, 65535, 100)
+    for i in range(effects.CACHE_PLAYS - 1):
+        sched.play_effect(ch, kf)
+        assert sched.effects[ch] is kf.data
+    sched.play_effect(ch, kf)
+    assert list(sched.effects[ch]) == list(kf.render())
+    sched.play_effect(ch, kf)
+    assert cache.hits == 1
+
+    # Long effects aren't rendered
+    long = effects.fade(0, 65535, effects.CACHE_MAX_TICKS + 1)
+    for i in range(effects.CACHE_PLAYS + 1):
+        assert cache.lookup(long) is None
+
+
+def test_effect_cache_replaces_coldest():
+    cache = effects.EffectCache(entries=2, plays=1)
+    a, b, c = [effects.fade(0, 1000 * i, 10) for i in (1, 2, 3)]
+    for effect, plays in ((a, 3), (b, 1)):
+        for i in range(plays):
+            assert cache.lookup(effect) is not None
+    # c replaces b, which was played least, once it was played more often
+    assert cache.lookup(c) is None
+    assert cache.lookup(c) is not None
+    assert set(cache.tables) == {a, c}
+
+
+def test_effect_cache_bounded():
+    cache = effects.EffectCache(entries=2, plays=2, max_counts=8)
+    hot = [effects.fade(0, 1000 * i, 10) for i in (1, 2)]
+    for effect in hot:
+        cache.lookup(effect)
+        assert cache.lookup(effect) is not None
+    # Many effects played once don't grow the counts or evict the tables
+    for i in range(100):
+        cache.lookup(effects.fade(0, 7, 10 + i))
+        assert len(cache.counts) <= 8
+    assert set(cache.tables) == set(hot)
+    assert all(cache.lookup(effect) is not None for effect in hot)
+    with pytest.raises(ValueError):
+        effects.EffectCache(entries=4, max_counts=4)
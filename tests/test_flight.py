@@ -0,0 +1,87 @@
+# Flight recorder of powermon_viper.py
+
+import numpy as np
+
+from hostsim import capture, replay, sim
+
+BAD_WORD = 0x7f00
+
+
+def traffic_words(n=4000):
+    # Simulated bus words, more than the recorder holds
+    traffic = sim.make_traffic(50000, n, seed=3)
+    return (np.array(traffic.times, dtype=float),
+            np.array(traffic.words, dtype=np.uint32),
+            np.array(traffic.zc_times, dtype=float))
+
+
+def data_words(pv, records, stamped=False):
+    # Bus words of the records without the zero crossings
+    return [w for t, w in pv.flight_bus_words(records, stamped)
+            if w != pv.CAPTURE_ZC]
+
+
+def test_records_last_words(monitor):
+    pv = replay.load_decoder()
+    word_times, words, zc_times = traffic_words()
+    res = replay.replay_words(word_times, words, zc_times, decoder=pv)
+    assert res.stats["address_errors"] == 0
+    pm = monitor(pv)
+    records = pm.get_flight_records()
+    assert len(records) == pv.FLIGHT_SIZE
+    assert pm.flight_frozen() == 0
+    recorded = data_words(pv, records)
+    assert recorded == list(words[-len(recorded):])
+    zc = [t for t, w in records if w & pv.FLIGHT_ZC]
+    assert len(zc) + len(recorded) == pv.FLIGHT_SIZE
+    assert zc == [int(t) for t in zc_times[-len(zc):]]
+
+
+def test_freeze_on_address_error(monitor, tmp_path):
+    # An unknown address freezes the recorder FLIGHT_POST words later, the
+    # dump has the words before and after it
+    pv = replay.load_decoder()
+    word_times, words, zc_times = traffic_words()
+    bad = 2500
+    words = np.insert(words, bad, BAD_WORD)
+    word_times = np.insert(word_times, bad, word_times[bad] - 0.5)
+    res = replay.replay_words(word_times, words, zc_times, decoder=pv)
+    assert res.stats["address_errors"] == 1
+    pm = monitor(pv)
+    assert pm.flight_frozen() == pv.FLIGHT_ADDRESS
+
+    recorded = data_words(pv, pm.get_flight_records())
+    pos = recorded.index(BAD_WORD)
+    assert recorded == list(words[bad-pos:bad-pos+len(recorded)])
+    # The recorder stops FLIGHT_POST records after the trigger. The words
+    # in the ring buffer that weren't decoded yet were recorded before it.
+    records = pm.get_flight_records()
+    after = len(records) - 1 - [w for t, w in records].index(BAD_WORD)
+    assert pv.FLIGHT_POST <= after <= pv.FLIGHT_POST + pv.RING_SIZE
+
+    path = str(tmp_path / "flight.wpcc")
+    assert pm.check_flight_recorder(path) == pv.FLIGHT_ADDRESS
+    assert pm.flight_frozen() == 0
+    t, w, z = capture.CaptureFile(path).events()
+    assert list(w) == recorded
+    assert len(z) == len(records) - len(recorded)
+
+
+def test_stamped_triacs_once(monitor):
+    # With stamp_zc_triacs, both machines record the triac strobes, the bus
+    # words only have the ones of the zero cross machine
+    pv = replay.load_decoder()
+    word_times, words, zc_times = traffic_words()
+    replay.replay_words(word_times, words, zc_times, decoder=pv, stamps=True)
+    records = monitor(pv).get_flight_records()
+    stamps = [w & ~pv.FLIGHT_ZC for t, w in records
+              if w & pv.FLIGHT_ZC and w & ~pv.FLIGHT_ZC > pv.STAMP_MASK]
+    data = [w for t, w in records if not w & pv.FLIGHT_ZC]
+    assert stamps
+    assert any(w >> 8 == pv.A_TRIACS for w in data)
+
+    bus = data_words(pv, records, stamped=True)
+    assert [w for w in bus if w >> 8 == pv.A_TRIACS] == \
+        [(w >> pv.STAMP_DATA_SHIFT) & 0x1ff for w in stamps]
+    assert [w for w in bus if w >> 8 != pv.A_TRIACS] == \
+        [w for w in data if w >> 8 != pv.A_TRIACS]
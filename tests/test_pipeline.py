@@ -0,0 +1,128 @@
+# Queue and pipeline of pipeline.py, with the thread checks of
+# hostsim/pipecheck.py
+
+import pytest
+
+import pipeline
+from pipeline import Pipeline, SPSCQueue
+
+from hostsim import pipecheck
+from hostsim.pipecheck import FakeMonitor
+
+
+def change(index, old, new):
+    return (index << 16) | (old << 8) | new
+
+
+def test_queue_order():
+    queue = SPSCQueue(8)
+    out = pipeline.array('I', [0]*(3*pipeline.Q_WORDS))
+    received = []
+    # Several times around the buffer
+    for i in range(40):
+        assert queue.push(i, i + 1000)
+        if i % 3 == 2:
+            n = queue.pop(out)
+            received.extend(out[j*pipeline.Q_WORDS] for j in range(n))
+            assert out[pipeline.Q_WORDS+1] == out[pipeline.Q_WORDS] + 1000
+    while len(queue):
+        n = queue.pop(out)
+        received.extend(out[j*pipeline.Q_WORDS] for j in range(n))
+    assert received == list(range(40))
+    assert queue.get_stats() == {"size": 8, "depth": 0, "high_water": 3,
+                                 "drops": 0}
+
+
+def test_queue_full():
+    queue = SPSCQueue(4)
+    assert all(queue.push(i, i) for i in range(4))
+    assert not queue.push(4, 4)
+    assert not queue.push(5, 5)
+    out = pipeline.array('I', [0]*(8*pipeline.Q_WORDS))
+    assert queue.pop(out) == 4
+    assert list(out[0:8:2]) == [0, 1, 2, 3]
+    assert queue.get_stats() == {"size": 4, "depth": 0, "high_water": 4,
+                                 "drops": 2}
+
+
+@pytest.mark.parametrize("size", [0, 3, 100])
+def test_queue_size(size):
+    with pytest.raises(ValueError):
+        SPSCQueue(size)
+
+
+def test_poll():
+    pm = FakeMonitor()
+    pipe = Pipeline(queue_size=16, batch=4)
+    notified = []
+    calls = []
+    pipe.set_lamp_notify(lambda: notified.append("lamps"))
+    pipe.set_solenoid_notify(lambda: notified.append("solenoids"))
+    pipe.add_stage(lambda state, now: calls.append((bytes(state), now)))
+    pipe.add_stage(lambda state, now: calls.append(("idle", now)),
+                   on_change=False)
+    pipe.attach(pm)
+
+    assert pipe.poll(now=1) == 0
+    assert calls == [("idle", 1)]
+    for index, new in ((3, 0x81), (9, 0x04), (3, 0x01)):
+        pm.state[index] = new
+        pipe.queue.push(0, change(index, 0, new))
+    del calls[:]
+    assert pipe.poll(now=2) == 3
+    assert notified == ["lamps", "solenoids"]
+    assert calls == [(bytes(pm.state), 2), ("idle", 2)]
+    assert pipe.state == pm.state
+
+    # More than a batch
+    for i in range(6):
+        pipe.queue.push(0, change(pipeline.STATE_GI, 0, i))
+    assert pipe.poll(now=3) == 4
+    assert pipe.poll(now=4) == 2
+    assert pipe.state[pipeline.STATE_GI] == 5
+    stats = pipe.get_stats()
+    assert (stats["events"], stats["batches"], stats["full_batches"],
+            stats["resyncs"]) == (9, 3, 1, 0)
+
+
+def test_resync_after_drops():
+    pm = FakeMonitor()
+    pipe = Pipeline(queue_size=4, batch=4)
+    notified = []
+    pipe.set_lamp_notify(lambda: notified.append("lamps"))
+    pipe.attach(pm)
+    for i in range(10):
+        # The monitor publishes every change, the queue drops some
+        pm.state[i] = i + 1
+        pipe.queue.push(0, change(i, 0, i + 1))
+    pipe.poll()
+    assert pipe.state == pm.state
+    assert notified == ["lamps"]
+    stats = pipe.get_stats()
+    assert (stats["drops"], stats["resyncs"]) == (6, 1)
+    # Nothing left from before the resync
+    assert pipe.poll() == 0
+
+
+def test_rules():
+    import rules
+    pm = FakeMonitor()
+    pipe = Pipeline(queue_size=16)
+    engine = rules.RuleEngine()
+    fired = []
+    engine.add_rule([rules.lamp(10)], lambda: fired.append(1))
+    pipe.add_rules(engine)
+    pipe.attach(pm)
+    pm.state[1] = 0x04
+    pipe.queue.push(0, change(1, 0, 0x04))
+    pipe.poll(now=5)
+    assert fired == [1]
+
+
+@pytest.mark.parametrize("pace", [0, pipecheck.PACE])
+def test_threads(pace):
+    errors, stats = pipecheck.check_queue(pace, records=20000, size=64)
+    assert errors == 0
+    assert stats["received"] + stats["drops"] == 20000
+    errors, stats = pipecheck.check_pipeline(pace, changes=5000, size=64)
+    assert errors == 0
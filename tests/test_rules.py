@@ -0,0 +1,203 @@
+# RuleEngine of rules.py, on hand made states and on the lamp changes of the
+# captures in logicanalyzer/
+
+import pytest
+
+import rules
+from rules import FALLING, RISING, RuleEngine, lamp, solenoid
+
+from conftest import CAPTURES, record
+
+
+def state_with(*bits):
+    state = bytearray(rules.RULE_STATE_SIZE)
+    for bit in bits:
+        state[bit >> 3] |= 1 << (bit & 7)
+    return state
+
+
+class Counter():
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+
+
+def test_rising_and_falling():
+    engine = RuleEngine()
+    on = Counter()
+    off = Counter()
+    engine.add_rule([lamp(3), solenoid(9)], on)
+    engine.add_rule([lamp(3), solenoid(9)], off, edge=FALLING)
+    engine.reset(state_with())
+
+    assert engine.update(state_with(lamp(3)), now=0) == 0
+    assert engine.update(state_with(lamp(3), solenoid(9)), now=1) == 1
+    assert (on.count, off.count) == (1, 0)
+    # Other bits don't change the condition
+    assert engine.update(state_with(lamp(3), solenoid(9), lamp(4)), now=2) == 0
+    assert engine.update(state_with(solenoid(9)), now=3) == 1
+    assert (on.count, off.count) == (1, 1)
+
+
+def test_off_only_rule():
+    # A rule with only off bits is true in the empty state, reset() doesn't
+    # fire it
+    engine = RuleEngine()
+    action = Counter()
+    r = engine.add_rule([], action, off=[lamp(5), lamp(6)])
+    engine.reset(state_with())
+    assert action.count == 0
+
+    engine.update(state_with(lamp(5)), now=0)
+    engine.update(state_with(lamp(5), lamp(6)), now=1)
+    engine.update(state_with(lamp(6)), now=2)
+    assert action.count == 0
+    engine.update(state_with(), now=3)
+    assert action.count == 1
+    assert engine.get_count(r) == 1
+
+    # Starting with a lamp on, it fires when the lamp goes off
+    engine.reset(state_with(lamp(5)))
+    engine.update(state_with(), now=4)
+    assert action.count == 2
+
+
+def test_hold_ms():
+    engine = RuleEngine()
+    action = Counter()
+    engine.add_rule([lamp(12), lamp(13)], action, hold_ms=200)
+    engine.reset(state_with())
+
+    # Condition true for less than hold_ms
+    engine.update(state_with(lamp(12), lamp(13)), now=1000)
+    assert engine.poll(now=1199) == 0
+    engine.update(state_with(lamp(12)), now=1150)
+    assert engine.poll(now=1500) == 0
+    assert action.count == 0
+
+    # Condition true for hold_ms, fires once
+    engine.update(state_with(lamp(12), lamp(13)), now=2000)
+    assert engine.poll(now=2199) == 0
+    assert engine.poll(now=2200) == 1
+    assert engine.poll(now=3000) == 0
+    assert action.count == 1
+
+    # An update after the hold time fires it as well
+    engine.update(state_with(), now=4000)
+    engine.update(state_with(lamp(12), lamp(13)), now=4100)
+    assert engine.update(state_with(lamp(12), lamp(13), lamp(1)), now=4300) == 1
+    assert action.count == 2
+
+
+def test_hold_ms_falling():
+    engine = RuleEngine()
+    action = Counter()
+    engine.add_rule([solenoid(0)], action, edge=FALLING, hold_ms=50)
+    engine.reset(state_with(solenoid(0)))
+    engine.update(state_with(), now=0)
+    engine.update(state_with(solenoid(0)), now=40)
+    assert engine.poll(now=100) == 0
+    engine.update(state_with(), now=200)
+    assert engine.poll(now=250) == 1
+    assert action.count == 1
+
+
+def reference_fires(states, on, off, edge, hold_ms):
+    # Times a rule fires for a list of (time_ms, state), the hold time is
+    # checked after each state
+    def condition(state):
+        return all(state[b >> 3] & (1 << (b & 7)) for b in on) and \
+            not any(state[b >> 3] & (1 << (b & 7)) for b in off)
+
+    fires = []
+    value = condition(bytearray(rules.RULE_STATE_SIZE))
+    due = None
+    for t, state in states:
+        new = condition(state)
+        if new != value:
+            value = new
+            due = None
+            if new == bool(edge):
+                if hold_ms:
+                    due = t + hold_ms
+                else:
+                    fires.append(t)
+        if due is not None and t >= due:
+            fires.append(t)
+            due = None
+    return fires
+
+
+@pytest.mark.parametrize("name", CAPTURES)
+def test_rules_on_capture(name):
+    # Rules on the lamps of the capture fire like the reference model
+    res = record(name).res
+    states = []
+    state = bytearray(rules.RULE_STATE_SIZE)
+    for t, kind, index, old, new in res.timeline:
+        if kind != "lamp":
+            continue
+        state[rules.RULE_LAMPS + index] = new
+        states.append((int(t) // 1000, bytearray(state)))
+    assert states
+
+    # Rules on the lamps that change in the capture
+    bits = []
+    for t, kind, index, old, new in res.timeline:
+        if kind == "lamp":
+            for row in range(8):
+                bit = lamp(index*8 + row)
+                if (old ^ new) & (1 << row) and bit not in bits:
+                    bits.append(bit)
+    b = [bits[i % len(bits)] for i in range(6)]
+    specs = []
+    for on, off in (([b[0]], []), ([b[0], b[1]], []), ([b[2]], [b[3]]),
+                    ([], [b[4]]), ([b[1], b[5]], [b[2]])):
+        for edge in (RISING, FALLING):
+            for hold_ms in (0, 5, 30):
+                specs.append((on, off, edge, hold_ms))
+
+    engine = RuleEngine()
+    fired = []
+    for i in range(len(specs)):
+        on, off, edge, hold_ms = specs[i]
+        fired.append([])
+        engine.add_rule(on, lambda i=i: fired[i].append(now[0]), off=off,
+                        edge=edge, hold_ms=hold_ms)
+    engine.reset(bytearray(rules.RULE_STATE_SIZE))
+    now = [0]
+    for t, s in states:
+        now[0] = t
+        engine.update(s, now=t)
+
+    for i in range(len(specs)):
+        assert fired[i] == reference_fires(states, *specs[i]), specs[i]
+    assert any(fired)
+
+
+def test_effect_actions():
+    # The actions play any effect on a scheduler channel or a PWMEffect, the
+    # length comes from the effect
+    import machine
+    import effects
+    assert rules.PWM_SINGLESHOT == effects.PWM_SINGLESHOT
+    kf = effects.fade(0, 65535, 5)
+    sched = effects.EffectScheduler(channels=1)
+    ch = sched.add_channel(machine.Pin(0))
+    output = effects.PWMEffect(machine.Pin(1), update_ms=10)
+    table = effects.from_samples(bytearray([0, 128, 255]))
+    for effect, last in ((kf, 65535), (table, 255 << 8)):
+        rules.play(sched, ch, effect, effects.PWM_RAMP)()
+        rules.play_output(output, effect, effects.PWM_RAMP)()
+        for i in range(6):
+            sched.tick()
+            output.update_data()
+        assert sched.pwms[ch].duty_u16() == last
+        assert output.pwm.duty_u16() == last
+        rules.stop(sched, ch)()
+        rules.stop_output(output)()
+        assert not sched.is_playing(ch)
+        assert output.pwm.duty_u16() == 0
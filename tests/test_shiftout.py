@@ -0,0 +1,99 @@
+# Shift register output of shiftout.py into the SPI stand-in
+
+import machine
+import pytest
+
+import shiftout
+from shiftout import ShiftOutput
+
+from hostsim import shiftbench
+from hostsim.shiftbench import FakeMonitor, chain_outputs
+
+
+class LatchPin(machine.Pin):
+    # Records the levels written to the pin
+
+    def __init__(self):
+        super().__init__(22, machine.Pin.OUT)
+        self.levels = []
+
+    def value(self, v=None):
+        if v is not None:
+            self.levels.append(v)
+        return super().value(v)
+
+
+def make_output(outputs=16, invert=False):
+    pm = FakeMonitor()
+    spi = machine.SPI(0)
+    latch = LatchPin()
+    return pm, spi, latch, ShiftOutput(pm, spi, outputs=outputs, latch=latch,
+                                       invert=invert)
+
+
+def test_outputs():
+    pm, spi, latch, out = make_output()
+    out.map_lamp(9, 0)
+    out.map_solenoid(3, 15)
+    out.map_gi(2, 7, threshold=5)
+    out.compile()
+    assert chain_outputs(spi.last, 16) == [0] * 16
+
+    state = bytearray(shiftout.STATE_SIZE)
+    state[1] = 0x02
+    state[8] = 0x08
+    state[shiftout.STATE_GI + 2] = 4
+    pm.set(state)
+    assert out.update()
+    levels = chain_outputs(spi.last, 16)
+    assert (levels[0], levels[7], levels[15]) == (1, 0, 1)
+    assert sum(levels) == 2
+
+    state[shiftout.STATE_GI + 2] = 5
+    pm.set(state)
+    assert out.update()
+    assert chain_outputs(spi.last, 16)[7] == 1
+
+
+def test_latch_pulse():
+    pm, spi, latch, out = make_output()
+    out.map_lamp(0, 0)
+    out.compile()
+    # Low at the start, one pulse after each write
+    assert latch.levels == [0, 1, 0]
+    assert spi.writes == 1
+
+
+def test_write_only_on_change():
+    pm, spi, latch, out = make_output(invert=True)
+    out.map_lamp(0, 3)
+    out.compile()
+    assert chain_outputs(spi.last, 16) == [1] * 16
+    state = bytearray(shiftout.STATE_SIZE)
+    # An unmapped lamp
+    state[0] = 0x02
+    pm.set(state)
+    assert not out.update()
+    state[0] = 0x03
+    pm.set(state)
+    assert out.update()
+    assert chain_outputs(spi.last, 16)[3] == 0
+    assert not out.update()
+    assert out.update(force=True)
+    # compile() writes the chain as well
+    assert out.get_stats() == {"updates": 5, "writes": 3, "pairs": 1}
+
+
+@pytest.mark.parametrize("outputs", [8, 32, 128])
+def test_random_mappings(outputs):
+    assert shiftbench.check(outputs, updates=200) == 0
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        make_output(outputs=12)
+    pm, spi, latch, out = make_output()
+    with pytest.raises(ValueError):
+        out.map_input(shiftout.IN_BITS, 0)
+    with pytest.raises(ValueError):
+        out.map_lamp(0, 16)
@@ -0,0 +1,154 @@
+# Published state (seqlock latch) of powermon_viper.py
+
+import sys
+import threading
+
+from hostsim import replay
+
+from conftest import record
+
+
+class ChangingSeq():
+    # stateseq that returns the given values, one per read
+
+    def __init__(self, values):
+        self.values = list(values)
+
+    def __getitem__(self, i):
+        if len(self.values) > 1:
+            return self.values.pop(0)
+        return self.values[0]
+
+
+def test_snapshot_copy_and_retry(monitor):
+    pv = replay.load_decoder()
+    pm = monitor(pv)
+    size = pv.STATE_SIZE
+    pv.statebuf[0:size] = bytes([1] * size)
+    pv.statebuf[size:2*size] = bytes([2] * size)
+
+    # Even: copy 0 is complete
+    pv.stateseq[0] = 4
+    assert pm.snapshot() == (4, bytearray([1] * size))
+    # Odd: copy 0 is being written, copy 1 is used
+    pv.stateseq[0] = 5
+    seq, buf = pm.snapshot(bytearray(size))
+    assert (seq, buf) == (5, bytearray([2] * size))
+
+    # The counter changed while copying: the copy is repeated
+    pv.stateseq = ChangingSeq([5, 6, 6, 6])
+    assert pm.snapshot() == (6, bytearray([1] * size))
+
+
+def test_publish_state():
+    pv = replay.load_decoder()
+    seq = pv.stateseq[0]
+    pv.publish_state(pv.statebuf, pv.stateseq, pv.STATE_SOLENOIDS,
+                     bytearray([1, 2, 3, 4]), 4)
+    assert pv.stateseq[0] == seq + 2
+    size = pv.STATE_SIZE
+    for copy in (0, 1):
+        state = pv.statebuf[copy*size:(copy+1)*size]
+        assert state[pv.STATE_SOLENOIDS:pv.STATE_GI] == bytes([1, 2, 3, 4])
+        assert state[pv.STATE_LAMPS:pv.STATE_SOLENOIDS] == bytes(8)
+
+
+def test_snapshot_while_publishing(monitor):
+    # A reader thread never sees a state that is partly written: every
+    # published state has all bytes equal
+    pv = replay.load_decoder()
+    pm = monitor(pv)
+    size = pv.STATE_SIZE
+    done = []
+
+    def publisher():
+        for i in range(3000):
+            pv.publish_state(pv.statebuf, pv.stateseq, 0,
+                             bytes([i & 0xff] * size), size)
+        done.append(True)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        thread = threading.Thread(target=publisher)
+        thread.start()
+        snapshots = 0
+        last = -1
+        while not done:
+            seq, buf = pm.snapshot()
+            assert buf == bytes([buf[0]] * size)
+            assert seq >= last
+            last = seq
+            snapshots += 1
+        thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert snapshots
+    assert pm.snapshot()[1] == bytes([2999 & 0xff] * size)
+
+
+def test_snapshot_after_replay(monitor):
+    rec = record("wpcpower.LPF")
+    pv = rec.pv
+    seq, state = monitor(pv).snapshot()
+    assert state[pv.STATE_LAMPS:pv.STATE_SOLENOIDS] == rec.res.lamps
+    assert state[pv.STATE_SOLENOIDS:pv.STATE_GI] == rec.res.solenoids
+    assert state[pv.STATE_GI:pv.STATE_SIZE] == rec.res.gi_brightness
+
+
+def test_read_events(monitor):
+    pv = replay.load_decoder()
+    pm = monitor(pv)
+    for i in range(5):
+        pv.journal_event(pv.eventbuf, pv.eventidx, 1000 + i,
+                         pv.STATE_SOLENOIDS + 1, i, i + 1)
+    buf = pv.array("I", [0] * (3 * pv.EVENT_WORDS))
+    assert pm.read_events(buf) == 3
+    events = [(buf[2*i], buf[2*i+1] >> 16, (buf[2*i+1] >> 8) & 0xff,
+               buf[2*i+1] & 0xff) for i in range(3)]
+    assert events == [(1000, 9, 0, 1), (1001, 9, 1, 2), (1002, 9, 2, 3)]
+    assert pm.read_events(buf) == 2
+    assert (buf[0], buf[1]) == (1003, (9 << 16) | (3 << 8) | 4)
+    assert pm.read_events(buf) == 0
+    assert pm.get_event_drops() == 0
+
+
+def test_journal_full(monitor):
+    # New events are dropped and counted while the journal is full
+    pv = replay.load_decoder()
+    pm = monitor(pv)
+    for i in range(pv.EVENT_NUM + 10):
+        pv.journal_event(pv.eventbuf, pv.eventidx, i, 0, 0, i & 0xff)
+    assert pm.get_event_drops() == 10
+    buf = pv.array("I", [0] * (pv.EVENT_NUM * pv.EVENT_WORDS))
+    assert pm.read_events(buf) == pv.EVENT_NUM
+    assert list(buf[0::2]) == list(range(pv.EVENT_NUM))
+    # There's space again
+    pv.journal_event(pv.eventbuf, pv.eventidx, 7, 0, 0, 0)
+    assert pm.read_events(buf) == 1
+    assert pm.get_event_drops() == 10
+
+
+def test_journal_of_replay(monitor):
+    # The journal has every change of a replay in the order of the timeline
+    rec = record("wpcpower.LPF")
+    pv = rec.pv
+    pm = monitor(pv)
+    offsets = {"lamp": pv.STATE_LAMPS, "solenoid": pv.STATE_SOLENOIDS,
+               "gi": pv.STATE_GI}
+    expected = [(offsets[kind] + index, old, new)
+                for t, kind, index, old, new in rec.res.timeline]
+    assert 0 < len(expected) < pv.EVENT_NUM
+    buf = pv.array("I", [0] * (64 * pv.EVENT_WORDS))
+    events = []
+    while True:
+        n = pm.read_events(buf)
+        if not n:
+            break
+        for i in range(n):
+            w = buf[2*i+1]
+            events.append((buf[2*i], w >> 16, (w >> 8) & 0xff, w & 0xff))
+    assert [e[1:] for e in events] == expected
+    times = [e[0] for e in events]
+    assert times == sorted(times)
+    assert pm.get_event_drops() == 0
@@ -0,0 +1,211 @@
+# StateStreamer of stream.py and the decoder in hostsim/streamdecode.py
+
+import random
+
+import pytest
+import utime
+
+import stream
+from hostsim.streamdecode import StreamDecoder, _CorruptingUART
+
+
+class FakeMonitor():
+
+    def __init__(self):
+        self.state = bytearray(stream.STREAM_STATE_SIZE)
+        self.seq = 0
+
+    def set(self, index, value):
+        self.state[index] = value
+        self.seq += 2
+
+    def snapshot(self, buf=None):
+        if buf is None:
+            buf = bytearray(stream.STREAM_STATE_SIZE)
+        buf[:] = self.state
+        return self.seq, buf
+
+
+class FakeUART():
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, buf):
+        self.writes.append(bytes(buf))
+
+
+@pytest.fixture
+def clock():
+    # Virtual clock for utime, now[0] in ms
+    now = [0]
+    utime.set_time_source(lambda: now[0] * 1000)
+    yield now
+    utime.set_time_source(None)
+
+
+def stream_changes(clock, pm, streamer, uart, steps, seed=1, poll_ms=5):
+    # Changes the state randomly and polls the streamer, returns the state
+    # the streamer had sent after each write
+    rnd = random.Random(seed)
+    sent = []
+    for i in range(steps):
+        if rnd.random() < 0.5:
+            pm.set(rnd.randrange(stream.STREAM_STATE_SIZE), rnd.randrange(256))
+        clock[0] += poll_ms
+        writes = len(uart.writes)
+        streamer.poll(clock[0])
+        if len(uart.writes) != writes:
+            sent.append(bytes(streamer.sent))
+    return sent
+
+
+def test_frames(clock):
+    pm = FakeMonitor()
+    uart = FakeUART()
+    streamer = stream.StateStreamer(pm, uart, batch_ms=0)
+    pm.set(3, 0x81)
+    streamer.poll(clock[0])
+    # The first frame is a key frame with the whole state
+    frame = uart.writes[0]
+    assert frame[0] == stream.STREAM_MAGIC
+    assert frame[stream.F_TYPE] == stream.FRAME_KEY
+    assert len(frame) == stream.FRAME_MAX
+    assert frame[stream.F_DATA + 3] == 0x81
+
+    # A delta frame only has the bytes that changed
+    pm.set(12, 5)
+    pm.set(0, 1)
+    clock[0] += 5
+    streamer.poll(clock[0])
+    frame = uart.writes[1]
+    assert frame[stream.F_TYPE] == stream.FRAME_DELTA
+    assert frame[stream.F_SEQ] == 1
+    bitmap = int.from_bytes(frame[stream.F_BITMAP:stream.F_DATA], "little")
+    assert bitmap == (1 << 0) | (1 << 12)
+    assert frame[stream.F_DATA:stream.F_DATA+2] == bytes([1, 5])
+    assert len(frame) == stream.F_DATA + 2 + stream.FRAME_CRC_SIZE
+
+    # Nothing changed, nothing sent
+    clock[0] += 5
+    assert streamer.poll(clock[0]) == 0
+    assert len(uart.writes) == 2
+
+    decoder = StreamDecoder()
+    applied = decoder.feed(b"".join(uart.writes))
+    assert [(seq, key) for seq, key, state in applied] == [(0, True),
+                                                           (1, False)]
+    assert decoder.state == pm.state
+
+
+def test_decoder_follows_streamer(clock):
+    pm = FakeMonitor()
+    uart = FakeUART()
+    streamer = stream.StateStreamer(pm, uart)
+    decoder = StreamDecoder()
+    sent = stream_changes(clock, pm, streamer, uart, 2000)
+    assert len(sent) == len(uart.writes) > 10
+    for data, state in zip(uart.writes, sent):
+        decoder.feed(data)
+        assert decoder.state == state
+    streamer.flush()
+    for data in uart.writes[len(sent):]:
+        decoder.feed(data)
+    assert decoder.state == pm.state
+    stats = streamer.get_stats()
+    assert stats["keyframes"] == 2000 * 5 // stream.KEYFRAME_MS
+    assert decoder.get_stats()["frames"] == stats["frames"]
+    assert decoder.get_stats()["crc_errors"] == 0
+
+
+def test_budget(clock):
+    # With a low budget, changes are combined into later frames
+    pm = FakeMonitor()
+    uart = FakeUART()
+    budget = 200
+    streamer = stream.StateStreamer(pm, uart, budget=budget, batch_ms=0)
+    decoder = StreamDecoder()
+    stream_changes(clock, pm, streamer, uart, 2000, poll_ms=1)
+    stats = streamer.get_stats()
+    assert stats["deferred"] > 0
+    assert stats["bytes"] <= budget * 2 + stream.FRAME_MAX
+    for i in range(200):
+        clock[0] += 5
+        streamer.poll(clock[0])
+    decoder.feed(b"".join(uart.writes))
+    assert decoder.state == pm.state
+
+
+def test_crc_error_resync(clock):
+    # A corrupt delta frame is dropped, the decoder ignores the following
+    # deltas and resyncs at the next key frame
+    pm = FakeMonitor()
+    uart = FakeUART()
+    streamer = stream.StateStreamer(pm, uart, batch_ms=0)
+    sent = stream_changes(clock, pm, streamer, uart, 1000)
+    frames = [(data[stream.F_TYPE], data) for data in uart.writes]
+    keys = [i for i in range(len(frames)) if frames[i][0] == stream.FRAME_KEY]
+    assert len(keys) >= 3
+    bad = keys[1] + 3
+    assert frames[bad][0] == stream.FRAME_DELTA
+
+    decoder = StreamDecoder()
+    for i in range(len(frames)):
+        data = bytearray(frames[i][1])
+        if i == bad:
+            data[stream.F_DATA] ^= 0x10
+        applied = decoder.feed(data)
+        if bad <= i < keys[2]:
+            assert applied == []
+        else:
+            assert len(applied) == 1
+            assert decoder.state == sent[i]
+    stats = decoder.get_stats()
+    assert stats["crc_errors"] == 1
+    assert stats["gaps"] == 1
+    assert stats["ignored"] == keys[2] - bad - 1
+
+
+def test_corrupt_every_nth_frame(clock):
+    # --corrupt N of the loopback: every Nth frame has a CRC error, the
+    # decoder drops the deltas after it and matches the sent state again from
+    # the next key frame on
+    pm = FakeMonitor()
+    uart = FakeUART()
+    out = _CorruptingUART(uart, 7)
+    streamer = stream.StateStreamer(pm, out, batch_ms=0)
+    sent = stream_changes(clock, pm, streamer, uart, 1000)
+    assert len(out.corrupted) == len(uart.writes) // 7 > 10
+
+    decoder = StreamDecoder()
+    synced = False
+    ignored = 0
+    for i in range(len(uart.writes)):
+        data = uart.writes[i]
+        applied = decoder.feed(data)
+        if (i + 1) % 7 == 0:
+            synced = False
+        elif data[stream.F_TYPE] == stream.FRAME_KEY:
+            synced = True
+        elif not synced:
+            ignored += 1
+        if (i + 1) % 7 and synced:
+            assert len(applied) == 1
+            assert decoder.state == sent[i]
+        else:
+            assert applied == []
+    stats = decoder.get_stats()
+    assert stats["crc_errors"] == len(out.corrupted)
+    assert stats["ignored"] == ignored > 0
+    assert decoder.synced == synced
+
+    # Resyncs at the next key frame that isn't corrupted
+    for i in range(2 * stream.KEYFRAME_MS // 5):
+        clock[0] += 5
+        writes = len(uart.writes)
+        streamer.poll(clock[0])
+        for data in uart.writes[writes:]:
+            decoder.feed(data)
+        if decoder.synced:
+            break
+    assert decoder.synced and decoder.state == pm.state
@@ -0,0 +1,136 @@
+# WS2812 output of ws2812.py with a framebuffer output instead of PIO/DMA
+
+import pytest
+
+import ws2812
+from ws2812 import LEDMap, WS2812
+
+STATE_GI = 12     # GI strings in the state of the PowerMonitor
+RED = (255, 0, 0)
+WARM = (255, 180, 80)
+
+
+class FakeMonitor():
+
+    def __init__(self):
+        self.framenum = 0
+        self.frame = bytearray(8)
+        self.state = bytearray(17)
+        self.intensity = bytearray(64)
+
+    def get_lamp_frame(self, buf=None):
+        if buf is None:
+            buf = bytearray(8)
+        buf[:] = self.frame
+        return self.framenum, buf
+
+    def snapshot(self, buf=None):
+        if buf is None:
+            buf = bytearray(17)
+        buf[:] = self.state
+        return 0, buf
+
+    def get_lamp_intensity(self, buf=None):
+        if buf is None:
+            buf = bytearray(64)
+        buf[:] = self.intensity
+        return buf
+
+
+class FakeOutput():
+    # Keeps the written framebuffers as (r, g, b) lists
+
+    def __init__(self):
+        self.frames = []
+        self.busy_flag = False
+
+    def busy(self):
+        return self.busy_flag
+
+    def write(self, fb, n):
+        self.frames.append([((w >> 16) & 0xff, w >> 24, (w >> 8) & 0xff)
+                            for w in fb[:n]])
+
+
+def scale(color, level):
+    return tuple((c * (level + 1)) >> 8 for c in color)
+
+
+def make_strip(mode=ws2812.LAMPS_ONOFF):
+    leds = LEDMap()
+    leds.add_lamp(12, RED)
+    leds.add_lamps(range(0, 3), (0, 0, 255))
+    leds.add_gi(2, WARM, count=2)
+    pm = FakeMonitor()
+    out = FakeOutput()
+    return pm, out, WS2812(pm, leds, output=out, lamps=mode)
+
+
+def test_led_map():
+    leds = LEDMap()
+    assert leds.add_lamp(63, RED) == 0
+    leds.add_gi(4, WARM, count=3)
+    assert len(leds) == 4
+    assert bytes(leds.compile()) == bytes([63, 255, 0, 0] + [68, 255, 180, 80] * 3)
+    with pytest.raises(ValueError):
+        leds.add_lamp(64, RED)
+    with pytest.raises(ValueError):
+        leds.add_gi(5, RED)
+
+
+def test_render():
+    pm, out, strip = make_strip()
+    gamma = strip.gamma
+    # Lamp 12 is column 1, row 4
+    pm.frame[1] = 1 << 4
+    pm.frame[0] = 0b101
+    pm.state[STATE_GI + 2] = 4
+    pm.framenum = 1
+    assert strip.update()
+    gi = scale(WARM, gamma[4 * 255 // ws2812.GI_MAX])
+    assert out.frames[-1] == [RED, (0, 0, 255), (0, 0, 0), (0, 0, 255), gi, gi]
+
+
+def test_update_on_change():
+    pm, out, strip = make_strip()
+    assert strip.update()
+    assert not strip.update()
+    assert len(out.frames) == 1
+    # A new lamp frame, even with the same lamps
+    pm.framenum += 1
+    assert strip.update()
+    # A GI change
+    pm.state[STATE_GI] = 8
+    assert strip.update()
+    assert strip.get_stats() == {"renders": 3, "writes": 3}
+
+
+def test_flush_waits_for_output():
+    pm, out, strip = make_strip()
+    strip.update()
+    first = strip.fbs[0]
+    out.busy_flag = True
+    pm.framenum += 1
+    pm.frame[1] = 0x10
+    # Rendered into the other framebuffer, sent once the output is free
+    assert strip.update()
+    assert len(out.frames) == 1
+    assert strip.fbs[1] is not first
+    pm.framenum += 1
+    pm.frame[1] = 0
+    strip.update()
+    assert len(out.frames) == 1
+    out.busy_flag = False
+    strip.update()
+    assert len(out.frames) == 2
+    assert out.frames[-1][0] == (0, 0, 0)
+
+
+def test_intensity():
+    pm, out, strip = make_strip(ws2812.LAMPS_INTENSITY)
+    pm.intensity[12] = 128
+    pm.intensity[1] = 255
+    strip.update()
+    assert out.frames[-1][0] == scale(RED, strip.gamma[128])
+    assert out.frames[-1][2] == (0, 0, 255)
+
@@ -0,0 +1,239 @@
+from micropython import const
+from array import array
+import rp2
+
+# WS2812 LED output
+#
+# Mirrors lamps and GI strings of the machine to a WS2812 LED strip:
+#
+#   leds = LEDMap()
+#   leds.add_lamp(12, (255, 0, 0))        # lamp 12 (column*8+row) in red
+#   leds.add_lamps(range(0, 8), (255, 255, 255))
+#   leds.add_gi(0, (255, 180, 80), count=10)   # 10 LEDs follow GI string 0
+#   strip = WS2812(pm, leds, machine.Pin(22))
+#   while True:
+#       strip.update()
+#       utime.sleep_ms(5)
+#
+# compile() converts the map into a table with the source and the color of
+# every LED. update() renders the LEDs only when a new lamp matrix frame (see
+# PowerMonitor.get_lamp_frame()) has been scanned or the GI changed: the levels
+# of all sources are looked up in the gamma table and multiplied with the
+# colors into a framebuffer of GRB words. The framebuffer is sent to the PIO
+# program by DMA, so the CPU isn't busy while the strip is updated.
+
+# LED sources: lamps 0-63, GI strings SRC_GI+0..4
+SRC_GI = const(64)
+SRC_NUM = const(69)
+GI_MAX = const(8)         # GI brightness levels of the poller (GI_LEVELS)
+
+# PowerMonitor.snapshot(): lamps, solenoids, GI brightness
+STATE_GI = const(12)
+STATE_SIZE = const(17)
+
+LT_SOURCE = const(0)
+LT_RED = const(1)
+LT_GREEN = const(2)
+LT_BLUE = const(3)
+LT_FIELDS = const(4)
+
+# Lamp levels: on/off from the lamp matrix or brightness from
+# PowerMonitor.get_lamp_intensity()
+LAMPS_ONOFF = const(0)
+LAMPS_INTENSITY = const(1)
+
+WS2812_FREQ = const(8000000)
+WS2812_SM = const(7)
+GAMMA = 2.2
+
+
+def gamma_table(gamma=GAMMA, maxlevel=255):
+    table = bytearray(256)
+    for i in range(256):
+        table[i] = int(((i / 255) ** gamma) * maxlevel + 0.5)
+    return table
+
+
+@rp2.asm_pio(sideset_init=rp2.PIO.OUT_LOW,
+             out_shiftdir=rp2.PIO.SHIFT_LEFT,
+             autopull=True,
+             pull_thresh=24,
+             fifo_join=rp2.PIO.JOIN_TX
+             )
+def ws2812():
+    # 10 cycles per bit at 8MHz: 1 is 0.875us high (7 cycles), 0 is 0.25us
+    # high (2 cycles)
+    wrap_target()
+    label("bitloop")
+    out(x, 1)               .side(0)    [2]
+    jmp(not_x, "do_zero")   .side(1)    [1]
+    jmp("bitloop")          .side(1)    [4]
+    label("do_zero")
+    nop()                   .side(0)    [4]
+    wrap()
+
+
+@micropython.viper
+def lamp_levels(levels: ptr8, frame: ptr8, gamma: ptr8, mode: int):
+    # Levels of the 64 lamps: gamma corrected on/off (frame is the lamp
+    # matrix) or brightness (frame is the lamp intensity)
+    if mode == LAMPS_INTENSITY:
+        for i in range(64):
+            levels[i] = gamma[frame[i]]
+        return
+    on = gamma[255]
+    off = gamma[0]
+    for col in range(8):
+        row = frame[col]
+        for b in range(8):
+            if row & 1:
+                levels[col*8+b] = on
+            else:
+                levels[col*8+b] = off
+            row = row >> 1
+
+
+@micropython.viper
+def render_leds(fb: ptr32, table: ptr8, levels: ptr8, n: int):
+    # fb[i] = GRB of LED i in the upper 24 bits, as ws2812 shifts them out
+    t = 0
+    for i in range(n):
+        level = levels[table[t+LT_SOURCE]] + 1
+        r = (table[t+LT_RED] * level) >> 8
+        g = (table[t+LT_GREEN] * level) >> 8
+        b = (table[t+LT_BLUE] * level) >> 8
+        fb[i] = (g << 24) | (r << 16) | (b << 8)
+        t += LT_FIELDS
+
+
+class LEDMap():
+    # Source and color of every LED of the strip, in the order of the strip
+
+    def __init__(self):
+        self.leds = []
+
+    def add_lamp(self, lamp, color):
+        # Adds an LED that shows a lamp (column*8+row), color is (r, g, b)
+        if lamp < 0 or lamp >= SRC_GI:
+            raise ValueError("invalid lamp")
+        self.leds.append((lamp, color))
+        return len(self.leds) - 1
+
+    def add_lamps(self, lamps, color):
+        for lamp in lamps:
+            self.add_lamp(lamp, color)
+
+    def add_gi(self, gi, color, count=1):
+        # Adds count LEDs that show the brightness of GI string gi (0-4)
+        if gi < 0 or gi >= SRC_NUM - SRC_GI:
+            raise ValueError("invalid GI string")
+        for i in range(count):
+            self.leds.append((SRC_GI + gi, color))
+
+    def __len__(self):
+        return len(self.leds)
+
+    def compile(self):
+        table = bytearray(len(self.leds) * LT_FIELDS)
+        t = 0
+        for source, color in self.leds:
+            table[t+LT_SOURCE] = source
+            table[t+LT_RED] = color[0]
+            table[t+LT_GREEN] = color[1]
+            table[t+LT_BLUE] = color[2]
+            t += LT_FIELDS
+        return table
+
+
+class PIOOutput():
+    # Sends a framebuffer to the strip with a PIO state machine fed by DMA
+
+    def __init__(self, pin, sm_id=WS2812_SM):
+        self.sm = rp2.StateMachine(sm_id, ws2812, freq=WS2812_FREQ,
+                                   sideset_base=pin)
+        self.sm.active(1)
+        self.dma = rp2.DMA()
+        # DREQ of the TX FIFO: PIO0 TX0-3 are 0-3, PIO1 TX0-3 are 8-11
+        dreq = (sm_id & 3) + (sm_id >> 2) * 8
+        self.ctrl = self.dma.pack_ctrl(size=2, inc_write=False, treq_sel=dreq)
+
+    def busy(self):
+        return self.dma.active()
+
+    def write(self, fb, n):
+        self.dma.config(read=fb, write=self.sm, count=n, ctrl=self.ctrl,
+                        trigger=True)
+
+    def close(self):
+        self.dma.close()
+        self.sm.active(0)
+
+
+class WS2812():
+
+    def __init__(self, pm, leds, pin=None, output=None, sm_id=WS2812_SM,
+                 lamps=LAMPS_ONOFF, gamma=None):
+        # output: object with busy() and write(fb, n), default PIOOutput on pin
+        self.pm = pm
+        self.n = len(leds)
+        self.table = leds.compile()
+        if gamma is None:
+            gamma = gamma_table()
+        self.gamma = gamma
+        if output is None:
+            output = PIOOutput(pin, sm_id)
+        self.output = output
+        self.mode = lamps
+
+        # Two framebuffers, one is rendered while the other is sent
+        self.fbs = (array('I', [0]*self.n), array('I', [0]*self.n))
+        self.back = 0
+        self.pending = False
+        self.levels = bytearray(SRC_NUM)
+        self.frame = bytearray(8)
+        self.intensity = bytearray(64)
+        self.state = bytearray(STATE_SIZE)
+        self.gi = bytearray(SRC_NUM - SRC_GI)
+        self.lastframe = -1
+        self.renders = 0
+        self.writes = 0
+
+    def update(self, force=False):
+        # Renders and sends the LEDs if the lamps or GI changed. Returns True
+        # if a new framebuffer was rendered.
+        pm = self.pm
+        framenum, frame = pm.get_lamp_frame(self.frame)
+        seq, state = pm.snapshot(self.state)
+        changed = force or framenum != self.lastframe
+        for i in range(SRC_NUM - SRC_GI):
+            if state[STATE_GI+i] != self.gi[i]:
+                self.gi[i] = state[STATE_GI+i]
+                changed = True
+        if changed:
+            self.lastframe = framenum
+            self.render(frame)
+        self.flush()
+        return changed
+
+    def render(self, frame):
+        levels = self.levels
+        if self.mode == LAMPS_INTENSITY:
+            frame = self.pm.get_lamp_intensity(self.intensity)
+        lamp_levels(levels, frame, self.gamma, self.mode)
+        for i in range(SRC_NUM - SRC_GI):
+            levels[SRC_GI+i] = self.gamma[min(self.gi[i], GI_MAX) * 255 // GI_MAX]
+        render_leds(self.fbs[self.back], self.table, levels, self.n)
+        self.pending = True
+        self.renders += 1
+
+    def flush(self):
+        # Sends the last rendered framebuffer unless the previous one is still
+        # being sent
+        if self.pending and not self.output.busy():
+            self.output.write(self.fbs[self.back], self.n)
+            self.back ^= 1
+            self.pending = False
+            self.writes += 1
+
+    def get_stats(self):
+        return {"renders": self.renders, "writes": self.writes}